@@ -0,0 +1,8 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Benchmarks of liblp, run with python -m benchmarks from the repository root.
+"""
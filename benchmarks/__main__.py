@@ -0,0 +1,295 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Run the benchmarks on synthetic super images and write the results as
+JSON. Results of two runs can be compared with --compare.
+"""
+
+from argparse import ArgumentParser
+from io import BytesIO
+import json
+import os
+from pathlib import Path
+import platform
+from random import Random
+from shutil import rmtree
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter, strftime
+from timeit import Timer
+from typing import Callable, List
+
+import liblp
+from liblp import (
+	LP_METADATA_MINOR_VERSION_MIN,
+	LP_METADATA_VERSION_FOR_EXPANDED_HEADER,
+	GetPartitionSize,
+	ReadMetadata,
+)
+from liblp.partition_tools.lpunpack import lpunpack
+from liblp.reader import ParseMetadata, ReadLogicalPartitionGeometry
+from liblp.sparse import BlockClassifier, ClassifyBlocks
+from liblp.writer import MetadataSerializer, SerializeMetadata
+
+from benchmarks.generator import PATTERN_SIZE, MiB, BuildSuperMetadata, GenerateSuperImage
+
+RESULTS_VERSION = 1
+
+HEADER_VERSIONS = {
+	"1.0": LP_METADATA_MINOR_VERSION_MIN,
+	"1.2": LP_METADATA_VERSION_FOR_EXPANDED_HEADER,
+}
+
+# Name, then GenerateSuperImage() arguments.
+DEFAULT_SCENARIOS = [
+	("plain", dict(size=256 * MiB, partitions=4, fragmentation=1, slots=2,
+	               minor_version=LP_METADATA_MINOR_VERSION_MIN)),
+	("fragmented", dict(size=256 * MiB, partitions=8, fragmentation=16, slots=2,
+	                    minor_version=LP_METADATA_VERSION_FOR_EXPANDED_HEADER)),
+	("many_extents", dict(size=256 * MiB, partitions=64, fragmentation=16, slots=3,
+	                      minor_version=LP_METADATA_VERSION_FOR_EXPANDED_HEADER,
+	                      alignment=4096)),
+]
+
+# Name, then lpunpack() arguments.
+EXTRACTION_MODES = [
+	("default", dict()),
+	("jobs4", dict(jobs=4)),
+	("no_cache", dict(bypass_cache=True)),
+]
+
+# Size of the data classified by the sparse benchmarks.
+CLASSIFY_SIZE = 64 * MiB
+CLASSIFY_BLOCK_SIZE = 4096
+# Layout of the metadata serialized by the serializer benchmarks.
+SERIALIZE_PARTITIONS = 1000
+SERIALIZE_FRAGMENTATION = 4
+
+def Measure(function: Callable[[], object], repeat: int, number: int = 1) -> List[float]:
+	"""Return the time of each of |repeat| runs of |number| calls, per call."""
+	return [total / number for total in Timer(function).repeat(repeat, number)]
+
+def GetNumber(function: Callable[[], object], target: float = 0.2) -> int:
+	"""Return how many calls of |function| take about |target| seconds."""
+	start = perf_counter()
+	function()
+	elapsed = perf_counter() - start
+	return max(1, int(target / max(elapsed, 1e-9)))
+
+def Result(name: str, scenario: str, unit: str, samples: List[float],
+           higher_is_better: bool = False) -> dict:
+	return {
+		"name": name,
+		"scenario": scenario,
+		"unit": unit,
+		"value": median(samples),
+		"best": max(samples) if higher_is_better else min(samples),
+		"higher_is_better": higher_is_better,
+		"samples": samples,
+	}
+
+def DropFromCache(path: Path):
+	# Clean pages can be dropped without privileges.
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+		os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+	finally:
+		os.close(fd)
+
+def BenchReadMetadata(image: Path, scenario: str, repeat: int) -> dict:
+	def Read():
+		ReadMetadata(image, 0)
+
+	number = GetNumber(Read)
+	samples = [seconds * 1e6 for seconds in Measure(Read, repeat, number)]
+	return Result("read_metadata", scenario, "us", samples)
+
+def BenchParseTables(image: Path, scenario: str, repeat: int) -> dict:
+	with image.open('rb') as fd:
+		geometry = ReadLogicalPartitionGeometry(fd)
+	metadata = ReadMetadata(image, 0)
+	blob = SerializeMetadata(metadata)
+	entries = len(metadata.partitions) + len(metadata.extents) \
+		+ len(metadata.groups) + len(metadata.block_devices)
+
+	def Parse():
+		ParseMetadata(geometry, BytesIO(blob))
+
+	number = GetNumber(Parse)
+	samples = [entries / seconds for seconds in Measure(Parse, repeat, number)]
+	return Result("parse_tables", scenario, "entries/s", samples, True)
+
+def BenchExtraction(image: Path, scenario: str, repeat: int, workdir: Path) -> List[dict]:
+	metadata = ReadMetadata(image, 0)
+	total = sum(GetPartitionSize(metadata, partition) for partition in metadata.partitions)
+
+	results = []
+	for mode, kwargs in EXTRACTION_MODES:
+		output = workdir / "extracted"
+		samples = []
+		for _ in range(repeat):
+			rmtree(output, ignore_errors=True)
+			output.mkdir()
+			DropFromCache(image)
+			start = perf_counter()
+			lpunpack(image, output, **kwargs)
+			samples.append(total / MiB / (perf_counter() - start))
+		rmtree(output)
+		results.append(Result(f"extract/{mode}", scenario, "MiB/s", samples, True))
+
+	return results
+
+def GetClassifyData(kind: str) -> bytes:
+	pattern = Random(0).getrandbits(PATTERN_SIZE * 8).to_bytes(PATTERN_SIZE, "little")
+	if kind == "random":
+		return pattern * (CLASSIFY_SIZE // PATTERN_SIZE)
+	if kind == "zeros":
+		return bytes(CLASSIFY_SIZE)
+	# Alternating random and zero MiBs.
+	return (pattern + bytes(PATTERN_SIZE)) * (CLASSIFY_SIZE // PATTERN_SIZE // 2)
+
+def BenchClassifyBlocks(repeat: int) -> List[dict]:
+	results = []
+	for kind in ("random", "zeros", "mixed"):
+		data = GetClassifyData(kind)
+		samples = [CLASSIFY_SIZE / MiB / seconds for seconds in
+		           Measure(lambda: ClassifyBlocks(data, CLASSIFY_BLOCK_SIZE), repeat)]
+		results.append(Result(f"classify/{kind}", "sparse", "MiB/s", samples, True))
+	return results
+
+def BenchBlockClassifier(repeat: int, workdir: Path) -> List[dict]:
+	path = workdir / "classify.img"
+	path.write_bytes(GetClassifyData("mixed"))
+
+	results = []
+	try:
+		for jobs in sorted({1, os.cpu_count() or 1}):
+			with BlockClassifier(CLASSIFY_BLOCK_SIZE, jobs) as classifier:
+				def Classify():
+					for _ in classifier.ClassifyFile(str(path), 0, CLASSIFY_SIZE):
+						pass
+
+				samples = [CLASSIFY_SIZE / MiB / seconds for seconds in Measure(Classify, repeat)]
+			results.append(Result(f"classifier/jobs{jobs}", "sparse", "MiB/s", samples, True))
+	finally:
+		path.unlink()
+
+	return results
+
+def BenchSerializer(repeat: int) -> List[dict]:
+	results = []
+	for version, minor_version in HEADER_VERSIONS.items():
+		metadata = BuildSuperMetadata(1024 * MiB, SERIALIZE_PARTITIONS, SERIALIZE_FRAGMENTATION,
+		                              minor_version=minor_version, alignment=4096)
+		serializer = MetadataSerializer()
+		blob = bytes(serializer.Serialize(metadata))
+
+		def Serialize():
+			serializer.Serialize(metadata)
+
+		def RoundTrip():
+			parsed = ParseMetadata(metadata.geometry, BytesIO(blob))
+			assert serializer.Serialize(parsed) == blob, "Round trip changed the metadata"
+
+		RoundTrip()
+		for name, function in (("serialize", Serialize), ("round_trip", RoundTrip)):
+			number = GetNumber(function)
+			samples = [seconds * 1e6 for seconds in Measure(function, repeat, number)]
+			results.append(Result(f"{name}/{version}", "serializer", "us", samples))
+	return results
+
+def RunScenario(name: str, arguments: dict, workdir: Path, repeat: int,
+                extraction: bool) -> List[dict]:
+	image = workdir / f"{name}.img"
+	GenerateSuperImage(image, **arguments)
+	try:
+		results = [
+			BenchReadMetadata(image, name, repeat),
+			BenchParseTables(image, name, repeat),
+		]
+		if extraction:
+			results.extend(BenchExtraction(image, name, repeat, workdir))
+	finally:
+		image.unlink()
+
+	return results
+
+def Compare(results: dict, baseline: dict):
+	old = {(result["scenario"], result["name"]): result for result in baseline["results"]}
+	for result in results["results"]:
+		previous = old.get((result["scenario"], result["name"]))
+		if not previous:
+			continue
+		ratio = result["value"] / previous["value"]
+		if not result["higher_is_better"]:
+			ratio = 1 / ratio
+		print(f"{result['scenario']:>14} {result['name']:<18} "
+		      f"{previous['value']:>14.1f} -> {result['value']:>14.1f} {result['unit']:<10} "
+		      f"{ratio:.2f}x")
+
+def main():
+	parser = ArgumentParser(description='liblp benchmarks on synthetic super images')
+	parser.add_argument('-o', '--output', help='Write the results to this JSON file', type=Path)
+	parser.add_argument('--compare', help='Compare the results with a previous JSON file', type=Path)
+	parser.add_argument('--workdir', help='Directory for the images (default is a temporary directory)', type=Path)
+	parser.add_argument('--repeat', help='Number of measurements of each benchmark (default is 5).', type=int, default=5)
+	parser.add_argument('--no-extraction', help='Skip the extraction benchmarks', action='store_true')
+	parser.add_argument('--no-micro', help='Skip the benchmarks that don\'t use a super image', action='store_true')
+	parser.add_argument('--size', help='Run a single scenario with a super image of this size, in MiB', type=int)
+	parser.add_argument('--partitions', help='Number of partitions of the single scenario (default is 4).', type=int, default=4)
+	parser.add_argument('--fragmentation', help='Extents per partition of the single scenario (default is 1).', type=int, default=1)
+	parser.add_argument('--slots', help='Metadata slots of the single scenario (default is 2).', type=int, default=2)
+	parser.add_argument('--header-version', help='Metadata header version of the single scenario (default is 1.0).', choices=list(HEADER_VERSIONS), default='1.0')
+	args = parser.parse_args()
+
+	scenarios = DEFAULT_SCENARIOS
+	if args.size:
+		scenarios = [("custom", dict(size=args.size * MiB, partitions=args.partitions,
+		                             fragmentation=args.fragmentation, slots=args.slots,
+		                             minor_version=HEADER_VERSIONS[args.header_version]))]
+
+	results = {
+		"version": RESULTS_VERSION,
+		"date": strftime("%Y-%m-%dT%H:%M:%S%z"),
+		"environment": {
+			"liblp": liblp.__version__,
+			"python": platform.python_version(),
+			"implementation": platform.python_implementation(),
+			"platform": platform.platform(),
+			"cpu_count": os.cpu_count(),
+		},
+		"scenarios": {name: arguments for name, arguments in scenarios},
+		"results": [],
+	}
+
+	def AddResults(new_results: List[dict]):
+		for result in new_results:
+			results["results"].append(result)
+			print(f"{result['scenario']:>14} {result['name']:<18} "
+			      f"{result['value']:>14.1f} {result['unit']}")
+
+	with TemporaryDirectory(dir=args.workdir) as workdir:
+		for name, arguments in scenarios:
+			AddResults(RunScenario(name, arguments, Path(workdir), args.repeat,
+			                       not args.no_extraction))
+		if not args.no_micro:
+			AddResults(BenchClassifyBlocks(args.repeat))
+			AddResults(BenchSerializer(args.repeat))
+			AddResults(BenchBlockClassifier(args.repeat, Path(workdir)))
+
+	if args.output:
+		with args.output.open('w') as fd:
+			json.dump(results, fd, indent=1)
+
+	if args.compare:
+		with args.compare.open() as fd:
+			baseline = json.load(fd)
+		print()
+		Compare(results, baseline)
+
+if __name__ == '__main__':
+	main()
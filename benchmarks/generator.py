@@ -0,0 +1,93 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Synthetic super image generator.
+"""
+
+import os
+from random import Random
+
+from liblp import (
+	LP_METADATA_MINOR_VERSION_MIN,
+	LP_PARTITION_ATTR_READONLY,
+	LP_SECTOR_SIZE,
+	LP_TARGET_TYPE_LINEAR,
+	BlockDeviceInfo,
+	LpMetadata,
+	MetadataBuilder,
+	WriteToImageFile,
+)
+from liblp.utility import WriteFully
+
+MiB = 1024 * 1024
+
+# Size of the random block partitions are filled with.
+PATTERN_SIZE = MiB
+
+def GetMetadataMaxSize(partitions: int, fragmentation: int) -> int:
+	# Expanded header, partitions, extents, one group and one block device.
+	size = 256 + partitions * 52 + partitions * fragmentation * 24 + 48 * 2 + 64
+	return max(64 * 1024, size + -size % 4096)
+
+def BuildSuperMetadata(size: int = 256 * MiB, partitions: int = 4,
+                       fragmentation: int = 1, slots: int = 2,
+                       minor_version: int = LP_METADATA_MINOR_VERSION_MIN,
+                       fill: float = 0.75, alignment: int = MiB) -> LpMetadata:
+	"""
+	Build the metadata of a |size| bytes super image with |slots| metadata
+	slots at |minor_version|. |partitions| partitions share |fill| of the
+	space, each split into |fragmentation| extents interleaved with the
+	others. Extents are aligned to |alignment|.
+	"""
+	builder = MetadataBuilder.New([BlockDeviceInfo("super", size, alignment, 0, 4096)], "super",
+	                              GetMetadataMaxSize(partitions, fragmentation), slots)
+	builder.header.minor_version = minor_version
+
+	partition_list = [builder.AddPartition(f"bench_{i}", LP_PARTITION_ATTR_READONLY)
+	                  for i in range(partitions)]
+
+	# Grow the partitions in turns, so that each growth lands after the
+	# other partitions and starts a new extent.
+	alignment = builder.block_devices[0].alignment
+	step = int(builder.AllocatableSpace() * fill) // (partitions * fragmentation)
+	step -= step % alignment
+	assert step, "Super image is too small for this layout"
+	for _ in range(fragmentation):
+		for partition in partition_list:
+			assert builder.ResizePartition(partition, partition.size + step), \
+				"Not enough space for the partitions"
+
+	return builder.Export()
+
+def GenerateSuperImage(path: str, size: int = 256 * MiB, partitions: int = 4,
+                       fragmentation: int = 1, slots: int = 2,
+                       minor_version: int = LP_METADATA_MINOR_VERSION_MIN,
+                       fill: float = 0.75, alignment: int = MiB, seed: int = 0) -> LpMetadata:
+	"""
+	Write a super image laid out by BuildSuperMetadata() to |path|, with
+	partitions filled with pseudo-random data from |seed|.
+	"""
+	metadata = BuildSuperMetadata(size, partitions, fragmentation, slots, minor_version,
+	                              fill, alignment)
+	WriteToImageFile(path, metadata, 4096, {}, False)
+
+	pattern = Random(seed).getrandbits(PATTERN_SIZE * 8).to_bytes(PATTERN_SIZE, "little")
+	fd = os.open(path, os.O_WRONLY)
+	try:
+		for extent in metadata.extents:
+			if extent.target_type != LP_TARGET_TYPE_LINEAR:
+				continue
+			offset = extent.target_data * LP_SECTOR_SIZE
+			end = offset + extent.num_sectors * LP_SECTOR_SIZE
+			while offset < end:
+				length = min(PATTERN_SIZE, end - offset)
+				WriteFully(fd, offset, memoryview(pattern)[:length])
+				offset += length
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+	return metadata
@@ -8,15 +8,178 @@ Android logical partitions library.
 
 As of commit 1e7af8d97552fbf536116a5445f45b6251627b54 (master)
 AOSP link: https://github.com/aosp-mirror/platform_system_core/tree/master/fs_mgr/liblp
+
+The public namespace (see liblp.include) is resolved lazily: a submodule
+is only imported the first time one of its names is accessed, so that
+command-line tools only pay for what they use.
 """
 
-from pathlib import Path
+from importlib import import_module
+from os import getcwd
+from os.path import dirname
 
 __version__ = "1.0.2"
 
-module_path = Path(__file__).parent
-current_path = Path.cwd()
+# Captured at import time, turned into Path objects on first access.
+_module_dir = dirname(__file__)
+_current_dir = getcwd()
+
+# Module that provides each public name.
+_lazy_modules = {
+	"liblp.include.metadata_format": (
+		"LP_METADATA_GEOMETRY_MAGIC",
+		"LP_METADATA_GEOMETRY_SIZE",
+		"LP_METADATA_HEADER_MAGIC",
+		"LP_METADATA_MAJOR_VERSION",
+		"LP_METADATA_MINOR_VERSION_MIN",
+		"LP_METADATA_MINOR_VERSION_MAX",
+		"LP_METADATA_VERSION_FOR_UPDATED_ATTR",
+		"LP_METADATA_VERSION_FOR_EXPANDED_HEADER",
+		"LP_PARTITION_ATTR_NONE",
+		"LP_PARTITION_ATTR_READONLY",
+		"LP_PARTITION_ATTR_SLOT_SUFFIXED",
+		"LP_PARTITION_ATTR_UPDATED",
+		"LP_PARTITION_ATTR_DISABLED",
+		"LP_PARTITION_ATTRIBUTE_MASK_V0",
+		"LP_PARTITION_ATTRIBUTE_MASK_V1",
+		"LP_PARTITION_ATTRIBUTE_MASK",
+		"LP_METADATA_DEFAULT_PARTITION_NAME",
+		"LP_SECTOR_SIZE",
+		"LP_PARTITION_RESERVED_BYTES",
+		"LP_HEADER_FLAG_VIRTUAL_AB_DEVICE",
+		"LP_TARGET_TYPE_LINEAR",
+		"LP_TARGET_TYPE_ZERO",
+		"LP_GROUP_SLOT_SUFFIXED",
+		"LP_BLOCK_DEVICE_SLOT_SUFFIXED",
+		"LpMetadataGeometry",
+		"LpMetadataTableDescriptor",
+		"LpMetadataHeader",
+		"LpMetadataPartition",
+		"LpMetadataExtent",
+		"LpMetadataPartitionGroup",
+		"LpMetadataBlockDevice",
+		"LpMetadataHeaderV1_0",
+		"LpMetadataHeaderV1_2",
+	),
+	"liblp.liblp": (
+		"LpMetadata",
+	),
+	"liblp.reader": (
+		"ReadMetadata",
+		"GetPartitionName",
+		"GetPartitionGroupName",
+		"GetBlockDevicePartitionName",
+	),
+	"liblp.writer": (
+		"FlashPartitionTable",
+		"UpdatePartitionTable",
+		"MetadataSerializer",
+	),
+	"liblp.images": (
+		"IsEmptySuperImage",
+		"WriteToImageFile",
+		"ReadFromImageFile",
+		"ReadFromImageBlob",
+		"WriteSplitImageFiles",
+	),
+	"liblp.utility": (
+		"GetMetadataSuperBlockDevice",
+		"GetTotalSuperPartitionSize",
+		"GetBlockDevicePartitionNames",
+		"SlotNumberForSlotSuffix",
+		"SlotSuffixForSlotNumber",
+		"GetPartitionSlotSuffix",
+		"FindPartition",
+		"GetPartitionSize",
+	),
+	"liblp.partition_opener": (
+		"BlockDeviceInfo",
+		"IPartitionOpener",
+		"PartitionOpener",
+		"DeviceMapOpener",
+		"PooledPartitionOpener",
+	),
+	"liblp.zip_opener": (
+		"ZipMemberFile",
+		"ZipPartitionOpener",
+	),
+	"liblp.extent_map": (
+		"PhysicalSegment",
+		"PartitionExtentMap",
+		"GetPartitionExtents",
+		"GetPartitionExtentMap",
+		"InvalidateExtentMaps",
+		"TranslateLogicalRange",
+		"GetLinearRanges",
+	),
+	"liblp.builder": (
+		"kDefaultPartitionAlignment",
+		"kDefaultBlockSize",
+		"kDefaultGroup",
+		"ExtentType",
+		"Extent",
+		"LinearExtent",
+		"ZeroExtent",
+		"PartitionGroup",
+		"Partition",
+		"MetadataBuilder",
+	),
+	"liblp.defrag": (
+		"ExtentMove",
+		"DefragPlan",
+		"DefragStats",
+		"PlanDefragmentation",
+		"DefragmentSuperImage",
+	),
+	"liblp.chunk_store": (
+		"ChunkStore",
+		"IngestStats",
+		"IngestSuperImage",
+		"StreamPartition",
+		"StreamSuperImage",
+	),
+	"liblp.device_mapper": (
+		"DmTarget",
+		"DmTargetLinear",
+		"DmTargetZero",
+		"DmTable",
+		"CreateDmTable",
+		"CreateDmTables",
+	),
+	"liblp.tracing": (
+		"LatencyHistogram",
+		"TraceStats",
+		"Tracer",
+		"TracingPartitionOpener",
+	),
+	"liblp.compact_metadata": (
+		"CompactLpMetadata",
+		"CompactPartition",
+		"CompactExtent",
+		"CompactPartitionGroup",
+		"CompactBlockDevice",
+		"ReadCompactMetadata",
+	),
+}
+
+_lazy_names = {
+	name: module for module, names in _lazy_modules.items() for name in names
+}
+
+__all__ = ["module_path", "current_path", *_lazy_names]
+
+def __getattr__(name: str):
+	if name in ("module_path", "current_path"):
+		from pathlib import Path
+		value = Path(_module_dir if name == "module_path" else _current_dir)
+	elif name in _lazy_names:
+		value = getattr(import_module(_lazy_names[name]), name)
+	else:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+	# Cache it, __getattr__ is only called for missing attributes.
+	globals()[name] = value
+	return value
 
-from liblp.include.liblp import *
-from liblp.include.metadata_format import *
-from liblp.include.partition_opener import *
+def __dir__():
+	return sorted(set(globals()) | set(__all__))
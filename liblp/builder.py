@@ -0,0 +1,576 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Build or edit logical partition metadata.
+
+Free space is tracked per block device as sorted, coalesced intervals
+searched with bisect, instead of being recomputed from every extent on
+each allocation. Finding the interval an extent touches is O(log n) in
+the number of free intervals, inserting or removing one is an O(n) list
+shift, which stays cheap for the few thousand intervals of real devices.
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from ctypes import sizeof
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+from liblp.include.metadata_format import (
+	LP_METADATA_GEOMETRY_MAGIC,
+	LP_METADATA_HEADER_MAGIC,
+	LP_METADATA_MAJOR_VERSION,
+	LP_METADATA_MINOR_VERSION_MIN,
+	LP_METADATA_VERSION_FOR_EXPANDED_HEADER,
+	LP_METADATA_VERSION_FOR_UPDATED_ATTR,
+	LP_PARTITION_ATTR_UPDATED,
+	LP_PARTITION_ATTRIBUTE_MASK,
+	LP_SECTOR_SIZE,
+	LP_TARGET_TYPE_LINEAR,
+	LP_TARGET_TYPE_ZERO,
+	LpMetadataBlockDevice,
+	LpMetadataExtent,
+	LpMetadataGeometry,
+	LpMetadataHeader,
+	LpMetadataHeaderV1_0,
+	LpMetadataPartition,
+	LpMetadataPartitionGroup,
+)
+from liblp.liblp import LpMetadata
+from liblp.partition_opener import BlockDeviceInfo
+from liblp.reader import GetPartitionGroupName, GetPartitionName
+from liblp.utility import AlignTo, GetTotalMetadataSize
+
+# By default, partitions are aligned on a 1MiB boundary.
+kDefaultPartitionAlignment = 1024 * 1024
+kDefaultBlockSize = 4096
+
+# Name of the default group in a metadata.
+kDefaultGroup = "default"
+
+# Maximum length of a partition, group or block device name.
+kMaxNameLength = 36
+
+class ExtentType(Enum):
+	kZero = 0
+	kLinear = 1
+
+class Extent:
+	"""Abstraction around dm-targets that can be encoded into logical partition tables."""
+	def __init__(self, num_sectors: int):
+		self.num_sectors = num_sectors
+
+	def AddTo(self, metadata: LpMetadata):
+		raise NotImplementedError
+
+	def GetExtentType(self) -> ExtentType:
+		raise NotImplementedError
+
+class LinearExtent(Extent):
+	"""This corresponds to a dm-linear target."""
+	def __init__(self, num_sectors: int, device_index: int, physical_sector: int):
+		super().__init__(num_sectors)
+		self.device_index = device_index
+		self.physical_sector = physical_sector
+
+	def AddTo(self, metadata: LpMetadata):
+		metadata.extents.append(LpMetadataExtent(self.num_sectors, LP_TARGET_TYPE_LINEAR,
+		                                         self.physical_sector, self.device_index))
+
+	def GetExtentType(self) -> ExtentType:
+		return ExtentType.kLinear
+
+	def EndSector(self) -> int:
+		return self.physical_sector + self.num_sectors
+
+class ZeroExtent(Extent):
+	"""This corresponds to a dm-zero target."""
+	def AddTo(self, metadata: LpMetadata):
+		metadata.extents.append(LpMetadataExtent(self.num_sectors, LP_TARGET_TYPE_ZERO, 0, 0))
+
+	def GetExtentType(self) -> ExtentType:
+		return ExtentType.kZero
+
+class PartitionGroup:
+	def __init__(self, name: str, maximum_size: int, flags: int = 0):
+		self.name = name
+		# 0 means the group is unbounded.
+		self.maximum_size = maximum_size
+		self.flags = flags
+
+class Partition:
+	def __init__(self, name: str, group_name: str, attributes: int):
+		self.name = name
+		self.group_name = group_name
+		self.attributes = attributes
+		self.extents: List[Extent] = []
+		# Size in bytes, always the sum of the extents.
+		self.size = 0
+
+	def AddExtent(self, extent: Extent):
+		# Merge with the last extent if they are contiguous on the same device.
+		if self.extents and isinstance(extent, LinearExtent):
+			last = self.extents[-1]
+			if (isinstance(last, LinearExtent)
+			    and last.device_index == extent.device_index
+			    and last.EndSector() == extent.physical_sector):
+				last.num_sectors += extent.num_sectors
+				self.size += extent.num_sectors * LP_SECTOR_SIZE
+				return
+
+		self.extents.append(extent)
+		self.size += extent.num_sectors * LP_SECTOR_SIZE
+
+	def ShrinkTo(self, aligned_size: int) -> List[LinearExtent]:
+		"""
+		Drop sectors from the end of the partition until it is |aligned_size|
+		bytes long. Return the linear ranges that are no longer used.
+		"""
+		assert aligned_size <= self.size, "Cannot shrink a partition to a bigger size."
+
+		released = []
+		sectors_to_remove = (self.size - aligned_size) // LP_SECTOR_SIZE
+		while sectors_to_remove:
+			extent = self.extents[-1]
+			sectors = min(sectors_to_remove, extent.num_sectors)
+			if isinstance(extent, LinearExtent):
+				released.append(LinearExtent(sectors, extent.device_index,
+				                             extent.EndSector() - sectors))
+
+			extent.num_sectors -= sectors
+			if not extent.num_sectors:
+				self.extents.pop()
+			sectors_to_remove -= sectors
+
+		self.size = aligned_size
+		return released
+
+	def RemoveExtents(self) -> List[Extent]:
+		extents = self.extents
+		self.extents = []
+		self.size = 0
+		return extents
+
+class FreeSpaceMap:
+	"""
+	Free sectors of a block device, as sorted and coalesced [start, end)
+	intervals. |allocatable| holds the starts of the intervals that still
+	have room for an aligned block, so allocating never has to walk over
+	fragments left unusable by alignment.
+	"""
+	def __init__(self, alignment: int, alignment_offset: int, sectors_per_block: int):
+		# Alignment and offset are in bytes, like in LpMetadataBlockDevice.
+		self.alignment = alignment
+		self.alignment_offset = alignment_offset
+		self.sectors_per_block = sectors_per_block
+		self.starts: List[int] = []
+		self.ends: List[int] = []
+		self.allocatable: List[int] = []
+		self.free_sectors = 0
+
+	def AlignSector(self, sector: int) -> int:
+		# Alignment info is not assumed to be sector-aligned, so round up to
+		# the nearest sector.
+		aligned = AlignTo(sector * LP_SECTOR_SIZE, self.alignment, self.alignment_offset)
+		return AlignTo(aligned, LP_SECTOR_SIZE) // LP_SECTOR_SIZE
+
+	def AllocatableRange(self, start: int, end: int) -> Tuple[int, int]:
+		"""Return the first aligned sector of [start, end) and how many blocks fit after it."""
+		aligned = self.AlignSector(start)
+		if aligned >= end:
+			return aligned, 0
+		sectors = end - aligned
+		return aligned, sectors - sectors % self.sectors_per_block
+
+	def InsertInterval(self, index: int, start: int, end: int):
+		self.starts.insert(index, start)
+		self.ends.insert(index, end)
+		self.free_sectors += end - start
+		if self.AllocatableRange(start, end)[1]:
+			insort(self.allocatable, start)
+
+	def RemoveInterval(self, index: int) -> Tuple[int, int]:
+		start = self.starts.pop(index)
+		end = self.ends.pop(index)
+		self.free_sectors -= end - start
+		position = bisect_left(self.allocatable, start)
+		if position < len(self.allocatable) and self.allocatable[position] == start:
+			del self.allocatable[position]
+		return start, end
+
+	def Free(self, start: int, end: int):
+		"""Return [start, end) to the free space, merging it with its neighbours."""
+		index = bisect_left(self.starts, start)
+		assert index == 0 or self.ends[index - 1] <= start, "Freeing sectors that are already free."
+		assert index == len(self.starts) or end <= self.starts[index], \
+			"Freeing sectors that are already free."
+
+		if index < len(self.starts) and self.starts[index] == end:
+			end = self.RemoveInterval(index)[1]
+		if index and self.ends[index - 1] == start:
+			index -= 1
+			start = self.RemoveInterval(index)[0]
+		self.InsertInterval(index, start, end)
+
+	def Reserve(self, start: int, end: int):
+		"""Mark [start, end) as used, it must be entirely free."""
+		index = bisect_right(self.starts, start) - 1
+		assert index >= 0 and end <= self.ends[index], "Reserving sectors that are not free."
+
+		free_start, free_end = self.RemoveInterval(index)
+		if end < free_end:
+			self.InsertInterval(index, end, free_end)
+		if free_start < start:
+			self.InsertInterval(index, free_start, start)
+
+	def Exclude(self, start: int, end: int):
+		"""Mark whatever is free in [start, end) as used."""
+		index = max(bisect_right(self.starts, start) - 1, 0)
+		while index < len(self.starts) and self.starts[index] < end:
+			free_start, free_end = self.starts[index], self.ends[index]
+			if free_end <= start:
+				index += 1
+				continue
+			self.Reserve(max(free_start, start), min(free_end, end))
+			index = bisect_right(self.starts, start)
+
+	def IsFree(self, start: int, end: int) -> bool:
+		index = bisect_right(self.starts, start) - 1
+		return index >= 0 and end <= self.ends[index]
+
+	def FreeSectorsAt(self, sector: int) -> int:
+		"""Return how many whole blocks are free starting exactly at |sector|."""
+		index = bisect_right(self.starts, sector) - 1
+		if index < 0 or self.ends[index] <= sector:
+			return 0
+		sectors = self.ends[index] - sector
+		return sectors - sectors % self.sectors_per_block
+
+	def FirstAllocatable(self) -> Optional[Tuple[int, int]]:
+		"""Return the lowest aligned free range as (start, sectors), or None if full."""
+		if not self.allocatable:
+			return None
+		start = self.allocatable[0]
+		index = bisect_left(self.starts, start)
+		return self.AllocatableRange(start, self.ends[index])
+
+class MetadataBuilder:
+	"""
+	Counterpart of AOSP's MetadataBuilder. Use New() to start from empty
+	block devices or NewFromMetadata() to edit existing metadata, then
+	Export() the result.
+
+	Invalid requests (duplicate names, unknown groups, bad block device
+	parameters) raise; ResizePartition() returns False when there is not
+	enough space, leaving the partition untouched.
+	"""
+	def __init__(self):
+		self.geometry = LpMetadataGeometry()
+		self.header = LpMetadataHeader()
+		self.block_devices: List[LpMetadataBlockDevice] = []
+		self.partitions: Dict[str, Partition] = {}
+		self.groups: Dict[str, PartitionGroup] = {}
+		self.group_usage: Dict[str, int] = {}
+		self.free_space: List[FreeSpaceMap] = []
+
+	@classmethod
+	def New(cls, block_devices: List[BlockDeviceInfo], super_partition: str,
+	        metadata_max_size: int, metadata_slot_count: int) -> "MetadataBuilder":
+		builder = cls()
+		builder.Init(block_devices, super_partition, metadata_max_size, metadata_slot_count)
+		return builder
+
+	@classmethod
+	def NewFromMetadata(cls, metadata: LpMetadata) -> "MetadataBuilder":
+		builder = cls()
+		builder.InitFromMetadata(metadata)
+		return builder
+
+	def Init(self, block_devices: List[BlockDeviceInfo], super_partition: str,
+	         metadata_max_size: int, metadata_slot_count: int):
+		assert metadata_max_size >= sizeof(LpMetadataHeader), \
+			"Metadata max size must be at least the size of the header."
+		assert metadata_slot_count, "Invalid metadata slot count."
+		assert block_devices, "At least one block device is required."
+		assert block_devices[0].partition_name == super_partition, \
+			f"The first block device must be the super partition {super_partition}."
+
+		# Align the metadata size up to the nearest sector.
+		metadata_max_size = AlignTo(metadata_max_size, LP_SECTOR_SIZE)
+
+		logical_block_size = block_devices[0].logical_block_size or kDefaultBlockSize
+		assert logical_block_size % LP_SECTOR_SIZE == 0, \
+			"Logical block size must be a multiple of the sector size."
+
+		for info in block_devices:
+			assert info.alignment % LP_SECTOR_SIZE == 0, \
+				"Block device alignment must be a multiple of the sector size."
+			assert info.alignment_offset % LP_SECTOR_SIZE == 0, \
+				"Block device alignment offset must be a multiple of the sector size."
+			assert info.size % LP_SECTOR_SIZE == 0, \
+				"Block device size must be a multiple of the sector size."
+			assert len(info.partition_name) <= kMaxNameLength, \
+				f"Partition name {info.partition_name} exceeds maximum length."
+
+			self.block_devices.append(LpMetadataBlockDevice(
+				first_logical_sector=0,
+				alignment=info.alignment or kDefaultPartitionAlignment,
+				alignment_offset=info.alignment_offset,
+				size=info.size,
+				partition_name=info.partition_name.encode('ascii')))
+
+		# We reserve a geometry block plus space for each copy of the maximum
+		# size of a metadata blob, twice since everything has a backup copy.
+		# The alignment offset is ignored for the metadata region.
+		super_device = self.block_devices[0]
+		total_reserved = GetTotalMetadataSize(metadata_max_size, metadata_slot_count)
+		free_area_start = AlignTo(total_reserved, super_device.alignment)
+		assert free_area_start < super_device.size, \
+			"Not enough space to allocate metadata and partitions on the super device."
+		super_device.first_logical_sector = free_area_start // LP_SECTOR_SIZE
+
+		self.geometry.magic = LP_METADATA_GEOMETRY_MAGIC
+		self.geometry.struct_size = sizeof(LpMetadataGeometry)
+		self.geometry.metadata_max_size = metadata_max_size
+		self.geometry.metadata_slot_count = metadata_slot_count
+		self.geometry.logical_block_size = logical_block_size
+
+		self.header.magic = LP_METADATA_HEADER_MAGIC
+		self.header.major_version = LP_METADATA_MAJOR_VERSION
+		self.header.minor_version = LP_METADATA_MINOR_VERSION_MIN
+		self.header.header_size = sizeof(LpMetadataHeaderV1_0)
+
+		self.InitFreeSpace()
+		self.AddGroup(kDefaultGroup, 0)
+
+	def InitFromMetadata(self, metadata: LpMetadata):
+		self.geometry = LpMetadataGeometry.from_buffer_copy(metadata.geometry)
+		self.header = LpMetadataHeader.from_buffer_copy(metadata.header)
+		self.block_devices = [LpMetadataBlockDevice.from_buffer_copy(block_device)
+		                      for block_device in metadata.block_devices]
+
+		for group in metadata.groups:
+			name = GetPartitionGroupName(group)
+			self.groups[name] = PartitionGroup(name, group.maximum_size, group.flags)
+			self.group_usage[name] = 0
+		group_names = list(self.groups)
+
+		self.InitFreeSpace()
+
+		for partition in metadata.partitions:
+			builder_partition = Partition(GetPartitionName(partition),
+			                              group_names[partition.group_index],
+			                              partition.attributes)
+			for i in range(partition.first_extent_index,
+			               partition.first_extent_index + partition.num_extents):
+				extent = metadata.extents[i]
+				if extent.target_type == LP_TARGET_TYPE_LINEAR:
+					builder_partition.AddExtent(LinearExtent(extent.num_sectors, extent.target_source,
+					                                         extent.target_data))
+				elif extent.target_type == LP_TARGET_TYPE_ZERO:
+					builder_partition.AddExtent(ZeroExtent(extent.num_sectors))
+				else:
+					raise Exception("Unknown extent type.")
+
+			assert builder_partition.name not in self.partitions, \
+				f"Duplicate partition {builder_partition.name}."
+			self.partitions[builder_partition.name] = builder_partition
+			self.group_usage[builder_partition.group_name] += builder_partition.size
+
+		self.ReserveUsedExtents()
+
+	def InitFreeSpace(self):
+		sectors_per_block = self.geometry.logical_block_size // LP_SECTOR_SIZE
+		self.free_space = []
+		for block_device in self.block_devices:
+			free_space = FreeSpaceMap(block_device.alignment, block_device.alignment_offset,
+			                       sectors_per_block)
+			end = block_device.size // LP_SECTOR_SIZE
+			if block_device.first_logical_sector < end:
+				free_space.InsertInterval(0, block_device.first_logical_sector, end)
+			self.free_space.append(free_space)
+
+	def ReserveUsedExtents(self):
+		# Build the used ranges of every device once and carve them out in
+		# order, extents shared by several partitions are merged.
+		used: List[List[Tuple[int, int]]] = [[] for _ in self.block_devices]
+		for partition in self.partitions.values():
+			for extent in partition.extents:
+				if isinstance(extent, LinearExtent):
+					used[extent.device_index].append((extent.physical_sector, extent.EndSector()))
+
+		for device_index, ranges in enumerate(used):
+			free_space = self.free_space[device_index]
+			first_sector = self.block_devices[device_index].first_logical_sector
+			end_sector = self.block_devices[device_index].size // LP_SECTOR_SIZE
+
+			free_space.starts, free_space.ends, free_space.allocatable = [], [], []
+			free_space.free_sectors = 0
+
+			position = first_sector
+			for start, end in sorted(ranges):
+				assert start >= first_sector and end <= end_sector, \
+					"Extent is outside of its block device."
+				if start > position:
+					free_space.InsertInterval(len(free_space.starts), position, start)
+				position = max(position, end)
+			if position < end_sector:
+				free_space.InsertInterval(len(free_space.starts), position, end_sector)
+
+	def AddGroup(self, group_name: str, maximum_size: int):
+		assert group_name not in self.groups, f"Group {group_name} already exists."
+		assert len(group_name) <= kMaxNameLength, f"Group name {group_name} exceeds maximum length."
+		self.groups[group_name] = PartitionGroup(group_name, maximum_size)
+		self.group_usage[group_name] = 0
+
+	def FindGroup(self, group_name: str) -> Optional[PartitionGroup]:
+		return self.groups.get(group_name)
+
+	def ListPartitionsInGroup(self, group_name: str) -> List[Partition]:
+		return [partition for partition in self.partitions.values()
+		        if partition.group_name == group_name]
+
+	def AddPartition(self, name: str, attributes: int,
+	                 group_name: str = kDefaultGroup) -> Partition:
+		assert name not in self.partitions, f"Attempting to create duplication partition with name: {name}"
+		assert group_name in self.groups, f"Could not find partition group: {group_name}"
+		assert len(name) <= kMaxNameLength, f"Partition name {name} exceeds maximum length."
+		assert not attributes & ~LP_PARTITION_ATTRIBUTE_MASK, \
+			f"Partition {name} has invalid attributes."
+
+		partition = Partition(name, group_name, attributes)
+		self.partitions[name] = partition
+		return partition
+
+	def FindPartition(self, name: str) -> Optional[Partition]:
+		return self.partitions.get(name)
+
+	def RemovePartition(self, name: str):
+		partition = self.partitions.pop(name, None)
+		if partition is None:
+			return
+
+		self.group_usage[partition.group_name] -= partition.size
+		for extent in partition.RemoveExtents():
+			if isinstance(extent, LinearExtent):
+				self.free_space[extent.device_index].Free(extent.physical_sector, extent.EndSector())
+
+	def ResizePartition(self, partition: Partition, requested_size: int) -> bool:
+		"""
+		Grow or shrink |partition| to |requested_size| bytes, rounded up to the
+		logical block size. Return False if the group would exceed its maximum
+		size or the block devices don't have enough free space.
+		"""
+		aligned_size = AlignTo(requested_size, self.geometry.logical_block_size)
+		old_size = partition.size
+
+		if aligned_size > old_size:
+			group = self.groups[partition.group_name]
+			new_group_size = self.group_usage[group.name] - old_size + aligned_size
+			if group.maximum_size and new_group_size > group.maximum_size:
+				return False
+			if not self.GrowPartition(partition, (aligned_size - old_size) // LP_SECTOR_SIZE):
+				return False
+		elif aligned_size < old_size:
+			for extent in partition.ShrinkTo(aligned_size):
+				self.free_space[extent.device_index].Free(extent.physical_sector, extent.EndSector())
+
+		self.group_usage[partition.group_name] += aligned_size - old_size
+		return True
+
+	def GrowPartition(self, partition: Partition, sectors_needed: int) -> bool:
+		new_extents: List[LinearExtent] = []
+
+		def Allocate(device_index: int, start: int, sectors: int):
+			self.free_space[device_index].Reserve(start, start + sectors)
+			new_extents.append(LinearExtent(sectors, device_index, start))
+
+		# Extend the last extent in place first, this keeps partitions that
+		# are resized repeatedly contiguous.
+		last = partition.extents[-1] if partition.extents else None
+		if isinstance(last, LinearExtent):
+			free_space = self.free_space[last.device_index]
+			sectors = min(sectors_needed, free_space.FreeSectorsAt(last.EndSector()))
+			if sectors:
+				Allocate(last.device_index, last.EndSector(), sectors)
+				sectors_needed -= sectors
+
+		# Then take the lowest aligned free ranges, super device first.
+		for device_index, free_space in enumerate(self.free_space):
+			while sectors_needed:
+				region = free_space.FirstAllocatable()
+				if not region:
+					break
+				start, length = region
+				sectors = min(sectors_needed, length)
+				Allocate(device_index, start, sectors)
+				sectors_needed -= sectors
+
+		if sectors_needed:
+			# Not enough space, give back what was taken.
+			for extent in new_extents:
+				self.free_space[extent.device_index].Free(extent.physical_sector, extent.EndSector())
+			return False
+
+		for extent in new_extents:
+			partition.AddExtent(extent)
+		return True
+
+	def AllocatableSpace(self) -> int:
+		return sum(block_device.size - block_device.first_logical_sector * LP_SECTOR_SIZE
+		           for block_device in self.block_devices)
+
+	def UsedSpace(self) -> int:
+		return sum(partition.size for partition in self.partitions.values())
+
+	def FreeSpaceSize(self) -> int:
+		return sum(free_space.free_sectors for free_space in self.free_space) * LP_SECTOR_SIZE
+
+	def Export(self) -> LpMetadata:
+		metadata = LpMetadata(LpMetadataGeometry.from_buffer_copy(self.geometry),
+		                      LpMetadataHeader.from_buffer_copy(self.header))
+		header = metadata.header
+
+		group_indices = {}
+		for group in self.groups.values():
+			group_indices[group.name] = len(metadata.groups)
+			metadata.groups.append(LpMetadataPartitionGroup(
+				group.name.encode('ascii'), group.flags, group.maximum_size))
+
+		for partition in self.partitions.values():
+			if partition.attributes & LP_PARTITION_ATTR_UPDATED:
+				header.minor_version = max(header.minor_version, LP_METADATA_VERSION_FOR_UPDATED_ATTR)
+
+			metadata.partitions.append(LpMetadataPartition(
+				partition.name.encode('ascii'), partition.attributes, len(metadata.extents),
+				len(partition.extents), group_indices[partition.group_name]))
+			for extent in partition.extents:
+				extent.AddTo(metadata)
+
+		for block_device in self.block_devices:
+			metadata.block_devices.append(LpMetadataBlockDevice.from_buffer_copy(block_device))
+
+		# Header flags are only understood by the expanded header.
+		if header.flags:
+			header.minor_version = max(header.minor_version, LP_METADATA_VERSION_FOR_EXPANDED_HEADER)
+		if header.minor_version >= LP_METADATA_VERSION_FOR_EXPANDED_HEADER:
+			header.header_size = sizeof(LpMetadataHeader)
+
+		offset = 0
+		for descriptor, entries, entry_type in (
+				(header.partitions, metadata.partitions, LpMetadataPartition),
+				(header.extents, metadata.extents, LpMetadataExtent),
+				(header.groups, metadata.groups, LpMetadataPartitionGroup),
+				(header.block_devices, metadata.block_devices, LpMetadataBlockDevice)):
+			descriptor.offset = offset
+			descriptor.num_entries = len(entries)
+			descriptor.entry_size = sizeof(entry_type)
+			offset += len(entries) * sizeof(entry_type)
+		header.tables_size = offset
+
+		if header.header_size + header.tables_size > self.geometry.metadata_max_size:
+			raise Exception("Partition metadata is too large for the metadata area.")
+
+		return metadata
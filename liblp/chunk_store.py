@@ -0,0 +1,320 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Content-addressed, deduplicating storage of super images.
+
+Partitions are split into fixed-size chunks of their logical content,
+stored once per SHA-256 and compressed with a stdlib codec. The bytes
+not covered by any extent (reserved area, geometry, metadata and free
+space) are chunked as physical regions, so that the exact image can be
+rebuilt. A JSON manifest per image lists the chunks of each partition
+and region, and where the partition extents go in the image.
+
+Store layout:
+	chunks/<first 2 hex digits>/<sha256>   codec byte + payload
+	manifests/<name>.json
+"""
+
+from bz2 import compress as bz2_compress, decompress as bz2_decompress
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+import json
+from lzma import compress as lzma_compress, decompress as lzma_decompress
+import os
+from pathlib import Path
+from threading import get_ident
+from typing import Callable, Dict, Iterator, List, NamedTuple, Tuple
+from zlib import compress as zlib_compress, decompress as zlib_decompress
+
+from liblp.extent_map import GetPartitionExtentMap
+from liblp.include.metadata_format import LP_TARGET_TYPE_LINEAR
+from liblp.partition_opener import Pread
+from liblp.reader import GetPartitionName, ReadMetadata
+
+MANIFEST_VERSION = 1
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+CODEC_LZMA = 3
+
+CODECS: Dict[str, Tuple[int, Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+	"none": (CODEC_NONE, bytes, bytes),
+	"zlib": (CODEC_ZLIB, zlib_compress, zlib_decompress),
+	"bz2": (CODEC_BZ2, bz2_compress, bz2_decompress),
+	"lzma": (CODEC_LZMA, lzma_compress, lzma_decompress),
+}
+
+DECOMPRESSORS = {codec_id: decompress for codec_id, _, decompress in CODECS.values()}
+
+class IngestStats:
+	def __init__(self):
+		self.chunks = 0
+		self.new_chunks = 0
+		self.bytes_in = 0
+		self.bytes_stored = 0
+
+	def __str__(self):
+		return (f"{self.chunks} chunks ({self.bytes_in} bytes), {self.new_chunks} new, "
+		        f"{self.bytes_stored} bytes stored")
+
+class ChunkStore:
+	def __init__(self, path: Path, codec: str = "zlib"):
+		assert codec in CODECS, f"Unknown codec {codec}"
+
+		self.path = Path(path)
+		self.codec = codec
+		self.chunks_dir = self.path / "chunks"
+		self.manifests_dir = self.path / "manifests"
+
+	def GetChunkPath(self, digest: str) -> Path:
+		return self.chunks_dir / digest[:2] / digest
+
+	def HasChunk(self, digest: str) -> bool:
+		return self.GetChunkPath(digest).exists()
+
+	def PutChunk(self, data: bytes) -> Tuple[str, int]:
+		"""
+		Store |data| if it isn't already. Return its digest and the number of
+		bytes written to the store, 0 if it was already there.
+		"""
+		digest = sha256(data).hexdigest()
+		path = self.GetChunkPath(digest)
+		if path.exists():
+			return digest, 0
+
+		codec_id, compress, _ = CODECS[self.codec]
+		payload = compress(data)
+		if len(payload) >= len(data):
+			codec_id, payload = CODEC_NONE, data
+
+		# Write then link, so that a chunk is either complete or missing. Only
+		# one of concurrent writers of the same chunk creates the link, the
+		# others report it as already stored.
+		path.parent.mkdir(parents=True, exist_ok=True)
+		temp_path = path.with_name(f"{digest}.{os.getpid()}.{get_ident()}.tmp")
+		with temp_path.open('wb') as fd:
+			fd.write(bytes([codec_id]))
+			fd.write(payload)
+		try:
+			os.link(temp_path, path)
+		except FileExistsError:
+			return digest, 0
+		finally:
+			temp_path.unlink()
+
+		return digest, 1 + len(payload)
+
+	def GetChunk(self, digest: str) -> bytes:
+		blob = self.GetChunkPath(digest).read_bytes()
+		assert blob, f"Chunk {digest} is empty"
+		assert blob[0] in DECOMPRESSORS, f"Chunk {digest} has an unknown codec {blob[0]}"
+
+		data = DECOMPRESSORS[blob[0]](blob[1:])
+		if sha256(data).hexdigest() != digest:
+			raise Exception(f"Chunk {digest} is corrupted")
+		return data
+
+	def GetManifestPath(self, name: str) -> Path:
+		if not name or "/" in name or os.sep in name or "\0" in name:
+			raise Exception(f"Invalid image name {name!r}")
+		return self.manifests_dir / f"{name}.json"
+
+	def ReadManifest(self, name: str) -> dict:
+		with self.GetManifestPath(name).open() as fd:
+			manifest = json.load(fd)
+
+		assert manifest["version"] == MANIFEST_VERSION, \
+			f"Unsupported manifest version {manifest['version']}"
+		return manifest
+
+	def WriteManifest(self, name: str, manifest: dict):
+		self.manifests_dir.mkdir(parents=True, exist_ok=True)
+		path = self.GetManifestPath(name)
+		temp_path = path.with_name(f"{path.name}.tmp")
+		with temp_path.open('w') as fd:
+			json.dump(manifest, fd, indent=1)
+		os.replace(temp_path, path)
+
+	def ListManifests(self) -> List[str]:
+		return sorted(path.stem for path in self.manifests_dir.glob("*.json"))
+
+class ImageRange(NamedTuple):
+	# Physical byte offset of the range in the super image.
+	offset: int
+	length: int
+
+def GetUncoveredRanges(size: int, covered: List[ImageRange]) -> List[ImageRange]:
+	"""Return the ranges of [0, |size|) not in |covered|."""
+	ranges = []
+	position = 0
+	for offset, length in sorted(covered):
+		if offset > position:
+			ranges.append(ImageRange(position, offset - position))
+		position = max(position, offset + length)
+	if position < size:
+		ranges.append(ImageRange(position, size - position))
+	return ranges
+
+def IngestSuperImage(store: ChunkStore, image: Path, name: str = None, slot: int = 0,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE, jobs: int = None) -> IngestStats:
+	"""
+	Add |image|, a non-sparse super image, to |store| as manifest |name|
+	(the file name without extension by default). Chunks are read, hashed
+	and compressed by |jobs| threads.
+	"""
+	if not name:
+		name = Path(image).stem
+	# Check the name before storing any chunk.
+	store.GetManifestPath(name)
+
+	metadata = ReadMetadata(image, slot)
+	assert len(metadata.block_devices) == 1, "Split super devices are not supported."
+
+	fd = os.open(image, os.O_RDONLY)
+	try:
+		size = os.fstat(fd).st_size
+
+		# (manifest entry, size, reader of (offset, length)) of everything to store.
+		sources: List[Tuple[dict, int, Callable[[int, int], bytes]]] = []
+		partitions = []
+		covered = []
+		for partition in metadata.partitions:
+			extent_map = GetPartitionExtentMap(metadata, partition)
+			extents = []
+			for segment in extent_map.Translate(0, extent_map.size):
+				if segment.target_type == LP_TARGET_TYPE_LINEAR:
+					extents.append([segment.logical_offset, segment.offset, segment.length])
+					covered.append(ImageRange(segment.offset, segment.length))
+
+			def ReadPartition(offset: int, length: int, extent_map=extent_map) -> bytes:
+				return b"".join(
+					Pread(fd, segment.length, segment.offset)
+					if segment.target_type == LP_TARGET_TYPE_LINEAR else bytes(segment.length)
+					for segment in extent_map.Translate(offset, length))
+
+			entry = {
+				"name": GetPartitionName(partition),
+				"size": extent_map.size,
+				"extents": extents,
+			}
+			partitions.append(entry)
+			sources.append((entry, extent_map.size, ReadPartition))
+
+		regions = []
+		for offset, length in GetUncoveredRanges(size, covered):
+			def ReadRegion(region_offset: int, length: int, offset=offset) -> bytes:
+				return Pread(fd, length, offset + region_offset)
+
+			entry = {"offset": offset, "size": length}
+			regions.append(entry)
+			sources.append((entry, length, ReadRegion))
+
+		stats = IngestStats()
+
+		def IngestChunk(chunk: Tuple[Callable[[int, int], bytes], int, int]) -> Tuple[str, int, int]:
+			read, offset, length = chunk
+			data = read(offset, length)
+			assert len(data) == length, "Unexpected end of file while reading the image"
+			digest, stored = store.PutChunk(data)
+			return digest, length, stored
+
+		with ThreadPoolExecutor(jobs) as executor:
+			for entry, length, read in sources:
+				entry["chunks"] = []
+				chunks = [(read, offset, min(chunk_size, length - offset))
+				          for offset in range(0, length, chunk_size)]
+				for digest, chunk_length, stored in executor.map(IngestChunk, chunks):
+					entry["chunks"].append(digest)
+					stats.chunks += 1
+					stats.bytes_in += chunk_length
+					if stored:
+						stats.new_chunks += 1
+						stats.bytes_stored += stored
+	finally:
+		os.close(fd)
+
+	store.WriteManifest(name, {
+		"version": MANIFEST_VERSION,
+		"chunk_size": chunk_size,
+		"size": size,
+		"slot": slot,
+		"partitions": partitions,
+		"regions": regions,
+	})
+
+	return stats
+
+def StreamChunks(store: ChunkStore, digests: List[str], skip: int = 0,
+                 length: int = None) -> Iterator[bytes]:
+	"""
+	Yield |length| bytes (everything by default) of the concatenation of
+	|digests|, starting |skip| bytes in.
+	"""
+	for digest in digests:
+		if length is not None and length <= 0:
+			return
+		data = store.GetChunk(digest)
+		if skip >= len(data):
+			skip -= len(data)
+			continue
+		if skip:
+			data = data[skip:]
+			skip = 0
+		if length is not None:
+			data = data[:length]
+			length -= len(data)
+		yield data
+
+def StreamPartition(store: ChunkStore, name: str, partition_name: str) -> Iterator[bytes]:
+	"""Yield the content of partition |partition_name| of manifest |name|."""
+	manifest = store.ReadManifest(name)
+	for partition in manifest["partitions"]:
+		if partition["name"] == partition_name:
+			return StreamChunks(store, partition["chunks"])
+
+	raise Exception(f"Partition {partition_name} not found in {name}")
+
+def StreamPieces(store: ChunkStore, pieces: List[Tuple[int, int, List[str], int]],
+                 chunk_size: int, size: int) -> Iterator[bytes]:
+	position = 0
+	for offset, length, chunks, logical_offset in pieces:
+		# Extents shared by several partitions are only written once.
+		if offset < position:
+			skipped = min(position - offset, length)
+			offset += skipped
+			length -= skipped
+			logical_offset += skipped
+		if not length:
+			continue
+		assert offset == position, f"Hole in the image layout at {position}"
+
+		first = logical_offset // chunk_size
+		last = (logical_offset + length + chunk_size - 1) // chunk_size
+		yield from StreamChunks(store, chunks[first:last], logical_offset - first * chunk_size, length)
+		position += length
+
+	assert position == size, "Image layout doesn't cover the whole image"
+
+def StreamSuperImage(store: ChunkStore, name: str) -> Iterator[bytes]:
+	"""
+	Yield the super image of manifest |name| in order, so that it can be
+	written to a pipe.
+	"""
+	manifest = store.ReadManifest(name)
+
+	# (physical offset, length, chunks, offset in the chunks)
+	pieces = []
+	for region in manifest["regions"]:
+		pieces.append((region["offset"], region["size"], region["chunks"], 0))
+	for partition in manifest["partitions"]:
+		for logical_offset, offset, length in partition["extents"]:
+			pieces.append((offset, length, partition["chunks"], logical_offset))
+	pieces.sort(key=lambda piece: piece[0])
+
+	return StreamPieces(store, pieces, manifest["chunk_size"], manifest["size"])
@@ -0,0 +1,275 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Lightweight metadata representation.
+
+Table entries are decoded in bulk with precompiled struct.Struct objects
+into __slots__ records, and names are decoded once at parse time. This is
+considerably cheaper in both memory and parse time than keeping one ctypes
+Structure (and its private buffer) per entry, and is meant for tools that
+scan many images. Use ToLpMetadata() to get back the ctypes form, e.g. for
+writing.
+"""
+
+from ctypes import sizeof
+from io import BufferedIOBase
+from struct import Struct
+from typing import List
+
+from liblp.include.metadata_format import (
+	LP_BLOCK_DEVICE_SLOT_SUFFIXED,
+	LP_GROUP_SLOT_SUFFIXED,
+	LP_METADATA_VERSION_FOR_UPDATED_ATTR,
+	LP_PARTITION_ATTR_SLOT_SUFFIXED,
+	LP_PARTITION_ATTRIBUTE_MASK_V0,
+	LP_PARTITION_ATTRIBUTE_MASK_V1,
+	LP_SECTOR_SIZE,
+	LP_TARGET_TYPE_LINEAR,
+	LpMetadataBlockDevice,
+	LpMetadataExtent,
+	LpMetadataGeometry,
+	LpMetadataHeader,
+	LpMetadataPartition,
+	LpMetadataPartitionGroup,
+	LpMetadataTableDescriptor,
+)
+from liblp.liblp import LpMetadata
+from liblp.partition_opener import IPartitionOpener, PartitionOpener
+from liblp.reader import ReadLogicalPartitionGeometry, ReadMetadataCopies, ReadMetadataTables
+from liblp.utility import (
+	GetTotalMetadataSize,
+	SlotSuffixForSlotNumber,
+)
+
+# Little-endian layouts of the table entries, see metadata_format.py.
+PARTITION_STRUCT = Struct("<36sIIII")
+EXTENT_STRUCT = Struct("<QIQI")
+GROUP_STRUCT = Struct("<36sIQ")
+BLOCK_DEVICE_STRUCT = Struct("<QIIQ36sI")
+
+assert PARTITION_STRUCT.size == sizeof(LpMetadataPartition)
+assert EXTENT_STRUCT.size == sizeof(LpMetadataExtent)
+assert GROUP_STRUCT.size == sizeof(LpMetadataPartitionGroup)
+assert BLOCK_DEVICE_STRUCT.size == sizeof(LpMetadataBlockDevice)
+
+def NameFromFixedBytes(name: bytes) -> str:
+	return name.split(b'\x00', 1)[0].decode('ascii')
+
+class CompactPartition:
+	__slots__ = ("name", "attributes", "first_extent_index", "num_extents", "group_index")
+
+	def __init__(self, name: str, attributes: int, first_extent_index: int,
+	             num_extents: int, group_index: int):
+		self.name = name
+		self.attributes = attributes
+		self.first_extent_index = first_extent_index
+		self.num_extents = num_extents
+		self.group_index = group_index
+
+	@classmethod
+	def FromStruct(cls, partition: LpMetadataPartition) -> "CompactPartition":
+		return cls(NameFromFixedBytes(partition.name), partition.attributes,
+		           partition.first_extent_index, partition.num_extents, partition.group_index)
+
+	def ToStruct(self) -> LpMetadataPartition:
+		return LpMetadataPartition(self.name.encode('ascii'), self.attributes,
+		                           self.first_extent_index, self.num_extents, self.group_index)
+
+class CompactExtent:
+	__slots__ = ("num_sectors", "target_type", "target_data", "target_source")
+
+	def __init__(self, num_sectors: int, target_type: int, target_data: int,
+	             target_source: int):
+		self.num_sectors = num_sectors
+		self.target_type = target_type
+		self.target_data = target_data
+		self.target_source = target_source
+
+	@classmethod
+	def FromStruct(cls, extent: LpMetadataExtent) -> "CompactExtent":
+		return cls(extent.num_sectors, extent.target_type, extent.target_data,
+		           extent.target_source)
+
+	def ToStruct(self) -> LpMetadataExtent:
+		return LpMetadataExtent(self.num_sectors, self.target_type, self.target_data,
+		                        self.target_source)
+
+class CompactPartitionGroup:
+	__slots__ = ("name", "flags", "maximum_size")
+
+	def __init__(self, name: str, flags: int, maximum_size: int):
+		self.name = name
+		self.flags = flags
+		self.maximum_size = maximum_size
+
+	@classmethod
+	def FromStruct(cls, group: LpMetadataPartitionGroup) -> "CompactPartitionGroup":
+		return cls(NameFromFixedBytes(group.name), group.flags, group.maximum_size)
+
+	def ToStruct(self) -> LpMetadataPartitionGroup:
+		return LpMetadataPartitionGroup(self.name.encode('ascii'), self.flags,
+		                                self.maximum_size)
+
+class CompactBlockDevice:
+	__slots__ = ("first_logical_sector", "alignment", "alignment_offset", "size",
+	             "partition_name", "flags")
+
+	def __init__(self, first_logical_sector: int, alignment: int, alignment_offset: int,
+	             size: int, partition_name: str, flags: int):
+		self.first_logical_sector = first_logical_sector
+		self.alignment = alignment
+		self.alignment_offset = alignment_offset
+		self.size = size
+		self.partition_name = partition_name
+		self.flags = flags
+
+	@classmethod
+	def FromStruct(cls, block_device: LpMetadataBlockDevice) -> "CompactBlockDevice":
+		return cls(block_device.first_logical_sector, block_device.alignment,
+		           block_device.alignment_offset, block_device.size,
+		           NameFromFixedBytes(block_device.partition_name), block_device.flags)
+
+	def ToStruct(self) -> LpMetadataBlockDevice:
+		return LpMetadataBlockDevice(self.first_logical_sector, self.alignment,
+		                             self.alignment_offset, self.size,
+		                             self.partition_name.encode('ascii'), self.flags)
+
+class CompactLpMetadata:
+	"""
+	Counterpart of LpMetadata using compact records. Geometry and header are
+	kept as ctypes structures since there is only one of each.
+	"""
+	__slots__ = ("geometry", "header", "partitions", "extents", "groups", "block_devices",
+	             "__weakref__")
+
+	def __init__(self,
+	             geometry: LpMetadataGeometry = None,
+	             header: LpMetadataHeader = None,
+	             partitions: List[CompactPartition] = None,
+	             extents: List[CompactExtent] = None,
+	             groups: List[CompactPartitionGroup] = None,
+	             block_devices: List[CompactBlockDevice] = None):
+		self.geometry = geometry
+		self.header = header
+		self.partitions = partitions or []
+		self.extents = extents or []
+		self.groups = groups or []
+		self.block_devices = block_devices or []
+
+	@classmethod
+	def FromLpMetadata(cls, metadata: LpMetadata) -> "CompactLpMetadata":
+		return cls(metadata.geometry, metadata.header,
+		           [CompactPartition.FromStruct(p) for p in metadata.partitions],
+		           [CompactExtent.FromStruct(e) for e in metadata.extents],
+		           [CompactPartitionGroup.FromStruct(g) for g in metadata.groups],
+		           [CompactBlockDevice.FromStruct(b) for b in metadata.block_devices])
+
+	def ToLpMetadata(self) -> LpMetadata:
+		return LpMetadata(self.geometry, self.header,
+		                  [p.ToStruct() for p in self.partitions],
+		                  [e.ToStruct() for e in self.extents],
+		                  [g.ToStruct() for g in self.groups],
+		                  [b.ToStruct() for b in self.block_devices])
+
+def GetTable(buffer: bytes, descriptor: LpMetadataTableDescriptor, table_struct: Struct):
+	assert descriptor.entry_size == table_struct.size, \
+		"Logical partition metadata has invalid table entry size."
+	end = descriptor.offset + descriptor.num_entries * descriptor.entry_size
+	return table_struct.iter_unpack(memoryview(buffer)[descriptor.offset:end])
+
+def ParseCompactTables(geometry: LpMetadataGeometry, header: LpMetadataHeader,
+                       buffer: bytes) -> CompactLpMetadata:
+	"""
+	Build a CompactLpMetadata from the raw table contents, performing the same
+	validation as ParseMetadata().
+	"""
+	metadata = CompactLpMetadata(geometry, header)
+
+	valid_attributes = LP_PARTITION_ATTRIBUTE_MASK_V0
+	if header.minor_version >= LP_METADATA_VERSION_FOR_UPDATED_ATTR:
+		valid_attributes |= LP_PARTITION_ATTRIBUTE_MASK_V1
+
+	num_extents = header.extents.num_entries
+	num_groups = header.groups.num_entries
+	num_block_devices = header.block_devices.num_entries
+
+	for name, attributes, first_extent_index, extents, group_index \
+			in GetTable(buffer, header.partitions, PARTITION_STRUCT):
+		if attributes & ~valid_attributes:
+			raise Exception("Logical partition has invalid attribute set.")
+		assert first_extent_index + extents <= num_extents, \
+			"Logical partition has invalid extent list."
+		assert group_index < num_groups, \
+			"Logical partition has invalid group index."
+
+		metadata.partitions.append(CompactPartition(
+			NameFromFixedBytes(name), attributes, first_extent_index, extents, group_index))
+
+	for num_sectors, target_type, target_data, target_source \
+			in GetTable(buffer, header.extents, EXTENT_STRUCT):
+		if target_type == LP_TARGET_TYPE_LINEAR and target_source >= num_block_devices:
+			raise Exception("Logical partition extent has invalid block device.")
+
+		metadata.extents.append(CompactExtent(num_sectors, target_type, target_data,
+		                                      target_source))
+
+	for name, flags, maximum_size in GetTable(buffer, header.groups, GROUP_STRUCT):
+		metadata.groups.append(CompactPartitionGroup(
+			NameFromFixedBytes(name), flags, maximum_size))
+
+	for first_logical_sector, alignment, alignment_offset, size, partition_name, flags \
+			in GetTable(buffer, header.block_devices, BLOCK_DEVICE_STRUCT):
+		metadata.block_devices.append(CompactBlockDevice(
+			first_logical_sector, alignment, alignment_offset, size,
+			NameFromFixedBytes(partition_name), flags))
+
+	assert metadata.block_devices, "Metadata does not specify a super device."
+	super_device = metadata.block_devices[0]
+
+	# Check that the metadata area and logical partition areas don't overlap.
+	metadata_region = GetTotalMetadataSize(geometry.metadata_max_size, geometry.metadata_slot_count)
+	if metadata_region > super_device.first_logical_sector * LP_SECTOR_SIZE:
+		raise Exception("Logical partition metadata overlaps with logical partition contents.")
+
+	return metadata
+
+def ParseCompactMetadata(geometry: LpMetadataGeometry, fd: BufferedIOBase) -> CompactLpMetadata:
+	header, buffer = ReadMetadataTables(geometry, fd)
+	return ParseCompactTables(geometry, header, buffer)
+
+def AdjustCompactMetadataForSlot(metadata: CompactLpMetadata, slot_number: int):
+	slot_suffix = SlotSuffixForSlotNumber(slot_number)
+
+	for partition in metadata.partitions:
+		if partition.attributes & LP_PARTITION_ATTR_SLOT_SUFFIXED:
+			partition.name += slot_suffix
+			partition.attributes &= ~LP_PARTITION_ATTR_SLOT_SUFFIXED
+
+	for block_device in metadata.block_devices:
+		if block_device.flags & LP_BLOCK_DEVICE_SLOT_SUFFIXED:
+			block_device.partition_name += slot_suffix
+			block_device.flags &= ~LP_BLOCK_DEVICE_SLOT_SUFFIXED
+
+	for group in metadata.groups:
+		if group.flags & LP_GROUP_SLOT_SUFFIXED:
+			group.name += slot_suffix
+			group.flags &= ~LP_GROUP_SLOT_SUFFIXED
+
+def ReadCompactMetadata(super_partition: str, slot_number: int,
+                        opener: IPartitionOpener = None) -> CompactLpMetadata:
+	"""
+	Same as ReadMetadata(), but returns a CompactLpMetadata.
+	"""
+	if not opener:
+		opener = PartitionOpener()
+
+	with opener.Open(super_partition, 'rb') as fd:
+		geometry = ReadLogicalPartitionGeometry(fd)
+		metadata = ReadMetadataCopies(fd, geometry, slot_number, ParseCompactMetadata)
+
+	AdjustCompactMetadataForSlot(metadata, slot_number)
+
+	return metadata
@@ -0,0 +1,234 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Extent defragmentation of super images.
+
+The planner makes fragmented partitions contiguous with the least amount
+of data moved: a partition is either laid out around one of its existing
+extents, so that extent stays in place, or moved as a whole to a free
+range, whichever moves fewer sectors.
+
+Data is only ever copied into space that no metadata slot references, so
+the old layout stays intact until the new metadata is written. A crash at
+any point leaves either the old or the new metadata valid, with its data.
+Space released by a pass can be used by the next one.
+"""
+
+import os
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from liblp.builder import LinearExtent, MetadataBuilder, Partition
+from liblp.extent_map import GetLinearRanges
+from liblp.include.metadata_format import LP_SECTOR_SIZE
+from liblp.liblp import LpMetadata
+from liblp.partition_opener import IPartitionOpener, PartitionOpener
+from liblp.reader import ReadLogicalPartitionGeometry, ReadUnadjustedMetadata
+from liblp.utility import CopyFileRange
+from liblp.writer import SerializeMetadata, UpdateMetadataSlots, ValidateAndSerializeMetadata
+
+class ExtentMove(NamedTuple):
+	partition_name: str
+	device_index: int
+	source_sector: int
+	target_sector: int
+	num_sectors: int
+
+class DefragPlan:
+	def __init__(self, metadata: LpMetadata, moves: List[ExtentMove],
+	             extents_before: int, extents_after: int):
+		# Metadata to write once all the moves are done.
+		self.metadata = metadata
+		self.moves = moves
+		self.extents_before = extents_before
+		self.extents_after = extents_after
+
+	@property
+	def bytes_moved(self) -> int:
+		return sum(move.num_sectors for move in self.moves) * LP_SECTOR_SIZE
+
+class DefragStats:
+	def __init__(self):
+		self.passes = 0
+		self.extents_before = 0
+		self.extents_after = 0
+		self.bytes_moved = 0
+
+	def __str__(self):
+		return (f"{self.extents_before} extents before, {self.extents_after} after, "
+		        f"{self.bytes_moved} bytes moved in {self.passes} passes")
+
+def FindPlacement(builder: MetadataBuilder, partition: Partition) -> Optional[Tuple[int, int, int]]:
+	"""
+	Return the cheapest contiguous placement of |partition| as
+	(sectors to move, device index, first sector), or None if there is none.
+	"""
+	num_sectors = partition.size // LP_SECTOR_SIZE
+	best = None
+
+	# Keep one extent in place and lay out the others around it.
+	logical_sector = 0
+	for anchor in partition.extents:
+		base = anchor.physical_sector - logical_sector
+		logical_sector += anchor.num_sectors
+
+		device_index = anchor.device_index
+		free_space = builder.free_space[device_index]
+		block_device = builder.block_devices[device_index]
+		if (base < block_device.first_logical_sector
+		    or base + num_sectors > block_device.size // LP_SECTOR_SIZE):
+			continue
+
+		cost = 0
+		feasible = True
+		position = base
+		for extent in partition.extents:
+			target = position
+			position += extent.num_sectors
+			if extent.device_index == device_index and extent.physical_sector == target:
+				continue
+			cost += extent.num_sectors
+			if not free_space.IsFree(target, target + extent.num_sectors):
+				feasible = False
+				break
+
+		if feasible and (not best or cost < best[0]):
+			best = (cost, device_index, base)
+
+	if best and best[0] < num_sectors:
+		return best
+
+	# Move everything to the smallest aligned free range that fits.
+	best_fit = None
+	for device_index, free_space in enumerate(builder.free_space):
+		for start, end in zip(free_space.starts, free_space.ends):
+			aligned, length = free_space.AllocatableRange(start, end)
+			if length >= num_sectors and (not best_fit or length < best_fit[0]):
+				best_fit = (length, device_index, aligned)
+
+	if best_fit:
+		return num_sectors, best_fit[1], best_fit[2]
+	return best
+
+def PlanDefragmentation(metadata: LpMetadata, max_extents: int = 1,
+                        pinned: Iterable[Tuple[int, int, int]] = ()) -> DefragPlan:
+	"""
+	Plan one defragmentation pass of the partitions of |metadata| having more
+	than |max_extents| extents. |pinned| are (device index, start, end)
+	sector ranges that must not be written, e.g. the extents of other
+	metadata slots. The current extents of |metadata| are never written
+	either.
+	"""
+	builder = MetadataBuilder.NewFromMetadata(metadata)
+	for device_index, start, end in pinned:
+		builder.free_space[device_index].Exclude(start, end)
+
+	candidates = [
+		partition for partition in builder.partitions.values()
+		if len(partition.extents) > max_extents
+		and all(isinstance(extent, LinearExtent) for extent in partition.extents)
+	]
+	# The most fragmented partitions go first.
+	candidates.sort(key=lambda partition: len(partition.extents), reverse=True)
+
+	moves = []
+	for partition in candidates:
+		placement = FindPlacement(builder, partition)
+		if not placement:
+			continue
+
+		_, device_index, base = placement
+		free_space = builder.free_space[device_index]
+
+		position = base
+		for extent in partition.extents:
+			target = position
+			position += extent.num_sectors
+			if extent.device_index == device_index and extent.physical_sector == target:
+				continue
+			free_space.Reserve(target, target + extent.num_sectors)
+			moves.append(ExtentMove(partition.name, extent.device_index, extent.physical_sector,
+			                        target, extent.num_sectors))
+
+		# The old extents are not released: they are still in use until the
+		# new metadata is written.
+		partition.RemoveExtents()
+		partition.AddExtent(LinearExtent(position - base, device_index, base))
+
+	new_metadata = builder.Export()
+	return DefragPlan(new_metadata, moves, len(metadata.extents), len(new_metadata.extents))
+
+def CoalesceMoves(moves: List[ExtentMove]) -> List[Tuple[int, int, int]]:
+	"""
+	Turn |moves| into (source sector, target sector, sectors) copies sorted by
+	source, merging moves that are contiguous on both sides.
+	"""
+	copies = []
+	for move in sorted(moves, key=lambda move: move.source_sector):
+		if copies:
+			source, target, num_sectors = copies[-1]
+			if (source + num_sectors == move.source_sector
+			    and target + num_sectors == move.target_sector):
+				copies[-1] = (source, target, num_sectors + move.num_sectors)
+				continue
+		copies.append((move.source_sector, move.target_sector, move.num_sectors))
+	return copies
+
+def DefragmentSuperImage(super_partition: str, slot_number: int = 0, max_extents: int = 1,
+                         max_passes: int = 8, opener: IPartitionOpener = None) -> DefragStats:
+	"""
+	Defragment the partitions of |slot_number| in place. Metadata slots that
+	are identical to |slot_number| are updated with it, the extents of the
+	other ones are left untouched.
+	"""
+	if not opener:
+		opener = PartitionOpener()
+
+	stats = DefragStats()
+
+	while stats.passes < max_passes:
+		with opener.Open(super_partition, 'r+b') as fd:
+			geometry = ReadLogicalPartitionGeometry(fd)
+			assert slot_number < geometry.metadata_slot_count, \
+				f"Invalid logical partition metadata slot number {slot_number}"
+
+			slots = [ReadUnadjustedMetadata(fd, geometry, slot) for slot in range(geometry.metadata_slot_count)]
+			metadata = slots[slot_number]
+			assert len(metadata.block_devices) == 1, \
+				"In-place defragmentation only supports single device super images."
+
+			blob = SerializeMetadata(metadata)
+			target_slots = []
+			pinned = []
+			for slot, slot_metadata in enumerate(slots):
+				if SerializeMetadata(slot_metadata) == blob:
+					target_slots.append(slot)
+				else:
+					pinned.extend(GetLinearRanges(slot_metadata))
+
+			plan = PlanDefragmentation(metadata, max_extents, pinned)
+			if not stats.passes:
+				stats.extents_before = plan.extents_before
+			stats.extents_after = plan.extents_before
+			if not plan.moves:
+				break
+
+			# Fail before moving anything if the new metadata can't be written.
+			ValidateAndSerializeMetadata(opener, plan.metadata, "", super_partition)
+
+			# Copy the data first and make it durable, only then switch the
+			# metadata over to it.
+			for source, target, num_sectors in CoalesceMoves(plan.moves):
+				CopyFileRange(fd.fileno(), fd.fileno(), num_sectors * LP_SECTOR_SIZE,
+				              source * LP_SECTOR_SIZE, target * LP_SECTOR_SIZE)
+			os.fsync(fd.fileno())
+
+		UpdateMetadataSlots(super_partition, plan.metadata, target_slots, opener)
+
+		stats.passes += 1
+		stats.extents_after = plan.extents_after
+		stats.bytes_moved += plan.bytes_moved
+
+	return stats
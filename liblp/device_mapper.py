@@ -0,0 +1,124 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+device-mapper tables of logical partitions, as built by fs_mgr_dm_linear
+and serialized by libdm, so that partitions can be mapped in place with
+dmsetup instead of being extracted.
+"""
+
+from typing import Dict, List
+
+from liblp.include.metadata_format import (
+	LP_PARTITION_ATTR_READONLY,
+	LP_TARGET_TYPE_LINEAR,
+	LP_TARGET_TYPE_ZERO,
+	LpMetadataPartition,
+)
+from liblp.liblp import LpMetadata
+from liblp.partition_opener import IPartitionOpener, PartitionOpener
+from liblp.reader import GetBlockDevicePartitionName, GetPartitionName
+
+class DmTarget:
+	"""A device-mapper target, covering |length| sectors from |start|."""
+	def __init__(self, start: int, length: int):
+		self.start = start
+		self.length = length
+
+	def name(self) -> str:
+		raise NotImplementedError
+
+	def GetParameterString(self) -> str:
+		raise NotImplementedError
+
+	def Serialize(self) -> str:
+		return f"{self.start} {self.length} {self.name()} {self.GetParameterString()}".rstrip()
+
+class DmTargetZero(DmTarget):
+	def name(self) -> str:
+		return "zero"
+
+	def GetParameterString(self) -> str:
+		return ""
+
+class DmTargetLinear(DmTarget):
+	def __init__(self, start: int, length: int, block_device: str, physical_sector: int):
+		super().__init__(start, length)
+		self.block_device = block_device
+		self.physical_sector = physical_sector
+
+	def name(self) -> str:
+		return "linear"
+
+	def GetParameterString(self) -> str:
+		return f"{self.block_device} {self.physical_sector}"
+
+class DmTable:
+	def __init__(self):
+		self.targets: List[DmTarget] = []
+		self.readonly = False
+
+	def AddTarget(self, target: DmTarget):
+		assert target.start == self.num_sectors(), "Targets must be contiguous"
+		self.targets.append(target)
+
+	def num_sectors(self) -> int:
+		if not self.targets:
+			return 0
+		return self.targets[-1].start + self.targets[-1].length
+
+	def IsValid(self) -> bool:
+		return bool(self.targets)
+
+	def Serialize(self) -> str:
+		"""Return the table in the format dmsetup reads, one target per line."""
+		return "".join(f"{target.Serialize()}\n" for target in self.targets)
+
+def CreateDmTable(metadata: LpMetadata, partition: LpMetadataPartition,
+                  opener: IPartitionOpener = None, super_device: str = "") -> DmTable:
+	"""
+	Build the table of |partition|. Block devices are referenced by
+	|opener|.GetDeviceString() of their partition name, except the first
+	one if |super_device| is given.
+	"""
+	if not opener:
+		opener = PartitionOpener()
+
+	table = DmTable()
+	table.readonly = bool(partition.attributes & LP_PARTITION_ATTR_READONLY)
+	logical_sector = 0
+	for i in range(partition.num_extents):
+		extent = metadata.extents[partition.first_extent_index + i]
+		if extent.target_type == LP_TARGET_TYPE_ZERO:
+			table.AddTarget(DmTargetZero(logical_sector, extent.num_sectors))
+		elif extent.target_type == LP_TARGET_TYPE_LINEAR:
+			assert extent.target_source < len(metadata.block_devices), \
+				f"Extent references unknown block device {extent.target_source}"
+			if extent.target_source == 0 and super_device:
+				block_device = super_device
+			else:
+				block_device = opener.GetDeviceString(
+					GetBlockDevicePartitionName(metadata.block_devices[extent.target_source]))
+			table.AddTarget(DmTargetLinear(logical_sector, extent.num_sectors,
+			                               block_device, extent.target_data))
+		else:
+			raise Exception(f"Unknown target type in metadata: {extent.target_type}")
+		logical_sector += extent.num_sectors
+
+	return table
+
+def CreateDmTables(metadata: LpMetadata, opener: IPartitionOpener = None,
+                   super_device: str = "") -> Dict[str, DmTable]:
+	"""
+	Build the tables of all the partitions of |metadata| that have extents,
+	by partition name.
+	"""
+	tables = {}
+	for partition in metadata.partitions:
+		if not partition.num_extents:
+			continue
+		tables[GetPartitionName(partition)] = CreateDmTable(metadata, partition,
+		                                                    opener, super_device)
+	return tables
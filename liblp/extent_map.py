@@ -0,0 +1,128 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from bisect import bisect_right
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+from weakref import WeakKeyDictionary
+
+from liblp.include.metadata_format import (
+	LP_SECTOR_SIZE,
+	LP_TARGET_TYPE_LINEAR,
+	LP_TARGET_TYPE_ZERO,
+	LpMetadataExtent,
+	LpMetadataPartition,
+)
+from liblp.liblp import LpMetadata
+
+class PhysicalSegment(NamedTuple):
+	"""A contiguous run of a logical partition, mapped onto its backing storage."""
+	# Target type of the extent this segment comes from (see LP_TARGET_TYPE_*).
+	target_type: int
+	# Index into the block devices table. Always 0 for ZERO segments.
+	block_device_index: int
+	# Physical byte offset on the block device. Always 0 for ZERO segments.
+	offset: int
+	# Length of the segment, in bytes.
+	length: int
+	# Logical byte offset inside the partition where this segment starts.
+	logical_offset: int
+
+class PartitionExtentMap:
+	"""
+	Logical to physical translation table of a single partition.
+
+	Extents are stored alongside the logical byte offset they start at, so
+	a lookup is a bisection over the cumulative sizes instead of a walk of
+	the extent list.
+	"""
+	def __init__(self, extents: List[LpMetadataExtent]):
+		self.extents = extents
+
+		# Logical byte offset of the start of each extent.
+		self.starts: List[int] = []
+
+		# Total size of the partition, in bytes.
+		self.size = 0
+
+		for extent in extents:
+			self.starts.append(self.size)
+			self.size += extent.num_sectors * LP_SECTOR_SIZE
+
+	def FindExtentIndex(self, offset: int) -> int:
+		"""Return the index of the extent containing the logical byte |offset|."""
+		assert 0 <= offset < self.size, \
+			f"Logical offset {offset} is outside of the partition (size {self.size})"
+		return bisect_right(self.starts, offset) - 1
+
+	def Translate(self, offset: int, length: int) -> List[PhysicalSegment]:
+		"""
+		Translate the logical range [offset, offset + length) into the list of
+		physical segments backing it, in logical order.
+		"""
+		assert offset >= 0 and length >= 0, "Invalid logical range"
+		assert offset + length <= self.size, \
+			f"Logical range {offset}+{length} exceeds partition size {self.size}"
+
+		segments: List[PhysicalSegment] = []
+		if not length:
+			return segments
+
+		index = self.FindExtentIndex(offset)
+		while length:
+			extent = self.extents[index]
+			extent_offset = offset - self.starts[index]
+			chunk = min(length, extent.num_sectors * LP_SECTOR_SIZE - extent_offset)
+
+			if extent.target_type == LP_TARGET_TYPE_LINEAR:
+				segments.append(PhysicalSegment(
+					LP_TARGET_TYPE_LINEAR, extent.target_source,
+					extent.target_data * LP_SECTOR_SIZE + extent_offset, chunk, offset))
+			elif extent.target_type == LP_TARGET_TYPE_ZERO:
+				segments.append(PhysicalSegment(LP_TARGET_TYPE_ZERO, 0, 0, chunk, offset))
+			else:
+				raise Exception(f"Unsupported target type in extent: {extent.target_type}")
+
+			offset += chunk
+			length -= chunk
+			index += 1
+
+		return segments
+
+_extent_maps: "WeakKeyDictionary[LpMetadata, Dict[Tuple[int, int], PartitionExtentMap]]" = \
+	WeakKeyDictionary()
+
+def GetPartitionExtents(metadata: LpMetadata,
+                        partition: LpMetadataPartition) -> List[LpMetadataExtent]:
+	first = partition.first_extent_index
+	return metadata.extents[first:first + partition.num_extents]
+
+def GetPartitionExtentMap(metadata: LpMetadata,
+                          partition: LpMetadataPartition) -> PartitionExtentMap:
+	"""
+	Return the extent map of |partition|. Maps are cached per metadata object,
+	call InvalidateExtentMaps() after modifying its extent table.
+	"""
+	cache = _extent_maps.setdefault(metadata, {})
+	key = (partition.first_extent_index, partition.num_extents)
+	extent_map = cache.get(key)
+	if extent_map is None:
+		extent_map = PartitionExtentMap(GetPartitionExtents(metadata, partition))
+		cache[key] = extent_map
+
+	return extent_map
+
+def InvalidateExtentMaps(metadata: LpMetadata):
+	_extent_maps.pop(metadata, None)
+
+def TranslateLogicalRange(metadata: LpMetadata, partition: LpMetadataPartition,
+                          offset: int, length: int) -> List[PhysicalSegment]:
+	return GetPartitionExtentMap(metadata, partition).Translate(offset, length)
+
+def GetLinearRanges(metadata: LpMetadata) -> Iterator[Tuple[int, int, int]]:
+	"""Yield (block device index, start, end) sector ranges of every linear extent."""
+	for extent in metadata.extents:
+		if extent.target_type == LP_TARGET_TYPE_LINEAR:
+			yield extent.target_source, extent.target_data, extent.target_data + extent.num_sectors
@@ -0,0 +1,151 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Detection of the filesystem and AVB footer of partition images, to find
+the part of a partition that is actually in use.
+"""
+
+from struct import Struct
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+# All the supported filesystems keep their superblock at this offset.
+SUPERBLOCK_OFFSET = 1024
+SUPERBLOCK_SIZE = 1024
+
+EXT4_SUPER_MAGIC = 0xEF53
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+# Offsets in the superblock of s_blocks_count_lo, s_log_block_size, s_magic,
+# s_feature_incompat and s_blocks_count_hi.
+EXT4_BLOCKS_COUNT_LO_OFFSET = 0x4
+EXT4_LOG_BLOCK_SIZE_OFFSET = 0x18
+EXT4_MAGIC_OFFSET = 0x38
+EXT4_FEATURE_INCOMPAT_OFFSET = 0x60
+EXT4_BLOCKS_COUNT_HI_OFFSET = 0x150
+
+EROFS_SUPER_MAGIC_V1 = 0xE0F5E1E2
+# magic, checksum, feature_compat, blkszbits, sb_extslots, root_nid, inos,
+# build_time, build_time_nsec, blocks
+EROFS_SUPER_BLOCK_STRUCT = Struct("<IIIBBHQQII")
+
+F2FS_SUPER_MAGIC = 0xF2F52010
+# magic, major_ver, minor_ver, log_sectorsize, log_sectors_per_block,
+# log_blocksize, log_blocks_per_seg, segs_per_sec, secs_per_zone,
+# checksum_offset, block_count
+F2FS_SUPER_BLOCK_STRUCT = Struct("<IHHIIIIIIIQ")
+
+AVB_FOOTER_MAGIC = b"AVBf"
+AVB_FOOTER_SIZE = 64
+# magic, version_major, version_minor, original_image_size, vbmeta_offset,
+# vbmeta_size
+AVB_FOOTER_STRUCT = Struct(">4sIIQQQ28x")
+
+class AvbFooter(NamedTuple):
+	original_image_size: int
+	vbmeta_offset: int
+	vbmeta_size: int
+
+def GetExt4Size(superblock: bytes) -> Optional[int]:
+	def Field(offset: int, size: int = 4) -> int:
+		return int.from_bytes(superblock[offset:offset + size], "little")
+
+	if Field(EXT4_MAGIC_OFFSET, 2) != EXT4_SUPER_MAGIC:
+		return None
+
+	blocks_count = Field(EXT4_BLOCKS_COUNT_LO_OFFSET)
+	if Field(EXT4_FEATURE_INCOMPAT_OFFSET) & EXT4_FEATURE_INCOMPAT_64BIT:
+		blocks_count |= Field(EXT4_BLOCKS_COUNT_HI_OFFSET) << 32
+
+	return blocks_count * (1024 << Field(EXT4_LOG_BLOCK_SIZE_OFFSET))
+
+def GetErofsSize(superblock: bytes) -> Optional[int]:
+	(magic, _, _, blkszbits, _, _, _, _, _,
+	 blocks) = EROFS_SUPER_BLOCK_STRUCT.unpack_from(superblock)
+	if magic != EROFS_SUPER_MAGIC_V1:
+		return None
+
+	return blocks << blkszbits
+
+def GetF2fsSize(superblock: bytes) -> Optional[int]:
+	(magic, _, _, _, _, log_blocksize, _, _, _, _,
+	 block_count) = F2FS_SUPER_BLOCK_STRUCT.unpack_from(superblock)
+	if magic != F2FS_SUPER_MAGIC:
+		return None
+
+	return block_count << log_blocksize
+
+FILESYSTEMS: List[Tuple[str, Callable[[bytes], Optional[int]]]] = [
+	("ext4", GetExt4Size),
+	("erofs", GetErofsSize),
+	("f2fs", GetF2fsSize),
+]
+
+def GetFilesystemSize(superblock: bytes) -> Optional[Tuple[str, int]]:
+	"""
+	Return the type and size in bytes of the filesystem whose superblock is
+	|superblock|, the SUPERBLOCK_SIZE bytes at SUPERBLOCK_OFFSET, or None if
+	it is not recognized.
+	"""
+	if len(superblock) < SUPERBLOCK_SIZE:
+		return None
+
+	for name, get_size in FILESYSTEMS:
+		size = get_size(superblock)
+		if size is not None:
+			return name, size
+
+	return None
+
+def ParseAvbFooter(data: bytes) -> Optional[AvbFooter]:
+	"""Parse |data|, the last AVB_FOOTER_SIZE bytes of a partition."""
+	if len(data) < AVB_FOOTER_SIZE:
+		return None
+
+	(magic, _, _, original_image_size, vbmeta_offset,
+	 vbmeta_size) = AVB_FOOTER_STRUCT.unpack_from(data)
+	if magic != AVB_FOOTER_MAGIC:
+		return None
+
+	return AvbFooter(original_image_size, vbmeta_offset, vbmeta_size)
+
+def GetUsedRanges(read: Callable[[int, int], bytes], size: int,
+                  block_size: int = 4096) -> List[Tuple[int, int]]:
+	"""
+	Return the (offset, length) ranges of a |size| bytes partition that hold
+	data: the filesystem, then everything up to the end of the vbmeta blob
+	and the last block if there is an AVB footer. Hash trees and FEC data
+	sit between the filesystem and vbmeta, so they are included.
+	|read|(offset, length) reads the partition.
+
+	The whole partition is returned if neither is found, or if they don't
+	fit in it.
+	"""
+	if size < SUPERBLOCK_OFFSET + SUPERBLOCK_SIZE:
+		return [(0, size)]
+
+	used = 0
+	filesystem = GetFilesystemSize(read(SUPERBLOCK_OFFSET, SUPERBLOCK_SIZE))
+	if filesystem:
+		used = filesystem[1]
+
+	footer = ParseAvbFooter(read(size - AVB_FOOTER_SIZE, AVB_FOOTER_SIZE))
+	if footer:
+		used = max(used, footer.original_image_size, footer.vbmeta_offset + footer.vbmeta_size)
+
+	if not filesystem and not footer:
+		return [(0, size)]
+
+	used += -used % block_size
+	if not used or used > size:
+		return [(0, size)]
+
+	if not footer:
+		return [(0, used)]
+
+	footer_start = size - block_size
+	if used >= footer_start:
+		return [(0, size)]
+
+	return [(0, used), (footer_start, block_size)]
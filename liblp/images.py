@@ -4,29 +4,418 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from io import SEEK_SET, BufferedIOBase
+import os
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple
 
+from liblp.extent_map import GetPartitionExtentMap
+from liblp.include.metadata_format import (
+	LP_METADATA_GEOMETRY_MAGIC,
+	LP_METADATA_GEOMETRY_SIZE,
+	LP_PARTITION_RESERVED_BYTES,
+	LP_SECTOR_SIZE,
+	LP_TARGET_TYPE_LINEAR,
+	LP_TARGET_TYPE_ZERO,
+	LpMetadataPartition,
+)
 from liblp.liblp import LpMetadata
+from liblp.reader import (
+	GetBlockDevicePartitionName,
+	GetPartitionName,
+	MemoryReader,
+	ParseGeometry,
+	ParseMetadata,
+	ReadMetadataFromFd,
+)
+from liblp.sparse import (
+	CHUNK_TYPE_FILL,
+	CHUNK_TYPE_RAW,
+	SPARSE_HEADER_STRUCT,
+	BlockClassifier,
+	CreateClassifierPool,
+	IsSparseImage,
+	SparseImageReader,
+	SparseImageWriter,
+)
+from liblp.utility import COPY_BUFFER_SIZE, CopyFileRange, WriteFully
+from liblp.writer import SerializeGeometry, SerializeMetadata
+
+def IsEmptySuperImageHeader(data: bytes) -> bool:
+	"""
+	Return whether |data|, the first bytes of an image, start with a geometry
+	block. Flashable images start with reserved bytes instead.
+	"""
+	return (len(data) >= LP_METADATA_GEOMETRY_SIZE
+	        and int.from_bytes(data[:4], "little") == LP_METADATA_GEOMETRY_MAGIC)
 
 def IsEmptySuperImage(file: str) -> bool:
-	raise NotImplementedError
+	with open(file, 'rb') as fd:
+		return IsEmptySuperImageHeader(fd.read(LP_METADATA_GEOMETRY_SIZE))
+
+def ReadFromEmptyImageFd(fd: BufferedIOBase) -> LpMetadata:
+	fd.seek(0, SEEK_SET)
+	geometry = ParseGeometry(fd.read(LP_METADATA_GEOMETRY_SIZE))
+	return ParseMetadata(geometry, fd)
 
 def ReadFromImageFile(image_file: str) -> LpMetadata:
-	raise NotImplementedError
+	"""
+	Read metadata from an image file, which can either be an empty image
+	(super_empty.img), a flashable super image or a sparse super image.
+	For the latter two, slot 0 is read.
+	"""
+	with open(image_file, 'rb') as fd:
+		data = fd.read(LP_METADATA_GEOMETRY_SIZE)
+
+		if IsEmptySuperImageHeader(data):
+			return ReadFromEmptyImageFd(fd)
+
+		if IsSparseImage(data):
+			sparse_fd = SparseImageReader(fd)
+			if IsEmptySuperImageHeader(sparse_fd.read(LP_METADATA_GEOMETRY_SIZE)):
+				return ReadFromEmptyImageFd(sparse_fd)
+			return ReadMetadataFromFd(sparse_fd, 0)
+
+		return ReadMetadataFromFd(fd, 0)
 
 def ReadFromImageBlob(data: bytes) -> LpMetadata:
 	"""
 	Note: signature should have been
 	ReadFromImageBlob(data: bytes, bytes: int) -> LpMetadata
 	but we don't need size in Python
+
+	|data| can be any object supporting the buffer protocol (bytes,
+	bytearray, memoryview, mmap); it is parsed in place without copying it.
+	"""
+	reader = MemoryReader(data)
+	assert len(reader.buffer) >= LP_METADATA_GEOMETRY_SIZE, \
+		"Image blob is too small to contain metadata."
+
+	return ReadFromEmptyImageFd(reader)
+
+# Minimum amount of partition data for sparse images to be classified by a
+# pool of processes.
+PARALLEL_CLASSIFY_THRESHOLD = 64 * 1024 * 1024
+
+class ImageSegment(NamedTuple):
+	"""A run of data placed in a block device image."""
+	# Byte offset of the segment in the block device image.
+	offset: int
+	# Length of the segment, in bytes.
+	length: int
+	# Contents of the segment, when it is held in memory...
+	data: bytes = None
+	# ...or the file holding it and the offset of the data in it...
+	path: str = None
+	file_offset: int = 0
+	# ...or a 4 bytes pattern repeated for the whole segment.
+	fill: bytes = None
+
+class ImagePiece(NamedTuple):
+	"""A run of data of a partition image, at a logical offset."""
+	logical_offset: int
+	length: int
+	file_offset: int = 0
+	fill: bytes = None
+
+def GetImagePieces(image: str):
 	"""
-	raise NotImplementedError
+	Return the size of the contents of |image| and where they are stored.
+	Sparse images are supported, DONT_CARE chunks produce no pieces.
+	"""
+	with open(image, 'rb') as fd:
+		if not IsSparseImage(fd.read(SPARSE_HEADER_STRUCT.size)):
+			size = os.fstat(fd.fileno()).st_size
+			return size, [ImagePiece(0, size)] if size else []
+
+		sparse = SparseImageReader(fd)
+
+	pieces = []
+	for start, chunk_type, length, payload in \
+			zip(sparse.starts, sparse.types, sparse.lengths, sparse.payloads):
+		if chunk_type == CHUNK_TYPE_RAW:
+			pieces.append(ImagePiece(start, length, file_offset=payload))
+		elif chunk_type == CHUNK_TYPE_FILL:
+			pieces.append(ImagePiece(start, length, fill=payload))
+
+	return sparse.size, pieces
+
+class ImageBuilder:
+	"""
+	Lay out the contents of the block device images of a super partition:
+	reserved bytes, geometry and metadata copies, and the partition images at
+	their extents. Nothing is read at this stage, segments reference the
+	partition images so that they can be streamed when exporting.
+	"""
+	def __init__(self, metadata: LpMetadata, block_size: int,
+	             images: Dict[str, str], sparsify: bool, jobs: int = None):
+		self.metadata = metadata
+		self.block_size = block_size
+		self.images = images or {}
+		self.sparsify = sparsify
+		# Number of processes classifying blocks of sparse images.
+		self.jobs = jobs or os.cpu_count() or 1
+
+		geometry = metadata.geometry
+		assert block_size and block_size % LP_SECTOR_SIZE == 0, \
+			"Block size must be a multiple of 512"
+		assert geometry.metadata_max_size % block_size == 0, \
+			"Metadata max size must be a multiple of the block size"
+		assert LP_METADATA_GEOMETRY_SIZE % block_size == 0, \
+			"Geometry size must be a multiple of the block size"
+		for block_device in metadata.block_devices:
+			assert block_device.size % block_size == 0, \
+				"Device size must be a multiple of the block size"
+
+		# Segments of each block device image, sorted by offset once built.
+		self.device_segments: List[List[ImageSegment]] = \
+			[[] for _ in metadata.block_devices]
+
+	def Build(self):
+		geometry = self.metadata.geometry
+
+		geometry_blob = SerializeGeometry(geometry)
+		metadata_blob = SerializeMetadata(self.metadata)
+		assert len(metadata_blob) <= geometry.metadata_max_size, \
+			"Logical partition metadata is too large."
+		metadata_blob = metadata_blob.ljust(geometry.metadata_max_size, b'\x00')
+
+		# Only the first block device holds metadata. Reserved bytes, then two
+		# copies of geometry, then two copies of each metadata slot.
+		segments = self.device_segments[0]
+		segments.append(ImageSegment(0, LP_PARTITION_RESERVED_BYTES, fill=bytes(4)))
+		offset = LP_PARTITION_RESERVED_BYTES
+		for _ in range(2):
+			segments.append(ImageSegment(offset, len(geometry_blob), data=geometry_blob))
+			offset += len(geometry_blob)
+		for _ in range(geometry.metadata_slot_count * 2):
+			segments.append(ImageSegment(offset, len(metadata_blob), data=metadata_blob))
+			offset += len(metadata_blob)
+
+		self.CheckExtentOrdering()
+
+		for partition in self.metadata.partitions:
+			name = GetPartitionName(partition)
+			if name in self.images:
+				self.AddPartitionImage(partition, self.images[name])
+
+		for segments in self.device_segments:
+			segments.sort(key=lambda segment: segment.offset)
+
+	def CheckExtentOrdering(self):
+		ranges = [[] for _ in self.metadata.block_devices]
+		for extent in self.metadata.extents:
+			assert (extent.num_sectors * LP_SECTOR_SIZE) % self.block_size == 0, \
+				"Extents must be aligned to the block size."
+			if extent.target_type != LP_TARGET_TYPE_LINEAR:
+				continue
+			assert (extent.target_data * LP_SECTOR_SIZE) % self.block_size == 0, \
+				"Extents must be aligned to the block size."
+			ranges[extent.target_source].append(
+				(extent.target_data, extent.target_data + extent.num_sectors))
+
+		for device_ranges in ranges:
+			device_ranges.sort()
+			for (_, end), (start, _) in zip(device_ranges, device_ranges[1:]):
+				assert end <= start, "Extents must not overlap."
+
+	def AddPartitionImage(self, partition: LpMetadataPartition, image: str):
+		name = GetPartitionName(partition)
+		extent_map = GetPartitionExtentMap(self.metadata, partition)
+
+		size, pieces = GetImagePieces(image)
+		if size > extent_map.size:
+			raise Exception(f"Image for partition '{name}' is greater than its size "
+			                f"({size}, expected {extent_map.size})")
+
+		for piece in pieces:
+			for segment in extent_map.Translate(piece.logical_offset, piece.length):
+				if segment.target_type == LP_TARGET_TYPE_ZERO:
+					raise Exception(f"Image for partition '{name}' has data in a zero extent")
+
+				self.device_segments[segment.block_device_index].append(ImageSegment(
+					segment.offset, segment.length, path=image,
+					file_offset=piece.file_offset + segment.logical_offset - piece.logical_offset,
+					fill=piece.fill))
+
+	def ExportRaw(self, device_index: int, file: str,
+	              progress: Callable[[int, int], None] = None):
+		"""
+		Write the image of a block device. Data of the partition images is
+		copied by the kernel where possible, and space not covered by any
+		segment is left as a hole.
+
+		|progress| is called with the number of bytes of the image done so
+		far and its size after every segment.
+		"""
+		size = self.metadata.block_devices[device_index].size
+		input_fds: Dict[str, int] = {}
+
+		out_fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+		try:
+			os.ftruncate(out_fd, size)
+
+			for segment in self.device_segments[device_index]:
+				if segment.fill is not None:
+					if segment.fill != bytes(4):
+						WriteFill(out_fd, segment.offset, segment.length, segment.fill)
+				elif segment.data is not None:
+					WriteFully(out_fd, segment.offset, segment.data)
+				else:
+					if segment.path not in input_fds:
+						input_fds[segment.path] = os.open(segment.path, os.O_RDONLY)
+					CopyFileRange(input_fds[segment.path], out_fd, segment.length,
+					              segment.file_offset, segment.offset)
+
+				if progress:
+					progress(segment.offset + segment.length, size)
+
+			if progress:
+				progress(size, size)
+		finally:
+			for fd in input_fds.values():
+				os.close(fd)
+			os.close(out_fd)
+
+	def UsesClassifierPool(self, device_index: int) -> bool:
+		# Spawning classification workers only pays off for large images.
+		file_bytes = sum(segment.length for segment in self.device_segments[device_index]
+		                 if segment.path is not None and segment.fill is None)
+		return self.jobs > 1 and file_bytes >= PARALLEL_CLASSIFY_THRESHOLD
+
+	def ExportSparse(self, device_index: int, file: str,
+	                 progress: Callable[[int, int], None] = None, classifier_pool=None):
+		"""
+		Write the image of a block device as a sparse image, in a single pass
+		with bounded memory. Space not covered by any segment (unallocated
+		space, ZERO extents, unused partition space) becomes DONT_CARE,
+		data blocks become either RAW or FILL chunks.
+
+		Blocks are classified by |classifier_pool| if given, otherwise by a
+		pool of its own.
+		"""
+		block_size = self.block_size
+		size = self.metadata.block_devices[device_index].size
+		segments = self.device_segments[device_index]
+		input_fds: Dict[str, int] = {}
+
+		def AlignUp(value: int) -> int:
+			return (value + block_size - 1) // block_size * block_size
+
+		jobs = self.jobs if self.UsesClassifierPool(device_index) else 1
+		if jobs == 1:
+			classifier_pool = None
+
+		try:
+			with open(file, 'wb') as out_fd, \
+			     BlockClassifier(block_size, jobs, executor=classifier_pool) as classifier:
+				writer = SparseImageWriter(out_fd, block_size, size // block_size)
+				position = 0
+
+				for segment in segments:
+					assert segment.offset % block_size == 0, "Segment is not block aligned."
+					writer.AddDontCare((segment.offset - position) // block_size)
+					length = AlignUp(segment.length)
+
+					if segment.fill is not None:
+						writer.AddFill(segment.fill, length // block_size)
+					elif segment.data is not None:
+						writer.AddData(segment.data.ljust(length, b'\x00'))
+					else:
+						if segment.path not in input_fds:
+							input_fds[segment.path] = os.open(segment.path, os.O_RDONLY)
+						in_fd = input_fds[segment.path]
+
+						offset = 0
+						for run in classifier.ClassifyFile(segment.path, segment.file_offset,
+						                                   segment.length):
+							run_length = run.blocks * block_size
+							if run.chunk_type == CHUNK_TYPE_RAW:
+								writer.AddRawFromFile(in_fd, segment.file_offset + offset,
+								                      min(run_length, segment.length - offset),
+								                      run.blocks)
+							else:
+								writer.AddFill(run.fill, run.blocks)
+							offset += run_length
+
+					position = segment.offset + length
+					if progress:
+						progress(position, size)
+
+				writer.AddDontCare((size - position) // block_size)
+				writer.Finish()
+
+				if progress:
+					progress(size, size)
+		finally:
+			for fd in input_fds.values():
+				os.close(fd)
+
+	def Export(self, file: str):
+		assert len(self.device_segments) == 1, \
+			"Cannot export image with multiple block devices"
+		if self.sparsify:
+			self.ExportSparse(0, file)
+		else:
+			self.ExportRaw(0, file)
+
+	def ExportFiles(self, output_dir: str, jobs: int = None,
+	                progress: Callable[[str, int, int], None] = None):
+		"""
+		Write one super_<name>.img per block device in |output_dir|. Images are
+		independent from each other, so they are written concurrently by up to
+		|jobs| workers (one per block device by default).
+
+		|progress| is called from the workers with the block device name, the
+		number of bytes done so far and the size of its image.
+
+		Sparse images share a single classification pool, started before the
+		workers.
+		"""
+		devices = range(len(self.device_segments))
+		classifier_pool = None
+		if self.sparsify and any(self.UsesClassifierPool(index) for index in devices):
+			classifier_pool = CreateClassifierPool(self.jobs)
+
+		def ExportDevice(index: int):
+			name = GetBlockDevicePartitionName(self.metadata.block_devices[index])
+			file = str(Path(output_dir) / f"super_{name}.img")
+			device_progress = (lambda done, total: progress(name, done, total)) if progress else None
+			if self.sparsify:
+				self.ExportSparse(index, file, device_progress, classifier_pool)
+			else:
+				self.ExportRaw(index, file, device_progress)
+
+		try:
+			with ThreadPoolExecutor(max_workers=jobs or len(devices) or 1) as executor:
+				# Consume the results to propagate exceptions raised by the workers.
+				for _ in executor.map(ExportDevice, devices):
+					pass
+		finally:
+			if classifier_pool:
+				classifier_pool.shutdown()
+
+def WriteFill(fd: int, offset: int, length: int, pattern: bytes):
+	buffer = pattern * (min(length, COPY_BUFFER_SIZE) // 4)
+	while length:
+		chunk = min(length, len(buffer))
+		WriteFully(fd, offset, memoryview(buffer)[:chunk])
+		offset += chunk
+		length -= chunk
 
 def WriteToImageFile(file: str, metadata: LpMetadata, block_size: int,
                      images: Dict[str, str], sparsify: bool) -> bool:
-	raise NotImplementedError
+	builder = ImageBuilder(metadata, block_size, images, sparsify)
+	builder.Build()
+	builder.Export(file)
+	return True
 
 def WriteSplitImageFiles(output_dir: str, metadata: LpMetadata,
                          block_size: int, images: Dict[str, str],
-                         sparsify: bool) -> bool:
-	raise NotImplementedError
+                         sparsify: bool, jobs: int = None,
+                         progress: Callable[[str, int, int], None] = None) -> bool:
+	builder = ImageBuilder(metadata, block_size, images, sparsify)
+	builder.Build()
+	builder.ExportFiles(output_dir, jobs, progress)
+	return True
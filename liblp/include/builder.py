@@ -4,15 +4,44 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
-from enum import Enum
+from liblp.builder import (
+	kDefaultPartitionAlignment as _kDefaultPartitionAlignment,
+	kDefaultBlockSize as _kDefaultBlockSize,
+	kDefaultGroup as _kDefaultGroup,
+	ExtentType as _ExtentType,
+	Extent as _Extent,
+	LinearExtent as _LinearExtent,
+	ZeroExtent as _ZeroExtent,
+	PartitionGroup as _PartitionGroup,
+	Partition as _Partition,
+	MetadataBuilder as _MetadataBuilder,
+)
 
-# By default, partitions are aligned on a 1MiB boundary.
-kDefaultPartitionAlignment = 1024 * 1024
-kDefaultBlockSize = 4096
+kDefaultPartitionAlignment = _kDefaultPartitionAlignment
+"""By default, partitions are aligned on a 1MiB boundary."""
 
-# Name of the default group in a metadata.
-kDefaultGroup = "default"
+kDefaultBlockSize = _kDefaultBlockSize
 
-class ExtentType(Enum):
-	kZero = 0
-	kLinear = 1
+kDefaultGroup = _kDefaultGroup
+"""Name of the default group in a metadata."""
+
+ExtentType = _ExtentType
+
+Extent = _Extent
+"""Abstraction around dm-targets that can be encoded into logical partition tables."""
+
+LinearExtent = _LinearExtent
+"""This corresponds to a dm-linear target."""
+
+ZeroExtent = _ZeroExtent
+"""This corresponds to a dm-zero target."""
+
+PartitionGroup = _PartitionGroup
+
+Partition = _Partition
+
+MetadataBuilder = _MetadataBuilder
+"""
+Build new logical partition metadata, or edit existing metadata, then
+Export() it for FlashPartitionTable() or UpdatePartitionTable().
+"""
@@ -0,0 +1,30 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from liblp.chunk_store import (
+	ChunkStore as _ChunkStore,
+	IngestStats as _IngestStats,
+	IngestSuperImage as _IngestSuperImage,
+	StreamPartition as _StreamPartition,
+	StreamSuperImage as _StreamSuperImage,
+)
+
+ChunkStore = _ChunkStore
+"""Directory of compressed chunks keyed by SHA-256, plus one manifest per image."""
+
+IngestStats = _IngestStats
+
+IngestSuperImage = _IngestSuperImage
+"""
+Split the partitions and the rest of a super image into chunks, store the
+new ones and write the manifest of the image.
+"""
+
+StreamPartition = _StreamPartition
+"""Yield the content of a partition of a stored image, in order."""
+
+StreamSuperImage = _StreamSuperImage
+"""Yield a stored super image in order, without seeking."""
@@ -0,0 +1,32 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from liblp.compact_metadata import (
+	CompactBlockDevice as _CompactBlockDevice,
+	CompactExtent as _CompactExtent,
+	CompactLpMetadata as _CompactLpMetadata,
+	CompactPartition as _CompactPartition,
+	CompactPartitionGroup as _CompactPartitionGroup,
+	ReadCompactMetadata as _ReadCompactMetadata,
+)
+
+CompactLpMetadata = _CompactLpMetadata
+"""
+Memory efficient counterpart of LpMetadata. Table entries are __slots__
+records with pre-decoded names; use ToLpMetadata() to convert back to the
+ctypes form, e.g. for writing.
+"""
+
+CompactPartition = _CompactPartition
+CompactExtent = _CompactExtent
+CompactPartitionGroup = _CompactPartitionGroup
+CompactBlockDevice = _CompactBlockDevice
+
+ReadCompactMetadata = _ReadCompactMetadata
+"""
+Same as ReadMetadata(), but returns a CompactLpMetadata, decoding the tables
+in bulk.
+"""
@@ -0,0 +1,33 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from liblp.defrag import (
+	ExtentMove as _ExtentMove,
+	DefragPlan as _DefragPlan,
+	DefragStats as _DefragStats,
+	PlanDefragmentation as _PlanDefragmentation,
+	DefragmentSuperImage as _DefragmentSuperImage,
+)
+
+ExtentMove = _ExtentMove
+"""Copy of |num_sectors| sectors of a partition to a new location."""
+
+DefragPlan = _DefragPlan
+"""Moves of one defragmentation pass, and the metadata to write after them."""
+
+DefragStats = _DefragStats
+
+PlanDefragmentation = _PlanDefragmentation
+"""
+Plan one pass making fragmented partitions contiguous, moving as little
+data as possible and only into space no metadata references.
+"""
+
+DefragmentSuperImage = _DefragmentSuperImage
+"""
+Defragment a super image in place. Data is copied and flushed before
+the metadata is updated, so an interrupted run leaves a valid image.
+"""
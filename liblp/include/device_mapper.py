@@ -0,0 +1,31 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from liblp.device_mapper import (
+	DmTarget as _DmTarget,
+	DmTargetLinear as _DmTargetLinear,
+	DmTargetZero as _DmTargetZero,
+	DmTable as _DmTable,
+	CreateDmTable as _CreateDmTable,
+	CreateDmTables as _CreateDmTables,
+)
+
+DmTarget = _DmTarget
+
+DmTargetLinear = _DmTargetLinear
+"""Maps sectors onto a range of another block device."""
+
+DmTargetZero = _DmTargetZero
+"""Reads as zeros, writes are discarded."""
+
+DmTable = _DmTable
+"""Targets of a device-mapper device, serialized in dmsetup format."""
+
+CreateDmTable = _CreateDmTable
+"""Build the device-mapper table of a logical partition."""
+
+CreateDmTables = _CreateDmTables
+"""Build the device-mapper tables of all the logical partitions with extents."""
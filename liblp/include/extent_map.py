@@ -0,0 +1,46 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from liblp.extent_map import (
+	PhysicalSegment as _PhysicalSegment,
+	PartitionExtentMap as _PartitionExtentMap,
+	GetPartitionExtents as _GetPartitionExtents,
+	GetPartitionExtentMap as _GetPartitionExtentMap,
+	InvalidateExtentMaps as _InvalidateExtentMaps,
+	TranslateLogicalRange as _TranslateLogicalRange,
+	GetLinearRanges as _GetLinearRanges,
+)
+
+PhysicalSegment = _PhysicalSegment
+
+PartitionExtentMap = _PartitionExtentMap
+
+GetPartitionExtents = _GetPartitionExtents
+"""Return the slice of the extent table owned by a partition."""
+
+GetPartitionExtentMap = _GetPartitionExtentMap
+"""
+Return the cached logical to physical translation table of a partition.
+"""
+
+InvalidateExtentMaps = _InvalidateExtentMaps
+"""
+Drop the cached extent maps of a metadata object. Must be called after
+modifying its extent table.
+"""
+
+TranslateLogicalRange = _TranslateLogicalRange
+"""
+Convert a logical (offset, length) range of a partition into the list of
+physical segments backing it. ZERO extents produce segments with
+target_type LP_TARGET_TYPE_ZERO.
+"""
+
+GetLinearRanges = _GetLinearRanges
+"""
+Yield the (block device index, start, end) sector range of every linear
+extent of a metadata.
+"""
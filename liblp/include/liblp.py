@@ -33,6 +33,7 @@ from liblp.utility import (
 from liblp.writer import (
 	FlashPartitionTable as _FlashPartitionTable,
 	UpdatePartitionTable as _UpdatePartitionTable,
+	MetadataSerializer as _MetadataSerializer,
 )
 
 LpMetadata = _LpMetadata
@@ -59,6 +60,12 @@ returned if an error occurs, which can include:
  - Incompatible geometry.
 """
 
+MetadataSerializer = _MetadataSerializer
+"""
+Serialize metadata (header and tables) into a reusable buffer. Use one
+instance to serialize many LpMetadata without reallocating.
+"""
+
 ReadMetadata = _ReadMetadata
 """
 Read logical partition metadata from its predetermined location on a block
@@ -8,6 +8,8 @@ from liblp.partition_opener import (
 	BlockDeviceInfo as _BlockDeviceInfo,
 	IPartitionOpener as _IPartitionOpener,
 	PartitionOpener as _PartitionOpener,
+	DeviceMapOpener as _DeviceMapOpener,
+	PooledPartitionOpener as _PooledPartitionOpener,
 )
 
 BlockDeviceInfo = _BlockDeviceInfo
@@ -15,3 +17,13 @@ BlockDeviceInfo = _BlockDeviceInfo
 IPartitionOpener = _IPartitionOpener
 
 PartitionOpener = _PartitionOpener
+
+DeviceMapOpener = _DeviceMapOpener
+"""PartitionOpener with explicit device strings, e.g. loop devices on a host."""
+
+PooledPartitionOpener = _PooledPartitionOpener
+"""
+PartitionOpener keeping a bounded, LRU-evicted pool of read-only file
+descriptors. Read-only opens share the pooled descriptor through pread(),
+each with its own position, so they are safe to use across threads.
+"""
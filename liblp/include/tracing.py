@@ -0,0 +1,27 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from liblp.tracing import (
+	LatencyHistogram as _LatencyHistogram,
+	TraceStats as _TraceStats,
+	Tracer as _Tracer,
+	TracingPartitionOpener as _TracingPartitionOpener,
+)
+
+LatencyHistogram = _LatencyHistogram
+"""Call count, bytes and latencies in power of two microsecond buckets."""
+
+TraceStats = _TraceStats
+"""I/O and call statistics collected while tracing, see Report() and ToDict()."""
+
+Tracer = _Tracer
+"""
+Context manager timing ParseGeometry, ReadMetadataHeader, ParseMetadata and
+the extraction of partitions, optionally under cProfile.
+"""
+
+TracingPartitionOpener = _TracingPartitionOpener
+"""IPartitionOpener wrapper counting the calls, bytes and latency of file I/O."""
@@ -0,0 +1,19 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from liblp.zip_opener import (
+	ZipMemberFile as _ZipMemberFile,
+	ZipPartitionOpener as _ZipPartitionOpener,
+)
+
+ZipMemberFile = _ZipMemberFile
+"""Read-only file object over a stored zip member, with random access."""
+
+ZipPartitionOpener = _ZipPartitionOpener
+"""
+IPartitionOpener over the members of a zip archive, such as the super
+image of a factory package, without extracting them.
+"""
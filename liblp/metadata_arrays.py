@@ -0,0 +1,197 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+NumPy views of the metadata tables.
+
+This module requires NumPy, install liblp with the "numpy" extra.
+
+Each table is exposed as a structured array whose dtype mirrors the
+corresponding ctypes structure. When reading from a device the arrays are
+views on the tables buffer, no per-entry object is created.
+"""
+
+from ctypes import sizeof
+from io import BufferedIOBase
+
+import numpy as np
+
+from liblp.include.metadata_format import (
+	LP_METADATA_VERSION_FOR_UPDATED_ATTR,
+	LP_PARTITION_ATTRIBUTE_MASK_V0,
+	LP_PARTITION_ATTRIBUTE_MASK_V1,
+	LP_SECTOR_SIZE,
+	LP_TARGET_TYPE_LINEAR,
+	LpMetadataBlockDevice,
+	LpMetadataExtent,
+	LpMetadataGeometry,
+	LpMetadataHeader,
+	LpMetadataPartition,
+	LpMetadataPartitionGroup,
+	LpMetadataTableDescriptor,
+)
+from liblp.liblp import LpMetadata
+from liblp.partition_opener import IPartitionOpener, PartitionOpener
+from liblp.reader import ReadLogicalPartitionGeometry, ReadMetadataCopies, ReadMetadataTables
+from liblp.utility import GetTotalMetadataSize
+
+PARTITION_DTYPE = np.dtype([
+	("name", "S36"),
+	("attributes", "<u4"),
+	("first_extent_index", "<u4"),
+	("num_extents", "<u4"),
+	("group_index", "<u4"),
+])
+
+EXTENT_DTYPE = np.dtype([
+	("num_sectors", "<u8"),
+	("target_type", "<u4"),
+	("target_data", "<u8"),
+	("target_source", "<u4"),
+])
+
+GROUP_DTYPE = np.dtype([
+	("name", "S36"),
+	("flags", "<u4"),
+	("maximum_size", "<u8"),
+])
+
+BLOCK_DEVICE_DTYPE = np.dtype([
+	("first_logical_sector", "<u8"),
+	("alignment", "<u4"),
+	("alignment_offset", "<u4"),
+	("size", "<u8"),
+	("partition_name", "S36"),
+	("flags", "<u4"),
+])
+
+assert PARTITION_DTYPE.itemsize == sizeof(LpMetadataPartition)
+assert EXTENT_DTYPE.itemsize == sizeof(LpMetadataExtent)
+assert GROUP_DTYPE.itemsize == sizeof(LpMetadataPartitionGroup)
+assert BLOCK_DEVICE_DTYPE.itemsize == sizeof(LpMetadataBlockDevice)
+
+class MetadataArrays:
+	"""
+	Metadata tables as NumPy structured arrays. Slot suffixes are not
+	applied, names are stored as they appear on disk.
+	"""
+	def __init__(self,
+	             geometry: LpMetadataGeometry,
+	             header: LpMetadataHeader,
+	             partitions: np.ndarray,
+	             extents: np.ndarray,
+	             groups: np.ndarray,
+	             block_devices: np.ndarray):
+		self.geometry = geometry
+		self.header = header
+		self.partitions = partitions
+		self.extents = extents
+		self.groups = groups
+		self.block_devices = block_devices
+
+def GetTableArray(buffer: bytes, descriptor: LpMetadataTableDescriptor,
+                  dtype: np.dtype) -> np.ndarray:
+	assert descriptor.entry_size == dtype.itemsize, \
+		"Logical partition metadata has invalid table entry size."
+	return np.frombuffer(buffer, dtype=dtype, count=descriptor.num_entries,
+	                     offset=descriptor.offset)
+
+def ArraysFromTables(geometry: LpMetadataGeometry, header: LpMetadataHeader,
+                     buffer: bytes) -> MetadataArrays:
+	"""
+	Wrap a tables buffer (as returned by ReadMetadataTables()) without copying
+	it. The arrays are read-only if |buffer| is immutable.
+	"""
+	return MetadataArrays(geometry, header,
+	                      GetTableArray(buffer, header.partitions, PARTITION_DTYPE),
+	                      GetTableArray(buffer, header.extents, EXTENT_DTYPE),
+	                      GetTableArray(buffer, header.groups, GROUP_DTYPE),
+	                      GetTableArray(buffer, header.block_devices, BLOCK_DEVICE_DTYPE))
+
+def ValidateArrays(arrays: MetadataArrays):
+	"""
+	Check the table entries like ParseMetadata() does, one vectorized
+	check per table.
+	"""
+	valid_attributes = LP_PARTITION_ATTRIBUTE_MASK_V0
+	if arrays.header.minor_version >= LP_METADATA_VERSION_FOR_UPDATED_ATTR:
+		valid_attributes |= LP_PARTITION_ATTRIBUTE_MASK_V1
+
+	partitions = arrays.partitions
+	if np.any(partitions["attributes"] & np.uint32(~valid_attributes & 0xFFFFFFFF)):
+		raise Exception("Logical partition has invalid attribute set.")
+	# Summed as 64-bit integers, so that it can't overflow.
+	last = partitions["first_extent_index"].astype(np.uint64) + partitions["num_extents"]
+	assert not np.any(last > len(arrays.extents)), \
+		"Logical partition has invalid extent list."
+	assert not np.any(partitions["group_index"] >= len(arrays.groups)), \
+		"Logical partition has invalid group index."
+
+	extents = arrays.extents
+	linear = extents["target_type"] == LP_TARGET_TYPE_LINEAR
+	if np.any(extents["target_source"][linear] >= len(arrays.block_devices)):
+		raise Exception("Logical partition extent has invalid block device.")
+
+	assert len(arrays.block_devices), "Metadata does not specify a super device."
+
+	# Check that the metadata area and logical partition areas don't overlap.
+	geometry = arrays.geometry
+	metadata_region = GetTotalMetadataSize(geometry.metadata_max_size, geometry.metadata_slot_count)
+	if metadata_region > int(arrays.block_devices[0]["first_logical_sector"]) * LP_SECTOR_SIZE:
+		raise Exception("Logical partition metadata overlaps with logical partition contents.")
+
+def ArraysFromLpMetadata(metadata: LpMetadata) -> MetadataArrays:
+	"""
+	Build the arrays from an already parsed LpMetadata. This needs to copy
+	every entry, prefer ReadMetadataArrays() when reading from a device.
+	"""
+	def ToArray(entries, dtype: np.dtype) -> np.ndarray:
+		return np.frombuffer(b"".join(bytes(entry) for entry in entries), dtype=dtype)
+
+	return MetadataArrays(metadata.geometry, metadata.header,
+	                      ToArray(metadata.partitions, PARTITION_DTYPE),
+	                      ToArray(metadata.extents, EXTENT_DTYPE),
+	                      ToArray(metadata.groups, GROUP_DTYPE),
+	                      ToArray(metadata.block_devices, BLOCK_DEVICE_DTYPE))
+
+def ParseMetadataArrays(geometry: LpMetadataGeometry, fd: BufferedIOBase) -> MetadataArrays:
+	arrays = ArraysFromTables(geometry, *ReadMetadataTables(geometry, fd))
+	ValidateArrays(arrays)
+	return arrays
+
+def ReadMetadataArrays(super_partition: str, slot_number: int,
+                       opener: IPartitionOpener = None) -> MetadataArrays:
+	"""
+	Read and validate the metadata of |slot_number| like ReadMetadata() does,
+	and expose its tables as arrays backed by the tables buffer.
+	"""
+	if not opener:
+		opener = PartitionOpener()
+
+	with opener.Open(super_partition, 'rb') as fd:
+		geometry = ReadLogicalPartitionGeometry(fd)
+		return ReadMetadataCopies(fd, geometry, slot_number, ParseMetadataArrays)
+
+def GetPartitionSizes(arrays: MetadataArrays) -> np.ndarray:
+	"""Return the size in bytes of every partition, in table order."""
+	# Cumulative sector count of the extent table, so that the size of
+	# extents [first, first + num) is a difference of two entries.
+	cumulative = np.zeros(len(arrays.extents) + 1, dtype=np.uint64)
+	np.cumsum(arrays.extents["num_sectors"], out=cumulative[1:])
+
+	first = arrays.partitions["first_extent_index"].astype(np.intp)
+	last = first + arrays.partitions["num_extents"].astype(np.intp)
+	return (cumulative[last] - cumulative[first]) * np.uint64(LP_SECTOR_SIZE)
+
+def GetPartitionExtentCounts(arrays: MetadataArrays) -> np.ndarray:
+	"""Return the number of extents of every partition, in table order."""
+	return arrays.partitions["num_extents"].copy()
+
+def GetGroupUsage(arrays: MetadataArrays) -> np.ndarray:
+	"""Return the total size in bytes of the partitions of every group."""
+	usage = np.zeros(len(arrays.groups), dtype=np.uint64)
+	np.add.at(usage, arrays.partitions["group_index"].astype(np.intp),
+	          GetPartitionSizes(arrays))
+	return usage
@@ -4,7 +4,20 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
-from io import BufferedIOBase
+from collections import OrderedDict
+from fcntl import ioctl
+from io import SEEK_CUR, SEEK_END, SEEK_SET, BufferedIOBase
+import os
+from stat import S_ISBLK
+from struct import unpack
+from threading import Lock
+from typing import Dict
+
+# Where partitions can be found by name.
+BY_NAME_DIR = "/dev/block/by-name"
+
+# ioctl(BLKGETSIZE64) request, from <linux/fs.h>.
+BLKGETSIZE64 = 0x80081272
 
 class BlockDeviceInfo:
 	def __init__(self,
@@ -58,16 +71,227 @@ class IPartitionOpener:
 		"""
 		raise NotImplementedError
 
+def GetPartitionAbsolutePath(partition_name: str) -> str:
+	"""
+	Return the path of |partition_name|: absolute paths, and paths of
+	existing files, are returned as is, otherwise the partition is looked up
+	in /dev/block/by-name/.
+	"""
+	path = os.fspath(partition_name)
+	if os.path.isabs(path) or os.path.exists(path):
+		return path
+	return os.path.join(BY_NAME_DIR, path)
+
+def ReadSysfsInt(path: str, default: int = 0) -> int:
+	try:
+		with open(path, 'r') as file:
+			return int(file.read().strip())
+	except (OSError, ValueError):
+		return default
+
+def GetBlockDeviceSize(fd: int) -> int:
+	return unpack("<Q", ioctl(fd, BLKGETSIZE64, bytes(8)))[0]
+
+def GetFileSize(fd: int) -> int:
+	"""
+	Return the size of |fd|, st_size is 0 for block devices.
+	"""
+	st = os.fstat(fd)
+	if S_ISBLK(st.st_mode):
+		return GetBlockDeviceSize(fd)
+	return st.st_size
+
+def GetBlockDeviceInfo(path: str, fd: int, rdev: int) -> BlockDeviceInfo:
+	size = GetBlockDeviceSize(fd)
+
+	# Partitions have their own alignment_offset, but share the queue
+	# limits of their parent disk.
+	sysfs_dir = os.path.realpath(f"/sys/dev/block/{os.major(rdev)}:{os.minor(rdev)}")
+	queue_dir = os.path.join(sysfs_dir, "queue")
+	if not os.path.isdir(queue_dir):
+		queue_dir = os.path.join(os.path.dirname(sysfs_dir), "queue")
+
+	return BlockDeviceInfo(os.path.basename(path), size,
+	                       ReadSysfsInt(os.path.join(queue_dir, "minimum_io_size")),
+	                       ReadSysfsInt(os.path.join(sysfs_dir, "alignment_offset")),
+	                       ReadSysfsInt(os.path.join(queue_dir, "logical_block_size"), 512))
+
 class PartitionOpener(IPartitionOpener):
 	"""
 	Helper class to implement IPartitionOpener. If |partition_name| is not an
 	absolute path, /dev/block/by-name/ will be prepended.
 	"""
 	def Open(self, partition_name: str, flags: int) -> BufferedIOBase:
-		return open(partition_name, flags)
+		return open(GetPartitionAbsolutePath(partition_name), flags)
 
 	def GetInfo(self, partition_name: str) -> BlockDeviceInfo:
-		return None # TODO
+		path = GetPartitionAbsolutePath(partition_name)
+		try:
+			fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+		except OSError:
+			return None
+
+		try:
+			stat = os.fstat(fd)
+			if S_ISBLK(stat.st_mode):
+				return GetBlockDeviceInfo(path, fd, stat.st_rdev)
+			# Image files have no alignment requirements, the builder
+			# defaults apply.
+			return BlockDeviceInfo(os.path.basename(path), stat.st_size, 0, 0, 4096)
+		except OSError:
+			return None
+		finally:
+			os.close(fd)
 
 	def GetDeviceString(self, partition_name: str) -> str:
-		return partition_name
+		return GetPartitionAbsolutePath(partition_name)
+
+class DeviceMapOpener(PartitionOpener):
+	"""
+	PartitionOpener whose device strings come from |devices|, a map of
+	physical partition names to paths or major:minor sequences, e.g. the
+	loop devices a super image is attached to on a host.
+	"""
+	def __init__(self, devices: Dict[str, str]):
+		self.devices = devices
+
+	def GetDeviceString(self, partition_name: str) -> str:
+		if partition_name in self.devices:
+			return self.devices[partition_name]
+		return super().GetDeviceString(partition_name)
+
+class PooledFd:
+	def __init__(self, fd: int):
+		self.fd = fd
+		# Number of users, the descriptor is only closed once it drops to 0.
+		self.refs = 0
+		self.evicted = False
+
+def Pread(fd: int, size: int, offset: int) -> bytes:
+	"""pread() until |size| bytes are read or end of file is reached."""
+	data = os.pread(fd, size, offset)
+	if len(data) == size or not data:
+		return data
+
+	chunks = [data]
+	read = len(data)
+	while read < size:
+		chunk = os.pread(fd, size - read, offset + read)
+		if not chunk:
+			break
+		chunks.append(chunk)
+		read += len(chunk)
+	return b"".join(chunks)
+
+class PreadFile:
+	"""
+	Read-only file object over a pooled descriptor. Reads use pread() with a
+	position private to this object, so any number of them can share the
+	same descriptor across threads.
+	"""
+	def __init__(self, opener: "PooledPartitionOpener", path: str, entry: PooledFd):
+		self.opener = opener
+		self.path = path
+		self.entry = entry
+		self.position = 0
+		self.closed = False
+
+	def fileno(self) -> int:
+		return self.entry.fd
+
+	def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+		if whence == SEEK_CUR:
+			offset += self.position
+		elif whence == SEEK_END:
+			offset += GetFileSize(self.entry.fd)
+		self.position = offset
+		return self.position
+
+	def tell(self) -> int:
+		return self.position
+
+	def read(self, size: int = -1) -> bytes:
+		if size < 0:
+			size = max(GetFileSize(self.entry.fd) - self.position, 0)
+		data = Pread(self.entry.fd, size, self.position)
+		self.position += len(data)
+		return data
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			self.opener.Release(self.entry)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class PooledPartitionOpener(PartitionOpener):
+	"""
+	PartitionOpener that keeps up to |max_open| read-only descriptors open,
+	evicting the least recently used one. Read-only Open() calls return a
+	PreadFile on the pooled descriptor, other modes open a new file.
+
+	Use ReadAt() for one-shot positional reads. All methods are thread-safe.
+	"""
+	def __init__(self, max_open: int = 16):
+		assert max_open > 0, "The pool must allow at least one descriptor."
+		self.max_open = max_open
+		self.lock = Lock()
+		self.pool: Dict[str, PooledFd] = OrderedDict()
+
+	def Acquire(self, partition_name: str) -> PooledFd:
+		path = os.path.abspath(GetPartitionAbsolutePath(partition_name))
+		with self.lock:
+			entry = self.pool.get(path)
+			if entry:
+				self.pool.move_to_end(path)
+			else:
+				entry = PooledFd(os.open(path, os.O_RDONLY | os.O_CLOEXEC))
+				self.pool[path] = entry
+				self.Evict()
+			entry.refs += 1
+			return entry
+
+	def Release(self, entry: PooledFd):
+		with self.lock:
+			entry.refs -= 1
+			if entry.evicted and not entry.refs:
+				os.close(entry.fd)
+
+	def Evict(self):
+		# Caller holds the lock. Descriptors still in use are closed by the
+		# last Release().
+		while len(self.pool) > self.max_open:
+			_, entry = self.pool.popitem(last=False)
+			entry.evicted = True
+			if not entry.refs:
+				os.close(entry.fd)
+
+	def Open(self, partition_name: str, flags: int) -> BufferedIOBase:
+		if flags != 'rb':
+			return super().Open(partition_name, flags)
+		return PreadFile(self, partition_name, self.Acquire(partition_name))
+
+	def ReadAt(self, partition_name: str, size: int, offset: int) -> bytes:
+		entry = self.Acquire(partition_name)
+		try:
+			return Pread(entry.fd, size, offset)
+		finally:
+			self.Release(entry)
+
+	def close(self):
+		with self.lock:
+			while self.pool:
+				_, entry = self.pool.popitem()
+				entry.evicted = True
+				if not entry.refs:
+					os.close(entry.fd)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
@@ -0,0 +1,166 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from argparse import ArgumentParser
+import os
+from pathlib import Path
+
+from liblp import (
+	LP_PARTITION_ATTR_NONE,
+	LP_PARTITION_ATTR_READONLY,
+	LP_TARGET_TYPE_ZERO,
+	GetLinearRanges,
+	GetPartitionExtentMap,
+	GetPartitionName,
+	IPartitionOpener,
+	LinearExtent,
+	LpMetadata,
+	MetadataBuilder,
+	Partition,
+	PartitionOpener,
+)
+from liblp.images import GetImagePieces, WriteFill
+from liblp.reader import ReadLogicalPartitionGeometry, ReadUnadjustedMetadata
+from liblp.utility import CopyFileRange
+from liblp.writer import SerializeMetadata, UpdateMetadataSlots, ValidateAndSerializeMetadata
+
+def ReplacePartition(builder: MetadataBuilder, name: str, group_name: str,
+                     attributes: int) -> Partition:
+	"""
+	Swap partition |name| for an empty one, at the same position in the
+	table. The old extents stay reserved.
+	"""
+	old = builder.partitions[name]
+	builder.group_usage[old.group_name] -= old.size
+
+	partition = Partition(name, group_name, attributes)
+	builder.partitions[name] = partition
+	return partition
+
+def lpadd(super_image: Path, partition_name: str, group_name: str, image: Path = None,
+          readonly: bool = False, replace: bool = False, slot: int = 0,
+          opener: IPartitionOpener = None) -> LpMetadata:
+	"""
+	Add |image| as partition |partition_name| of |group_name| to an existing
+	super image, or replace that partition if |replace| is set. Only the
+	image data is written, followed by the metadata.
+
+	New data goes to free space so that an interrupted run leaves the old
+	partition intact. If there is not enough of it, a replaced partition
+	reuses its own extents, which is not crash-safe.
+
+	The metadata slots identical to |slot| are updated, the extents of the
+	other slots are left untouched.
+	"""
+	if not opener:
+		opener = PartitionOpener()
+
+	with opener.Open(super_image, 'rb') as fd:
+		geometry = ReadLogicalPartitionGeometry(fd)
+		assert slot < geometry.metadata_slot_count, f"Invalid metadata slot number {slot}"
+		slots = [ReadUnadjustedMetadata(fd, geometry, i) for i in range(geometry.metadata_slot_count)]
+
+	metadata = slots[slot]
+	blob = SerializeMetadata(metadata)
+
+	builder = MetadataBuilder.NewFromMetadata(metadata)
+	target_slots = []
+	pinned = []
+	for i, slot_metadata in enumerate(slots):
+		if SerializeMetadata(slot_metadata) == blob:
+			target_slots.append(i)
+		else:
+			pinned.extend(GetLinearRanges(slot_metadata))
+	for device_index, start, end in pinned:
+		builder.free_space[device_index].Exclude(start, end)
+
+	if not builder.FindGroup(group_name):
+		builder.AddGroup(group_name, 0)
+
+	size, pieces = GetImagePieces(image) if image else (0, [])
+
+	old = builder.FindPartition(partition_name)
+	if old:
+		if not replace:
+			raise Exception(f"Partition {partition_name} already exists, use --replace")
+		attributes = old.attributes
+		if readonly:
+			attributes |= LP_PARTITION_ATTR_READONLY
+		partition = ReplacePartition(builder, partition_name, group_name, attributes)
+	else:
+		attributes = LP_PARTITION_ATTR_READONLY if readonly else LP_PARTITION_ATTR_NONE
+		partition = builder.AddPartition(partition_name, attributes, group_name)
+
+	if not builder.ResizePartition(partition, size):
+		if not old:
+			raise Exception(f"Not enough space to add partition {partition_name}")
+
+		# Fall back to overwriting the old partition.
+		for extent in old.RemoveExtents():
+			if isinstance(extent, LinearExtent):
+				builder.free_space[extent.device_index].Free(extent.physical_sector,
+				                                             extent.EndSector())
+		for device_index, start, end in pinned:
+			builder.free_space[device_index].Exclude(start, end)
+		if not builder.ResizePartition(partition, size):
+			raise Exception(f"Not enough space to replace partition {partition_name}")
+
+	new_metadata = builder.Export()
+	for new_partition in new_metadata.partitions:
+		if GetPartitionName(new_partition) == partition_name:
+			break
+
+	first = new_partition.first_extent_index
+	extents = new_metadata.extents[first:first + new_partition.num_extents]
+	if any(extent.target_source for extent in extents):
+		raise Exception("Split super devices are not supported.")
+
+	# Fail before writing anything if the new metadata can't be written.
+	ValidateAndSerializeMetadata(opener, new_metadata, "", super_image)
+
+	# Write the data and make it durable before pointing the metadata at it.
+	extent_map = GetPartitionExtentMap(new_metadata, new_partition)
+	with opener.Open(super_image, 'r+b') as fd:
+		image_fd = os.open(image, os.O_RDONLY) if image else None
+		try:
+			for piece in pieces:
+				for segment in extent_map.Translate(piece.logical_offset, piece.length):
+					assert segment.target_type != LP_TARGET_TYPE_ZERO
+					if piece.fill is not None:
+						WriteFill(fd.fileno(), segment.offset, segment.length, piece.fill)
+					else:
+						CopyFileRange(image_fd, fd.fileno(), segment.length,
+						              piece.file_offset + segment.logical_offset - piece.logical_offset,
+						              segment.offset)
+		finally:
+			if image_fd is not None:
+				os.close(image_fd)
+		os.fsync(fd.fileno())
+
+	UpdateMetadataSlots(super_image, new_metadata, target_slots, opener)
+
+	return new_metadata
+
+def main():
+	parser = ArgumentParser(description='command-line tool for adding or replacing a partition in a super image')
+	parser.add_argument('super_image', help='Super image path', type=Path)
+	parser.add_argument('partition_name', help='Name of the partition to add')
+	parser.add_argument('group_name', help='Group of the partition, created if missing')
+	parser.add_argument('image', help='Partition image, raw or sparse (default is an empty partition)', type=Path, nargs='?')
+	parser.add_argument('--readonly', help='Mark the partition as read-only', action='store_true')
+	parser.add_argument('--replace', help='Replace the partition if it already exists', action='store_true')
+	parser.add_argument('-S', '--slot', help='Slot number (default is 0).', type=int, default=0)
+	args = parser.parse_args()
+
+	metadata = lpadd(args.super_image, args.partition_name, args.group_name, args.image,
+	                 args.readonly, args.replace, args.slot)
+
+	for partition in metadata.partitions:
+		if GetPartitionName(partition) == args.partition_name:
+			print(f"{args.partition_name}: {partition.num_extents} extents")
+
+if __name__ == '__main__':
+	main()
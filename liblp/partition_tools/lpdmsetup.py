@@ -0,0 +1,96 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from argparse import ArgumentParser
+from pathlib import Path
+import re
+from shlex import quote
+from typing import Dict, List
+
+from liblp import (
+	CreateDmTables,
+	DeviceMapOpener,
+	GetBlockDevicePartitionName,
+	ReadMetadata,
+)
+
+# Device strings end up in dm tables, split on whitespace, and in a shell
+# script run as root.
+DEVICE_STRING_PATTERN = re.compile(r"[\w./:+@%,-]+")
+
+# Variable holding the loop device attached by the script.
+LOOP_DEVICE = "$LOOP"
+
+def IsValidDeviceString(device: str) -> bool:
+	return bool(DEVICE_STRING_PATTERN.fullmatch(device))
+
+def QuoteTableLine(line: str) -> str:
+	"""Quote a table line for the shell, only expanding the loop device."""
+	return f'"{LOOP_DEVICE}"'.join(quote(part) for part in line.split(LOOP_DEVICE))
+
+def lpdmsetup(image: Path, devices: Dict[str, str] = None, partitions: List[str] = None,
+              slot: int = 0, prefix: str = "") -> str:
+	"""
+	Return a shell script mapping the partitions of |image| with dmsetup.
+	|devices| maps block device partition names to device strings. The first
+	block device defaults to a read-only loop device of |image|, attached by
+	the script.
+	"""
+	metadata = ReadMetadata(image, slot)
+	devices = dict(devices or {})
+	for name, device in devices.items():
+		if not IsValidDeviceString(device):
+			raise Exception(f"Invalid device string for block device {name}: {device!r}")
+
+	lines = ["#!/bin/sh", "set -e"]
+
+	super_name = GetBlockDevicePartitionName(metadata.block_devices[0])
+	if super_name not in devices:
+		lines.append(f"LOOP=$(losetup --find --show --read-only {quote(str(image))})")
+		devices[super_name] = LOOP_DEVICE
+
+	for block_device in metadata.block_devices[1:]:
+		name = GetBlockDevicePartitionName(block_device)
+		if name not in devices:
+			raise Exception(f"No device given for block device {name}")
+
+	tables = CreateDmTables(metadata, DeviceMapOpener(devices))
+
+	if partitions:
+		missing = [name for name in partitions if name not in tables]
+		if missing:
+			raise Exception(f"Partitions not found: {missing}")
+		tables = {name: tables[name] for name in partitions}
+
+	for name, table in tables.items():
+		readonly = " --readonly" if table.readonly else ""
+		table_lines = " ".join(QuoteTableLine(line) for line in table.Serialize().splitlines())
+		lines.append(f"printf '%s\\n' {table_lines} | dmsetup create {quote(prefix + name)}{readonly}")
+
+	return "\n".join(lines) + "\n"
+
+def main():
+	parser = ArgumentParser(description='command-line tool for mapping the partitions of a super image with device-mapper')
+	parser.add_argument('image', help='Super image path', type=Path)
+	parser.add_argument('-d', '--device', help='Device of a block device, as NAME=PATH or NAME=MAJOR:MINOR. This can be specified multiple times (default is a loop device of the image for super).', action='append', default=[])
+	parser.add_argument('-p', '--partition', help='Map the named partition. This can be specified multiple times.', action='append')
+	parser.add_argument('-S', '--slot', help='Slot number (default is 0).', type=int, default=0)
+	parser.add_argument('--prefix', help='Prefix of the device-mapper device names.', default='')
+	args = parser.parse_args()
+
+	devices = {}
+	for device in args.device:
+		name, separator, path = device.partition('=')
+		if not separator:
+			parser.error(f"Invalid device {device}, expected NAME=PATH")
+		if not IsValidDeviceString(path):
+			parser.error(f"Invalid device {device}, paths can't contain whitespace or shell metacharacters")
+		devices[name] = path
+
+	print(lpdmsetup(args.image, devices, args.partition, args.slot, args.prefix), end='')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,74 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from argparse import ArgumentParser
+from pathlib import Path
+import sys
+
+from liblp.chunk_store import (
+	CODECS,
+	DEFAULT_CHUNK_SIZE,
+	ChunkStore,
+	IngestSuperImage,
+	StreamPartition,
+	StreamSuperImage,
+)
+
+def main():
+	parser = ArgumentParser(description='command-line tool for archiving super images in a deduplicating chunk store')
+	parser.add_argument('store', help='Chunk store directory', type=Path)
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	ingest = subparsers.add_parser('ingest', help='Add a super image to the store')
+	ingest.add_argument('image', help='Super image path', type=Path)
+	ingest.add_argument('-n', '--name', help='Name of the image in the store (default is the file name without extension)')
+	ingest.add_argument('-S', '--slot', help='Slot number of the metadata to use (default is 0).', type=int, default=0)
+	ingest.add_argument('--chunk-size', help=f'Chunk size in bytes (default is {DEFAULT_CHUNK_SIZE}).', type=int, default=DEFAULT_CHUNK_SIZE)
+	ingest.add_argument('-c', '--codec', help='Compression of new chunks (default is zlib).', choices=list(CODECS), default='zlib')
+	ingest.add_argument('-j', '--jobs', help='Number of threads (default is the number of CPUs).', type=int)
+
+	restore = subparsers.add_parser('restore', help='Rebuild a super image')
+	restore.add_argument('name', help='Name of the image in the store')
+	restore.add_argument('output', help='Output path, - for stdout', type=Path)
+
+	extract = subparsers.add_parser('extract', help='Rebuild a partition image')
+	extract.add_argument('name', help='Name of the image in the store')
+	extract.add_argument('partition', help='Partition name')
+	extract.add_argument('output', help='Output path, - for stdout', type=Path)
+
+	subparsers.add_parser('list', help='List the images in the store')
+
+	args = parser.parse_args()
+
+	if args.command == 'ingest':
+		store = ChunkStore(args.store, args.codec)
+		stats = IngestSuperImage(store, args.image, args.name, args.slot, args.chunk_size, args.jobs)
+		print(stats)
+		return
+
+	store = ChunkStore(args.store)
+	if args.command == 'list':
+		for name in store.ListManifests():
+			print(name)
+		return
+
+	if args.command == 'restore':
+		stream = StreamSuperImage(store, args.name)
+	else:
+		stream = StreamPartition(store, args.name, args.partition)
+
+	if str(args.output) == '-':
+		output = sys.stdout.buffer
+		for data in stream:
+			output.write(data)
+		output.flush()
+	else:
+		with args.output.open('wb') as output:
+			for data in stream:
+				output.write(data)
+
+if __name__ == '__main__':
+	main()
@@ -5,35 +5,176 @@
 #
 
 from argparse import ArgumentParser
+from contextlib import nullcontext
+from errno import EINVAL
 from io import BufferedReader
+from mmap import mmap
+import os
 from pathlib import Path
-from typing import Dict, List
+import sys
+from threading import local
+from typing import Dict, List, NamedTuple, Tuple
 
 from liblp import (
 	LP_SECTOR_SIZE,
 	LP_TARGET_TYPE_LINEAR,
 	LpMetadata,
 	LpMetadataPartition,
+	GetPartitionExtentMap,
 	GetPartitionName,
 	ReadMetadata,
 )
+from liblp.filesystems import GetUsedRanges
+from liblp.partition_opener import PartitionOpener, Pread
+from liblp.reader import ReadLogicalPartitionGeometry
+from liblp.tracing import Traced, TraceOpener, Tracer
+from liblp.utility import CopyFileRange, SetDirectIo, WriteFully
+
+# Alignment of O_DIRECT offsets, lengths and buffers.
+DIRECT_IO_ALIGNMENT = 4096
+# Size of the reusable read buffer in cache-bypass mode.
+UNCACHED_BUFFER_SIZE = 4 * 1024 * 1024
+# Amount of output written between flushes in cache-bypass mode.
+UNCACHED_FLUSH_SIZE = 64 * 1024 * 1024
+# Size of the ranges partitions are split into when extracting with
+# several workers.
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+class CopyRange(NamedTuple):
+	input_offset: int
+	output_offset: int
+	length: int
+
+class SharedRange(NamedTuple):
+	input_offset: int
+	length: int
+	# (partition name, output offset) of every partition mapping the range.
+	targets: List[Tuple[str, int]]
+
+class UncachedReader:
+	"""
+	Positional reads that stay out of the page cache: O_DIRECT into an
+	aligned, reusable buffer when the filesystem supports it, otherwise
+	buffered reads followed by POSIX_FADV_DONTNEED.
+	"""
+	def __init__(self, path: str):
+		self.fd = os.open(path, os.O_RDONLY)
+		self.direct = SetDirectIo(self.fd, True)
+		os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+		# Anonymous mappings are page aligned.
+		self.buffer = mmap(-1, UNCACHED_BUFFER_SIZE)
+		self.view = memoryview(self.buffer)
+		# Leave room for aligning the start of a read down.
+		self.max_read = UNCACHED_BUFFER_SIZE - DIRECT_IO_ALIGNMENT
+
+	def Read(self, offset: int, length: int) -> memoryview:
+		"""
+		Read up to |length| bytes at |offset|. The result is a view of the
+		buffer, only valid until the next call.
+		"""
+		assert length <= self.max_read, "Read is larger than the buffer."
+
+		if self.direct:
+			start = offset - offset % DIRECT_IO_ALIGNMENT
+			end = offset + length
+			end += -end % DIRECT_IO_ALIGNMENT
+			try:
+				count = os.preadv(self.fd, [self.view[:end - start]], start)
+			except OSError as e:
+				# Unaligned I/O is not supported here, use the page cache.
+				if e.errno != EINVAL:
+					raise
+				self.direct = SetDirectIo(self.fd, False)
+			else:
+				return self.view[offset - start:min(offset - start + length, count)]
+
+		count = os.preadv(self.fd, [self.view[:length]], offset)
+		os.posix_fadvise(self.fd, offset, length, os.POSIX_FADV_DONTNEED)
+		return self.view[:count]
+
+	def close(self):
+		self.view.release()
+		self.buffer.close()
+		os.close(self.fd)
+
+class UncachedWriter:
+	"""
+	Sequential writer that regularly flushes what it wrote and drops it
+	from the page cache.
+	"""
+	def __init__(self, path: str):
+		self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+		self.written = 0
+		self.flushed = 0
+
+	def Write(self, data: bytes):
+		WriteFully(self.fd, self.written, data)
+		self.written += len(data)
+		if self.written - self.flushed >= UNCACHED_FLUSH_SIZE:
+			self.Flush()
+
+	def Flush(self):
+		# Dirty pages can't be dropped, write them back first.
+		os.fdatasync(self.fd)
+		os.posix_fadvise(self.fd, self.flushed, self.written - self.flushed,
+		                 os.POSIX_FADV_DONTNEED)
+		self.flushed = self.written
+
+	def close(self):
+		try:
+			self.Flush()
+		finally:
+			os.close(self.fd)
 
 class ImageExtractor:
 	def __init__(self,
 	             image_fd: BufferedReader,
 	             metadata: LpMetadata,
 	             partitions: List[str],
-	             output_dir: str):
+	             output_dir: str,
+	             bypass_cache: bool = False,
+	             jobs: int = 1,
+	             chunk_size: int = DEFAULT_CHUNK_SIZE,
+	             used_only: bool = False,
+	             image_offset: int = 0,
+	             streaming: bool = False):
 		self.image_fd = image_fd
 		self.metadata = metadata
 		self.partitions = partitions or []
 		self.output_dir = output_dir
+		# Keep the extracted data out of the page cache.
+		self.bypass_cache = bypass_cache
+		# With more than one job, each partition is split into |chunk_size|
+		# ranges copied concurrently.
+		self.jobs = jobs
+		self.chunk_size = chunk_size
+		block_size = metadata.geometry.logical_block_size
+		assert chunk_size > 0 and not chunk_size % block_size, \
+			f"Chunk size {chunk_size} is not a positive multiple of the logical block size {block_size}"
+		# Only copy the filesystem and AVB footer of each partition, the
+		# rest of the output is left as a hole.
+		self.used_only = used_only
+		# Offset of the super image in |image_fd|, e.g. in a zip archive.
+		self.image_offset = image_offset
+		# |image_fd| can only be read forward, like a compressed zip member.
+		# All the partitions are extracted in one pass over it.
+		self.streaming = streaming
 
 		self.partition_map: Dict[str, LpMetadataPartition] = {}
+		# Bytes not read thanks to extents shared between partitions.
+		self.bytes_saved = 0
 
 	def Extract(self):
 		self.BuildPartitionList()
 
+		ranges = self.GetSharedRanges()
+		self.bytes_saved = sum((len(shared_range.targets) - 1) * shared_range.length
+		                       for shared_range in ranges)
+		if self.bytes_saved or self.streaming:
+			self.ExtractShared(ranges)
+			return
+
 		for _, info in self.partition_map.items():
 			self.ExtractPartition(info)
 
@@ -50,7 +191,7 @@ class ImageExtractor:
 		if not extract_all and self.partitions:
 			raise Exception(f"Partitions not found: {self.partitions}")
 
-	def ExtractPartition(self, partition: LpMetadataPartition):
+	def GetImageSize(self, partition: LpMetadataPartition) -> int:
 		# Validate the extents and find the total image size.
 		total_size = 0
 		for i in range(partition.num_extents):
@@ -63,13 +204,27 @@ class ImageExtractor:
 				raise Exception("Split super devices are not supported.")
 			total_size += extent.num_sectors * LP_SECTOR_SIZE
 
+		return total_size
+
+	@Traced("ImageExtractor.ExtractPartition")
+	def ExtractPartition(self, partition: LpMetadataPartition):
+		total_size = self.GetImageSize(partition)
+
+		if self.jobs > 1 or self.used_only:
+			self.ExtractPartitionRanges(partition, total_size)
+			return
+
+		if self.bypass_cache:
+			self.ExtractPartitionUncached(partition)
+			return
+
 		with (self.output_dir / f"{GetPartitionName(partition)}.img").open('wb') as output_fd:
 			block_size = self.metadata.geometry.logical_block_size
 			for i in range(partition.num_extents):
 				index = partition.first_extent_index + i
 				extent = self.metadata.extents[index]
 
-				super_offset = extent.target_data * LP_SECTOR_SIZE
+				super_offset = self.image_offset + extent.target_data * LP_SECTOR_SIZE
 				self.image_fd.seek(super_offset)
 
 				remaining_bytes = extent.num_sectors * LP_SECTOR_SIZE
@@ -81,23 +236,334 @@ class ImageExtractor:
 
 					remaining_bytes -= block_size
 
+	def ExtractPartitionUncached(self, partition: LpMetadataPartition):
+		reader = UncachedReader(self.image_fd.name)
+		try:
+			writer = UncachedWriter(self.output_dir / f"{GetPartitionName(partition)}.img")
+			try:
+				for i in range(partition.num_extents):
+					extent = self.metadata.extents[partition.first_extent_index + i]
+
+					offset = self.image_offset + extent.target_data * LP_SECTOR_SIZE
+					remaining_bytes = extent.num_sectors * LP_SECTOR_SIZE
+					while remaining_bytes:
+						with reader.Read(offset, min(remaining_bytes, reader.max_read)) as data:
+							if not data:
+								raise Exception("Unexpected end of file while reading extent")
+							writer.Write(data)
+							offset += len(data)
+							remaining_bytes -= len(data)
+			finally:
+				writer.close()
+		finally:
+			reader.close()
+
+	def GetUsedExtents(self, partition: LpMetadataPartition) -> List[CopyRange]:
+		"""
+		Return the parts of the extents of |partition| to extract: all of
+		them, or only the used ranges if |used_only| is set.
+		"""
+		block_size = self.metadata.geometry.logical_block_size
+		used_ranges = None
+		if self.used_only:
+			if self.streaming:
+				raise Exception("Extracting only the used data needs random access to the image.")
+			extent_map = GetPartitionExtentMap(self.metadata, partition)
+
+			def ReadPartition(offset: int, length: int) -> bytes:
+				return b"".join(Pread(self.image_fd.fileno(), segment.length,
+				                      self.image_offset + segment.offset)
+				                for segment in extent_map.Translate(offset, length))
+
+			used_ranges = GetUsedRanges(ReadPartition, extent_map.size, block_size)
+
+		extents = []
+		output_offset = 0
+		for i in range(partition.num_extents):
+			extent = self.metadata.extents[partition.first_extent_index + i]
+
+			input_offset = self.image_offset + extent.target_data * LP_SECTOR_SIZE
+			length = extent.num_sectors * LP_SECTOR_SIZE
+			if length % block_size:
+				raise Exception("extent is not block-aligned")
+
+			for used_offset, used_length in used_ranges or [(output_offset, length)]:
+				start = max(output_offset, used_offset)
+				end = min(output_offset + length, used_offset + used_length)
+				if start < end:
+					extents.append(CopyRange(input_offset + start - output_offset, start, end - start))
+
+			output_offset += length
+
+		return extents
+
+	def GetCopyRanges(self, partition: LpMetadataPartition) -> List[CopyRange]:
+		ranges = []
+		for input_offset, output_offset, length in self.GetUsedExtents(partition):
+			for start in range(0, length, self.chunk_size):
+				ranges.append(CopyRange(input_offset + start, output_offset + start,
+				                        min(self.chunk_size, length - start)))
+
+		return ranges
+
+	def ExtractPartitionRanges(self, partition: LpMetadataPartition, total_size: int):
+		"""
+		Copy the ranges of |partition| into a file of |total_size| bytes,
+		with |jobs| threads. Only positional I/O is used so that they can
+		share both descriptors.
+		"""
+		ranges = self.GetCopyRanges(partition)
+		input_fd = self.image_fd.fileno()
+		readers = local()
+		opened_readers: List[UncachedReader] = []
+
+		def CopyRangeCached(copy_range: CopyRange):
+			CopyFileRange(input_fd, output_fd, copy_range.length,
+			              copy_range.input_offset, copy_range.output_offset)
+
+		def CopyRangeUncached(copy_range: CopyRange):
+			reader = getattr(readers, "reader", None)
+			if not reader:
+				reader = readers.reader = UncachedReader(self.image_fd.name)
+				opened_readers.append(reader)
+
+			done = 0
+			while done < copy_range.length:
+				length = min(copy_range.length - done, reader.max_read)
+				with reader.Read(copy_range.input_offset + done, length) as data:
+					if not data:
+						raise Exception("Unexpected end of file while reading extent")
+					WriteFully(output_fd, copy_range.output_offset + done, data)
+					done += len(data)
+
+			os.fdatasync(output_fd)
+			os.posix_fadvise(output_fd, copy_range.output_offset, copy_range.length,
+			                 os.POSIX_FADV_DONTNEED)
+
+		output_fd = os.open(self.output_dir / f"{GetPartitionName(partition)}.img",
+		                    os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+		try:
+			os.ftruncate(output_fd, total_size)
+			copy = CopyRangeUncached if self.bypass_cache else CopyRangeCached
+			if self.jobs > 1:
+				# Only imported when needed, it is slow to import.
+				from concurrent.futures import ThreadPoolExecutor
+
+				with ThreadPoolExecutor(self.jobs) as executor:
+					for _ in executor.map(copy, ranges):
+						pass
+			else:
+				for copy_range in ranges:
+					copy(copy_range)
+		finally:
+			for reader in opened_readers:
+				reader.close()
+			os.close(output_fd)
+
+	def GetSharedRanges(self) -> List[SharedRange]:
+		"""
+		Split the extents of the selected partitions at every extent boundary,
+		so that each physical range is returned once along with all the
+		partitions mapping it.
+		"""
+		events = []
+		for name, partition in self.partition_map.items():
+			self.GetImageSize(partition)
+			for start, output_offset, length in self.GetUsedExtents(partition):
+				events.append((start, 1, name, output_offset - start))
+				events.append((start + length, -1, name, output_offset - start))
+
+		# Ends sort before starts at the same offset.
+		events.sort(key=lambda event: (event[0], event[1]))
+
+		ranges = []
+		active = set()
+		position = 0
+		for offset, kind, name, delta in events:
+			if active and offset > position:
+				ranges.append(SharedRange(position, offset - position,
+				                          [(target, position + target_delta)
+				                           for target, target_delta in sorted(active)]))
+			position = offset
+			if kind > 0:
+				active.add((name, delta))
+			else:
+				active.remove((name, delta))
+
+		return ranges
+
+	@Traced("ImageExtractor.ExtractShared")
+	def ExtractShared(self, ranges: List[SharedRange]):
+		"""
+		Read every range once and write it to all the partitions mapping it.
+		The ranges are sorted, so a streamed image is read in order.
+		"""
+		readers = local()
+		opened_readers: List[UncachedReader] = []
+		output_fds: Dict[str, int] = {}
+
+		def Read(offset: int, length: int):
+			if self.streaming:
+				assert offset >= self.image_fd.tell(), "Streamed images can only be read forward."
+				# Skips what is in between.
+				self.image_fd.seek(offset)
+				return memoryview(self.image_fd.read(length))
+
+			if not self.bypass_cache:
+				return memoryview(Pread(self.image_fd.fileno(), length, offset))
+
+			reader = getattr(readers, "reader", None)
+			if not reader:
+				reader = readers.reader = UncachedReader(self.image_fd.name)
+				opened_readers.append(reader)
+			return reader.Read(offset, min(length, reader.max_read))
+
+		def CopySharedRange(shared_range: SharedRange):
+			done = 0
+			while done < shared_range.length:
+				with Read(shared_range.input_offset + done, shared_range.length - done) as data:
+					if not data:
+						raise Exception("Unexpected end of file while reading extent")
+					for name, output_offset in shared_range.targets:
+						WriteFully(output_fds[name], output_offset + done, data)
+					done += len(data)
+
+			if self.bypass_cache:
+				for name, output_offset in shared_range.targets:
+					os.fdatasync(output_fds[name])
+					os.posix_fadvise(output_fds[name], output_offset, shared_range.length,
+					                 os.POSIX_FADV_DONTNEED)
+
+		# Bound the reads, and the work items of the thread pool.
+		chunks = []
+		for shared_range in ranges:
+			for start in range(0, shared_range.length, self.chunk_size):
+				chunks.append(SharedRange(shared_range.input_offset + start,
+				                          min(self.chunk_size, shared_range.length - start),
+				                          [(name, output_offset + start)
+				                           for name, output_offset in shared_range.targets]))
+
+		try:
+			for name, partition in self.partition_map.items():
+				output_fds[name] = os.open(self.output_dir / f"{name}.img",
+				                           os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+				os.ftruncate(output_fds[name], self.GetImageSize(partition))
+
+			if self.jobs > 1 and not self.streaming:
+				from concurrent.futures import ThreadPoolExecutor
+
+				with ThreadPoolExecutor(self.jobs) as executor:
+					for _ in executor.map(CopySharedRange, chunks):
+						pass
+			else:
+				for chunk in chunks:
+					CopySharedRange(chunk)
+		finally:
+			for reader in opened_readers:
+				reader.close()
+			for output_fd in output_fds.values():
+				os.close(output_fd)
+
 def lpunpack(image: Path, output: Path = Path('.'),
-             partitions: List[str] = None, slot: int = 0):
-	with image.open('rb') as image_fd:
-		metadata = ReadMetadata(image, slot)
+             partitions: List[str] = None, slot: int = 0,
+             bypass_cache: bool = False, jobs: int = 1,
+             chunk_size: int = DEFAULT_CHUNK_SIZE, used_only: bool = False,
+             zip_member: str = None) -> int:
+	"""
+	Extract the partitions of |image|, or of its member |zip_member| if it
+	is a zip archive. Return the number of bytes that did not have to be
+	read because they are shared by several partitions.
+
+	While a Tracer is active, the image is read through a
+	TracingPartitionOpener.
+	"""
+	opener = TraceOpener(PartitionOpener())
+
+	if zip_member:
+		# Only imported when needed, zipfile is slow to import.
+		from liblp.zip_opener import ZipPartitionOpener
+
+		with ZipPartitionOpener(image) as zip_opener:
+			member_opener = TraceOpener(zip_opener)
+			metadata = ReadMetadata(zip_member, slot, member_opener)
+
+			offset = zip_opener.GetMemberOffset(zip_member)
+			if offset is None:
+				if used_only:
+					raise Exception(f"{zip_member} is compressed in {image}, extracting only "
+					                "the used data needs random access to the image.")
+
+				# Compressed, extract everything in one pass.
+				with member_opener.Open(zip_member, 'rb') as image_fd:
+					extractor = ImageExtractor(image_fd, metadata, partitions, output, bypass_cache,
+					                           jobs, chunk_size, used_only, streaming=True)
+					extractor.Extract()
+				return extractor.bytes_saved
 
-		extractor = ImageExtractor(image_fd, metadata, partitions, output)
+		# Stored, read straight from the archive.
+		with opener.Open(image, 'rb') as image_fd:
+			extractor = ImageExtractor(image_fd, metadata, partitions, output, bypass_cache,
+			                           jobs, chunk_size, used_only, offset)
+			extractor.Extract()
+		return extractor.bytes_saved
+
+	with opener.Open(image, 'rb') as image_fd:
+		metadata = ReadMetadata(image, slot, opener)
+
+		extractor = ImageExtractor(image_fd, metadata, partitions, output, bypass_cache,
+		                           jobs, chunk_size, used_only)
 		extractor.Extract()
 
+	return extractor.bytes_saved
+
 def main():
 	parser = ArgumentParser(description='command-line tool for extracting partition images from super')
 	parser.add_argument('image', help='Super image path', type=Path)
 	parser.add_argument('-o', '--output', help='Output directory (default is current dir)', type=Path, default=Path('.'))
 	parser.add_argument('-p', '--partition', help='Extract the named partition. This can be specified multiple times.', action='append')
 	parser.add_argument('-S', '--slot', help='Slot number (default is 0).', type=int, default=0)
+	parser.add_argument('--no-cache', help='Keep the super image and the extracted images out of the page cache.', action='store_true')
+	parser.add_argument('-j', '--jobs', help='Number of threads copying each partition (default is 1).', type=int, default=1)
+	parser.add_argument('--chunk-size', help=f'Size of the ranges copied by each thread, in bytes (default is {DEFAULT_CHUNK_SIZE}).', type=int, default=DEFAULT_CHUNK_SIZE)
+	parser.add_argument('-z', '--zip-member', help='Read the super image from this member of the zip archive IMAGE (default is super.img for .zip files).')
+	parser.add_argument('--used-only', help='Only copy the filesystem and AVB footer of each partition, leaving the rest as a hole.', action='store_true')
+	parser.add_argument('--trace', help='Print I/O statistics and the time spent parsing and extracting, plus a cProfile report with "profile".', nargs='?', const='timers', choices=['timers', 'profile'])
 	args = parser.parse_args()
 
-	lpunpack(args.image, args.output, args.partition, args.slot)
+	if args.chunk_size <= 0:
+		parser.error("--chunk-size must be positive")
+
+	zip_member = args.zip_member
+	if not zip_member and args.image.suffix == '.zip':
+		zip_member = 'super.img'
+
+	if zip_member:
+		# Only imported when needed, zipfile is slow to import.
+		from liblp.zip_opener import ZipPartitionOpener
+
+		with ZipPartitionOpener(args.image) as opener:
+			if args.used_only and opener.GetMemberOffset(zip_member) is None:
+				parser.error(f"--used-only needs random access to the image, "
+				             f"{zip_member} is compressed in {args.image}")
+			with opener.Open(zip_member, 'rb') as fd:
+				geometry = ReadLogicalPartitionGeometry(fd)
+	else:
+		with PartitionOpener().Open(args.image, 'rb') as fd:
+			geometry = ReadLogicalPartitionGeometry(fd)
+
+	if args.chunk_size % geometry.logical_block_size:
+		parser.error(f"--chunk-size must be a multiple of the logical block size "
+		             f"{geometry.logical_block_size}")
+
+	tracer = Tracer(profile=args.trace == 'profile') if args.trace else None
+	with tracer or nullcontext():
+		bytes_saved = lpunpack(args.image, args.output, args.partition, args.slot,
+		                       args.no_cache, args.jobs, args.chunk_size, args.used_only,
+		                       zip_member)
+	if tracer:
+		print(tracer.stats, file=sys.stderr)
+	if bytes_saved:
+		print(f"Shared extents: {bytes_saved} bytes read once for several partitions")
 
 if __name__ == '__main__':
 	main()
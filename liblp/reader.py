@@ -4,9 +4,10 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
-from ctypes import sizeof, c_uint8
+from ctypes import sizeof
 from hashlib import sha256
 from io import SEEK_SET, BufferedIOBase
+from typing import Callable, Tuple, TypeVar
 
 from liblp.include.metadata_format import (
 	LP_BLOCK_DEVICE_SLOT_SUFFIXED,
@@ -34,6 +35,7 @@ from liblp.include.metadata_format import (
 )
 from liblp.liblp import LpMetadata
 from liblp.partition_opener import IPartitionOpener, PartitionOpener
+from liblp.tracing import Traced
 from liblp.utility import (
 	GetMetadataSuperBlockDevice,
 	GetPrimaryGeometryOffset,
@@ -41,12 +43,37 @@ from liblp.utility import (
 	GetTotalMetadataSize,
 	GetPrimaryMetadataOffset,
 	GetBackupMetadataOffset,
+	ChecksumWithZeroedField,
 	SlotSuffixForSlotNumber,
 	UpdatePartitionName,
 	UpdateBlockDevicePartitionName,
 	UpdatePartitionGroupName,
 )
 
+class MemoryReader:
+	"""
+	File-like reader over an in-memory buffer. read() returns memoryview
+	slices of the buffer, so parsing does not copy the data.
+	"""
+	def __init__(self, buffer):
+		self.buffer = memoryview(buffer).cast('B')
+		self.position = 0
+
+	def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+		assert whence == SEEK_SET, "Only SEEK_SET is supported"
+		self.position = offset
+		return self.position
+
+	def tell(self) -> int:
+		return self.position
+
+	def read(self, size: int = -1) -> memoryview:
+		end = len(self.buffer) if size < 0 else self.position + size
+		data = self.buffer[self.position:end]
+		self.position += len(data)
+		return data
+
+@Traced("ParseGeometry")
 def ParseGeometry(buffer: bytes):
 	geometry = LpMetadataGeometry.from_buffer_copy(buffer)
 
@@ -61,9 +88,8 @@ def ParseGeometry(buffer: bytes):
 		"Logical partition metadata has unrecognized fields."
 
 	# Recompute and check the CRC32.
-	temp = LpMetadataGeometry.from_buffer_copy(bytes(geometry))
-	temp.checksum = (c_uint8*32)(0)
-	crc = sha256(bytes(temp)).digest()
+	crc = ChecksumWithZeroedField(memoryview(buffer)[:geometry.struct_size],
+	                              LpMetadataGeometry.checksum.offset)
 	assert crc == bytes(geometry.checksum), \
 		"Logical partition metadata has invalid geometry checksum."
 
@@ -105,9 +131,15 @@ def ValidateTableBounds(header: LpMetadataHeader, table: LpMetadataTableDescript
 	table_size = table.num_entries * table.entry_size
 	assert header.tables_size - table.offset >= table_size
 
+@Traced("ReadMetadataHeader")
 def ReadMetadataHeader(fd: BufferedIOBase) -> LpMetadataHeader:
-	header = LpMetadataHeader.from_buffer_copy(fd.read(sizeof(LpMetadataHeaderV1_0))
-		+ b'\x00' * (sizeof(LpMetadataHeader) - sizeof(LpMetadataHeaderV1_0)))
+	# Fields past LpMetadataHeaderV1_0 stay zeroed for older headers.
+	buffer = bytearray(sizeof(LpMetadataHeader))
+	data = fd.read(sizeof(LpMetadataHeaderV1_0))
+	assert len(data) == sizeof(LpMetadataHeaderV1_0), \
+		"Logical partition metadata header is truncated."
+	buffer[:len(data)] = data
+	header = LpMetadataHeader.from_buffer(buffer)
 
 	assert header.magic == LP_METADATA_HEADER_MAGIC, \
 		"Logical partition metadata has invalid magic value."
@@ -124,14 +156,15 @@ def ReadMetadataHeader(fd: BufferedIOBase) -> LpMetadataHeader:
 	# Read in any remaining fields, the last step needed before checksumming.
 	remaining_bytes = header.header_size - sizeof(LpMetadataHeaderV1_0)
 	if remaining_bytes:
-		header = LpMetadataHeader.from_buffer_copy(
-			bytes(header)[:sizeof(LpMetadataHeaderV1_0)] + fd.read(remaining_bytes))
-
-	# To compute the header's checksum, we have to temporarily set its checksum
-    # field to 0. Note that we must only compute up to |header_size|.
-	temp = LpMetadataHeader.from_buffer_copy(bytes(header))
-	temp.header_checksum = (c_uint8*32)(0)
-	crc = sha256(bytes(temp)[:header.header_size]).digest()
+		data = fd.read(remaining_bytes)
+		assert len(data) == remaining_bytes, \
+			"Logical partition metadata header is truncated."
+		buffer[sizeof(LpMetadataHeaderV1_0):header.header_size] = data
+
+	# The checksum is computed as if its field was 0, and only up to
+	# |header_size|.
+	crc = ChecksumWithZeroedField(memoryview(buffer)[:header.header_size],
+	                              LpMetadataHeader.header_checksum.offset)
 	assert crc == bytes(header.header_checksum), \
 		"Logical partition metadata has invalid checksum."
 
@@ -151,6 +184,25 @@ def ReadMetadataHeader(fd: BufferedIOBase) -> LpMetadataHeader:
 
 	return header
 
+def ReadMetadataTables(geometry: LpMetadataGeometry,
+                       fd: BufferedIOBase) -> Tuple[LpMetadataHeader, bytes]:
+	"""
+	Read and validate the metadata header and the raw contents of its tables.
+	"""
+	header = ReadMetadataHeader(fd)
+
+	assert header.tables_size <= geometry.metadata_max_size, \
+		"Invalid partition metadata header table size."
+
+	buffer = fd.read(header.tables_size)
+
+	checksum = sha256(buffer).digest()
+	assert checksum == bytes(header.tables_checksum), \
+		"Logical partition metadata has invalid table checksum."
+
+	return header, buffer
+
+@Traced("ParseMetadata")
 def ParseMetadata(geometry: LpMetadataGeometry, fd: BufferedIOBase) -> LpMetadata:
 	"""
 	Read and validate metadata information from a block device that holds
@@ -160,16 +212,7 @@ def ParseMetadata(geometry: LpMetadataGeometry, fd: BufferedIOBase) -> LpMetadat
 	metadata = LpMetadata()
 
 	metadata.geometry = geometry
-	metadata.header = ReadMetadataHeader(fd)
-
-	assert metadata.header.tables_size <= geometry.metadata_max_size, \
-		"Invalid partition metadata header table size."
-
-	buffer = fd.read(metadata.header.tables_size)
-
-	checksum = sha256(buffer).digest()
-	assert checksum == bytes(metadata.header.tables_checksum), \
-		"Logical partition metadata has invalid table checksum."
+	metadata.header, buffer = ReadMetadataTables(geometry, fd)
 
 	valid_attributes = LP_PARTITION_ATTRIBUTE_MASK_V0
 	if metadata.header.minor_version >= LP_METADATA_VERSION_FOR_UPDATED_ATTR:
@@ -240,6 +283,35 @@ def ReadBackupMetadata(fd: BufferedIOBase, geometry: LpMetadataGeometry,
 	fd.seek(offset, SEEK_SET)
 	return ParseMetadata(geometry, fd)
 
+T = TypeVar("T")
+
+def ReadMetadataCopies(fd: BufferedIOBase, geometry: LpMetadataGeometry, slot_number: int,
+                       parse: Callable[[LpMetadataGeometry, BufferedIOBase], T]) -> T:
+	"""
+	Parse the primary copy of the metadata of |slot_number| with |parse|, or
+	the backup copy if that fails. If both fail, the error of the primary
+	copy is raised.
+	"""
+	if slot_number >= geometry.metadata_slot_count:
+		raise Exception('invalid metadata slot number')
+
+	fd.seek(GetPrimaryMetadataOffset(geometry, slot_number), SEEK_SET)
+	try:
+		return parse(geometry, fd)
+	except Exception as primary_error:
+		fd.seek(GetBackupMetadataOffset(geometry, slot_number), SEEK_SET)
+		try:
+			return parse(geometry, fd)
+		except Exception:
+			raise primary_error
+
+def ReadUnadjustedMetadata(fd: BufferedIOBase, geometry: LpMetadataGeometry,
+                           slot_number: int) -> LpMetadata:
+	"""
+	Read the metadata of |slot_number| as stored, without applying the slot
+	suffix, e.g. to write it back after editing it.
+	"""
+	return ReadMetadataCopies(fd, geometry, slot_number, ParseMetadata)
 
 def AdjustMetadataForSlot(metadata: LpMetadata, slot_number: int):
 	slot_suffix = SlotSuffixForSlotNumber(slot_number)
@@ -265,36 +337,22 @@ def AdjustMetadataForSlot(metadata: LpMetadata, slot_number: int):
 		UpdatePartitionGroupName(group, group_name)
 		group.flags &= ~LP_GROUP_SLOT_SUFFIXED
 
-def ReadMetadata(super_partition: str, slot_number: int,
-                 opener: IPartitionOpener = None) -> LpMetadata:
-	if not opener:
-		opener = PartitionOpener()
-	
-	fd = opener.Open(super_partition, 'rb')
-
+def ReadMetadataFromFd(fd: BufferedIOBase, slot_number: int) -> LpMetadata:
 	geometry = ReadLogicalPartitionGeometry(fd)
-
-	if slot_number > geometry.metadata_slot_count:
-		raise Exception('invalid metadata slot number')
-	
-	offsets = [
-		GetPrimaryMetadataOffset(geometry, slot_number),
-        GetBackupMetadataOffset(geometry, slot_number),
-	]
-	metadata = None
-
-	for offset in offsets:
-		fd.seek(offset, SEEK_SET)
-		metadata = ParseMetadata(geometry, fd)
-		if metadata:
-			break
-
-	assert metadata, "Could not read metadata."
+	metadata = ReadMetadataCopies(fd, geometry, slot_number, ParseMetadata)
 
 	AdjustMetadataForSlot(metadata, slot_number)
 
 	return metadata
 
+def ReadMetadata(super_partition: str, slot_number: int,
+                 opener: IPartitionOpener = None) -> LpMetadata:
+	if not opener:
+		opener = PartitionOpener()
+
+	with opener.Open(super_partition, 'rb') as fd:
+		return ReadMetadataFromFd(fd, slot_number)
+
 def NameFromFixedArray(name: bytes) -> str:
 	return name.decode('ascii')
 
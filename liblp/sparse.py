@@ -0,0 +1,450 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Android sparse image format (libsparse) support.
+"""
+
+from bisect import bisect_right
+from io import SEEK_CUR, SEEK_END, SEEK_SET, BufferedIOBase
+import os
+from struct import Struct
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from liblp.utility import CopyFileRange
+
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+
+SPARSE_MAJOR_VERSION = 1
+SPARSE_MINOR_VERSION = 0
+
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+# magic, major_version, minor_version, file_hdr_sz, chunk_hdr_sz, blk_sz,
+# total_blks, total_chunks, image_checksum
+SPARSE_HEADER_STRUCT = Struct("<IHHHHIIII")
+# chunk_type, reserved1, chunk_sz (in blocks), total_sz (in bytes, header included)
+CHUNK_HEADER_STRUCT = Struct("<HHII")
+
+# Raw chunks are split so that their total size fits the 32-bit field.
+MAX_RAW_CHUNK_SIZE = 256 * 1024 * 1024
+
+def IsSparseImage(data: bytes) -> bool:
+	"""Return whether |data|, the start of an image, begins with a sparse header."""
+	return (len(data) >= SPARSE_HEADER_STRUCT.size
+	        and int.from_bytes(data[:4], "little") == SPARSE_HEADER_MAGIC)
+
+# Amount of data classified by a single task.
+CLASSIFY_WINDOW_SIZE = 4 * 1024 * 1024
+
+class BlockRun(NamedTuple):
+	"""Run-length encoded sequence of blocks that can be stored as one chunk."""
+	# CHUNK_TYPE_RAW or CHUNK_TYPE_FILL.
+	chunk_type: int
+	# Length of the run, in blocks.
+	blocks: int
+	# 4 bytes pattern of FILL runs.
+	fill: bytes = None
+
+def ClassifyBlocks(data: bytes, block_size: int) -> List[BlockRun]:
+	"""
+	Split block aligned |data| into RAW and FILL runs.
+
+	Comparing the first two words of a block rules out almost every RAW
+	block without copying it. Remaining candidates are compared against a
+	block made of their pattern, built once per pattern, with a single
+	memcmp() of bytes objects.
+	"""
+	assert len(data) % block_size == 0, "Data must be block aligned"
+	if not isinstance(data, bytes):
+		data = bytes(data)
+
+	fill_blocks: Dict[bytes, bytes] = {}
+	runs: List[BlockRun] = []
+
+	# Current run, a None pattern meaning RAW.
+	run_pattern: Optional[bytes] = None
+	run_blocks = 0
+
+	for offset in range(0, len(data), block_size):
+		pattern = data[offset:offset + 4]
+		if pattern == data[offset + 4:offset + 8]:
+			fill_block = fill_blocks.get(pattern)
+			if fill_block is None:
+				fill_block = fill_blocks[pattern] = pattern * (block_size // 4)
+			if data[offset:offset + block_size] != fill_block:
+				pattern = None
+		else:
+			pattern = None
+
+		if pattern != run_pattern and run_blocks:
+			runs.append(BlockRun(CHUNK_TYPE_RAW, run_blocks) if run_pattern is None
+			            else BlockRun(CHUNK_TYPE_FILL, run_blocks, run_pattern))
+			run_blocks = 0
+		run_pattern = pattern
+		run_blocks += 1
+
+	if run_blocks:
+		runs.append(BlockRun(CHUNK_TYPE_RAW, run_blocks) if run_pattern is None
+		            else BlockRun(CHUNK_TYPE_FILL, run_blocks, run_pattern))
+
+	return runs
+
+def ClassifyFileRange(path: str, offset: int, length: int, block_size: int) -> List[BlockRun]:
+	"""
+	Classify |length| bytes of |path| at |offset|. A partial last block is
+	padded with zeros. This reads the file itself so that pool workers only
+	exchange run descriptors with the caller.
+	"""
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		data = os.pread(fd, length, offset)
+	finally:
+		os.close(fd)
+
+	if len(data) != length:
+		raise Exception(f"Unexpected end of file in {path}")
+
+	padding = -length % block_size
+	if padding:
+		data += bytes(padding)
+
+	return ClassifyBlocks(data, block_size)
+
+def CreateClassifierPool(jobs: int):
+	"""
+	Create a pool of |jobs| processes for BlockClassifier and start its
+	workers right away, from the calling thread: forking them later from a
+	worker thread could copy locks held by other threads.
+	"""
+	# Only imported when needed, multiprocessing is slow to import.
+	from concurrent.futures import ProcessPoolExecutor
+
+	executor = ProcessPoolExecutor(jobs)
+	executor.submit(int).result()
+	return executor
+
+class BlockClassifier:
+	"""
+	Classify file ranges into RAW and FILL runs, distributing windows of
+	CLASSIFY_WINDOW_SIZE bytes across a pool of |jobs| processes (the
+	classification holds the GIL, so threads would not help). With a single
+	job, windows are classified in the calling process.
+
+	An existing pool from CreateClassifierPool() can be shared with
+	|executor|, it is not shut down by close().
+	"""
+	def __init__(self, block_size: int, jobs: int = None,
+	             window_size: int = CLASSIFY_WINDOW_SIZE, executor=None):
+		self.block_size = block_size
+		self.jobs = jobs or os.cpu_count() or 1
+		self.window_size = max(window_size // block_size, 1) * block_size
+
+		self.executor = executor
+		self.owns_executor = False
+		if not executor and self.jobs > 1:
+			self.executor = CreateClassifierPool(self.jobs)
+			self.owns_executor = True
+
+	def ClassifyFile(self, path: str, offset: int, length: int) -> Iterator[BlockRun]:
+		"""Yield the merged runs of a file range, in order."""
+		window_offsets = range(0, length, self.window_size)
+		args = (
+			[path] * len(window_offsets),
+			[offset + window_offset for window_offset in window_offsets],
+			[min(self.window_size, length - window_offset) for window_offset in window_offsets],
+			[self.block_size] * len(window_offsets),
+		)
+		if self.executor:
+			results = self.executor.map(ClassifyFileRange, *args)
+		else:
+			results = map(ClassifyFileRange, *args)
+
+		pending: Optional[BlockRun] = None
+		for runs in results:
+			for run in runs:
+				if pending and pending.chunk_type == run.chunk_type and pending.fill == run.fill:
+					pending = BlockRun(run.chunk_type, pending.blocks + run.blocks, run.fill)
+					continue
+				if pending:
+					yield pending
+				pending = run
+
+		if pending:
+			yield pending
+
+	def close(self):
+		if self.owns_executor:
+			self.executor.shutdown()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class SparseImageReader:
+	"""
+	Read-only, seekable view of the expanded contents of a sparse image.
+
+	Only the chunk headers are read when opening the image, data is read
+	from the underlying file on demand.
+	"""
+	def __init__(self, fd: BufferedIOBase):
+		self.fd = fd
+
+		fd.seek(0, SEEK_SET)
+		(magic, major_version, _, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks,
+		 total_chunks, _) = SPARSE_HEADER_STRUCT.unpack(fd.read(SPARSE_HEADER_STRUCT.size))
+
+		assert magic == SPARSE_HEADER_MAGIC, "Invalid sparse image magic."
+		assert major_version == SPARSE_MAJOR_VERSION, "Unsupported sparse image version."
+		assert chunk_hdr_sz >= CHUNK_HEADER_STRUCT.size, "Invalid sparse chunk header size."
+
+		self.block_size = blk_sz
+		self.size = total_blks * blk_sz
+
+		# Expanded start offset, type, length and payload of every chunk. The
+		# payload is the offset of the data in the sparse file for RAW chunks,
+		# and the pattern for FILL chunks.
+		self.starts: List[int] = []
+		self.types: List[int] = []
+		self.lengths: List[int] = []
+		self.payloads: List[object] = []
+
+		position = file_hdr_sz
+		start = 0
+		for _ in range(total_chunks):
+			fd.seek(position, SEEK_SET)
+			chunk_type, _, chunk_sz, total_sz = \
+				CHUNK_HEADER_STRUCT.unpack(fd.read(CHUNK_HEADER_STRUCT.size))
+			data_offset = position + chunk_hdr_sz
+			length = chunk_sz * blk_sz
+
+			if chunk_type == CHUNK_TYPE_RAW:
+				assert total_sz - chunk_hdr_sz == length, "Invalid sparse raw chunk size."
+				payload = data_offset
+			elif chunk_type == CHUNK_TYPE_FILL:
+				fd.seek(data_offset, SEEK_SET)
+				payload = fd.read(4)
+			elif chunk_type == CHUNK_TYPE_DONT_CARE:
+				payload = None
+			elif chunk_type == CHUNK_TYPE_CRC32:
+				position += total_sz
+				continue
+			else:
+				raise Exception(f"Unknown sparse chunk type: {chunk_type:#x}")
+
+			if length:
+				self.starts.append(start)
+				self.types.append(chunk_type)
+				self.lengths.append(length)
+				self.payloads.append(payload)
+
+			start += length
+			position += total_sz
+
+		assert start == self.size, "Sparse image chunks do not cover the whole image."
+
+		self.position = 0
+
+	def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+		if whence == SEEK_CUR:
+			offset += self.position
+		elif whence == SEEK_END:
+			offset += self.size
+		assert offset >= 0, "Negative seek position"
+		self.position = offset
+		return self.position
+
+	def tell(self) -> int:
+		return self.position
+
+	def read(self, size: int = -1) -> bytes:
+		if size < 0 or self.position + size > self.size:
+			size = max(self.size - self.position, 0)
+
+		data = bytearray()
+		index = bisect_right(self.starts, self.position) - 1
+		while size:
+			chunk_offset = self.position - self.starts[index]
+			length = min(size, self.lengths[index] - chunk_offset)
+			chunk_type = self.types[index]
+
+			if chunk_type == CHUNK_TYPE_RAW:
+				self.fd.seek(self.payloads[index] + chunk_offset, SEEK_SET)
+				data += self.fd.read(length)
+			elif chunk_type == CHUNK_TYPE_FILL:
+				# Chunk lengths are multiples of the block size, so the pattern
+				# phase only depends on the offset inside the chunk.
+				phase = chunk_offset % 4
+				pattern = self.payloads[index]
+				data += (pattern * ((length + phase) // 4 + 1))[phase:phase + length]
+			else:
+				data += bytes(length)
+
+			self.position += length
+			size -= length
+			index += 1
+
+		return bytes(data)
+
+	def close(self):
+		self.fd.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class SparseImageWriter:
+	"""
+	Streaming sparse image writer.
+
+	Chunks are written as they are added, adjacent chunks of the same type
+	(and pattern, for FILL chunks) are merged. The file header is written
+	last, once the number of chunks is known, so |fd| must be seekable.
+	"""
+	def __init__(self, fd: BufferedIOBase, block_size: int, total_blocks: int):
+		assert block_size % 4 == 0, "Block size must be a multiple of 4"
+
+		self.fd = fd
+		self.block_size = block_size
+		self.total_blocks = total_blocks
+
+		self.blocks = 0
+		self.chunks = 0
+
+		# Chunk being built.
+		self.chunk_type: Optional[int] = None
+		self.chunk_blocks = 0
+		self.chunk_fill: Optional[bytes] = None
+		self.chunk_offset = 0
+
+		self.fd.seek(0, SEEK_SET)
+		self.fd.write(bytes(SPARSE_HEADER_STRUCT.size))
+
+	def FlushChunk(self):
+		if self.chunk_type is None:
+			return
+
+		if self.chunk_type == CHUNK_TYPE_RAW:
+			# The data has already been written after a placeholder header.
+			position = self.fd.tell()
+			self.fd.seek(self.chunk_offset, SEEK_SET)
+			self.fd.write(CHUNK_HEADER_STRUCT.pack(
+				CHUNK_TYPE_RAW, 0, self.chunk_blocks,
+				CHUNK_HEADER_STRUCT.size + self.chunk_blocks * self.block_size))
+			self.fd.seek(position, SEEK_SET)
+		elif self.chunk_type == CHUNK_TYPE_FILL:
+			self.fd.write(CHUNK_HEADER_STRUCT.pack(
+				CHUNK_TYPE_FILL, 0, self.chunk_blocks, CHUNK_HEADER_STRUCT.size + 4))
+			self.fd.write(self.chunk_fill)
+		else:
+			self.fd.write(CHUNK_HEADER_STRUCT.pack(
+				CHUNK_TYPE_DONT_CARE, 0, self.chunk_blocks, CHUNK_HEADER_STRUCT.size))
+
+		self.chunks += 1
+		self.chunk_type = None
+		self.chunk_blocks = 0
+		self.chunk_fill = None
+
+	def StartChunk(self, chunk_type: int, fill: bytes = None):
+		if self.chunk_type == chunk_type and self.chunk_fill == fill:
+			return
+		self.FlushChunk()
+		self.chunk_type = chunk_type
+		self.chunk_fill = fill
+		if chunk_type == CHUNK_TYPE_RAW:
+			self.chunk_offset = self.fd.tell()
+			self.fd.write(bytes(CHUNK_HEADER_STRUCT.size))
+
+	def AddRaw(self, data: bytes):
+		assert len(data) % self.block_size == 0, "Raw data must be block aligned"
+		max_blocks = MAX_RAW_CHUNK_SIZE // self.block_size
+		data = memoryview(data)
+		while data:
+			self.StartChunk(CHUNK_TYPE_RAW)
+			blocks = min(len(data) // self.block_size, max_blocks - self.chunk_blocks)
+			if not blocks:
+				self.FlushChunk()
+				continue
+			length = blocks * self.block_size
+			self.fd.write(data[:length])
+			data = data[length:]
+			self.chunk_blocks += blocks
+			self.blocks += blocks
+
+	def AddFill(self, pattern: bytes, blocks: int):
+		if blocks:
+			self.StartChunk(CHUNK_TYPE_FILL, bytes(pattern))
+			self.chunk_blocks += blocks
+			self.blocks += blocks
+
+	def AddDontCare(self, blocks: int):
+		if blocks:
+			self.StartChunk(CHUNK_TYPE_DONT_CARE)
+			self.chunk_blocks += blocks
+			self.blocks += blocks
+
+	def AddData(self, data: bytes):
+		"""
+		Add block aligned data, storing every block as either RAW or FILL
+		depending on its contents.
+		"""
+		data = bytes(data)
+		offset = 0
+		for run in ClassifyBlocks(data, self.block_size):
+			length = run.blocks * self.block_size
+			if run.chunk_type == CHUNK_TYPE_RAW:
+				self.AddRaw(data[offset:offset + length])
+			else:
+				self.AddFill(run.fill, run.blocks)
+			offset += length
+
+	def AddRawFromFile(self, in_fd: int, offset: int, length: int, blocks: int):
+		"""
+		Add |blocks| RAW blocks whose first |length| bytes are read from
+		|in_fd| at |offset|, the rest being zeros. Data is copied to the
+		output file by the kernel where possible.
+		"""
+		max_blocks = MAX_RAW_CHUNK_SIZE // self.block_size
+		while blocks:
+			self.StartChunk(CHUNK_TYPE_RAW)
+			count = min(blocks, max_blocks - self.chunk_blocks)
+			if not count:
+				self.FlushChunk()
+				continue
+
+			size = count * self.block_size
+			copy = min(length, size)
+			self.fd.flush()
+			position = self.fd.tell()
+			CopyFileRange(in_fd, self.fd.fileno(), copy, offset, position)
+			self.fd.seek(position + copy, SEEK_SET)
+			if size > copy:
+				self.fd.write(bytes(size - copy))
+
+			offset += copy
+			length -= copy
+			blocks -= count
+			self.chunk_blocks += count
+			self.blocks += count
+
+	def Finish(self):
+		self.FlushChunk()
+		assert self.blocks == self.total_blocks, \
+			f"Sparse image has {self.blocks} blocks, expected {self.total_blocks}"
+
+		self.fd.seek(0, SEEK_SET)
+		self.fd.write(SPARSE_HEADER_STRUCT.pack(
+			SPARSE_HEADER_MAGIC, SPARSE_MAJOR_VERSION, SPARSE_MINOR_VERSION,
+			SPARSE_HEADER_STRUCT.size, CHUNK_HEADER_STRUCT.size, self.block_size,
+			self.total_blocks, self.chunks, 0))
+		self.fd.seek(0, SEEK_END)
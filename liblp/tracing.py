@@ -0,0 +1,263 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+I/O tracing and profiling hooks.
+
+TracingPartitionOpener counts the calls, bytes and latency of the file
+objects it opens. Functions decorated with Traced() are timed while a
+Tracer is active, and optionally profiled with cProfile. When no Tracer
+is active, a traced function costs one extra call.
+
+Reads done on raw descriptors (os.pread(), copy_file_range()) bypass the
+file objects, they only show up in the timers of their caller.
+
+cProfile and pstats are only imported when profiling, since the reader
+imports this module.
+"""
+
+from functools import wraps
+from io import BufferedIOBase, SEEK_SET, StringIO
+from threading import Lock, current_thread, local
+from time import perf_counter
+from typing import Callable, Dict, Optional
+
+from liblp.partition_opener import BlockDeviceInfo, IPartitionOpener
+
+class LatencyHistogram:
+	"""Call latencies, in power of two microsecond buckets."""
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.bytes = 0
+		# Bucket index i counts calls of less than 2^i microseconds.
+		self.buckets: Dict[int, int] = {}
+
+	def Add(self, seconds: float, size: int = 0):
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+		self.bytes += size
+		bucket = int(seconds * 1e6).bit_length()
+		self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+	def Percentile(self, percent: float) -> float:
+		"""Return an upper bound of the |percent| percentile, in seconds."""
+		remaining = self.count * percent / 100
+		for bucket in sorted(self.buckets):
+			remaining -= self.buckets[bucket]
+			if remaining <= 0:
+				return (1 << bucket) / 1e6
+		return self.max
+
+	def ToDict(self) -> dict:
+		return {
+			"count": self.count,
+			"total": self.total,
+			"max": self.max,
+			"bytes": self.bytes,
+			"buckets_us": {1 << bucket: count for bucket, count in sorted(self.buckets.items())},
+		}
+
+	def __str__(self):
+		line = (f"{self.count:>8} calls {self.total * 1e3:>10.3f} ms"
+		        f"  p50 <{self.Percentile(50) * 1e6:.0f} us"
+		        f"  p99 <{self.Percentile(99) * 1e6:.0f} us"
+		        f"  max {self.max * 1e6:.0f} us")
+		if self.bytes:
+			line += f"  {self.bytes} bytes"
+		return line
+
+class TraceStats:
+	"""
+	Statistics collected by a Tracer: I/O calls on traced files by
+	operation, and calls of traced functions by name.
+	"""
+	def __init__(self):
+		self.lock = Lock()
+		self.io: Dict[str, LatencyHistogram] = {}
+		self.calls: Dict[str, LatencyHistogram] = {}
+		# pstats.Stats of the profiled calls.
+		self.profile = None
+
+	def Add(self, table: Dict[str, LatencyHistogram], name: str, seconds: float, size: int = 0):
+		with self.lock:
+			histogram = table.get(name)
+			if not histogram:
+				histogram = table[name] = LatencyHistogram()
+			histogram.Add(seconds, size)
+
+	def AddIo(self, operation: str, seconds: float, size: int = 0):
+		self.Add(self.io, operation, seconds, size)
+
+	def AddCall(self, name: str, seconds: float):
+		self.Add(self.calls, name, seconds)
+
+	def ToDict(self) -> dict:
+		return {
+			"io": {name: histogram.ToDict() for name, histogram in self.io.items()},
+			"calls": {name: histogram.ToDict() for name, histogram in self.calls.items()},
+		}
+
+	def Report(self, profile_entries: int = 25) -> str:
+		lines = ["I/O:"]
+		lines.extend(f"  {name:<32}{histogram}" for name, histogram in sorted(self.io.items()))
+		lines.append("Calls:")
+		lines.extend(f"  {name:<32}{histogram}" for name, histogram in sorted(self.calls.items()))
+
+		if self.profile:
+			from pstats import SortKey
+
+			output = StringIO()
+			self.profile.stream = output
+			self.profile.sort_stats(SortKey.TIME).print_stats(profile_entries)
+			lines.append("Profile:")
+			lines.append(output.getvalue().rstrip())
+
+		return "\n".join(lines)
+
+	def __str__(self):
+		return self.Report()
+
+class Tracer:
+	"""
+	Context manager enabling the Traced() hooks. With |profile|, the
+	outermost traced calls of the thread that created the tracer also run
+	under cProfile, results end up in |stats|.profile.
+	"""
+	def __init__(self, stats: TraceStats = None, profile: bool = False):
+		self.stats = stats or TraceStats()
+		self.profiler = None
+		if profile:
+			from cProfile import Profile
+			self.profiler = Profile()
+		self.thread = current_thread()
+		self.local = local()
+		self.previous: Optional[Tracer] = None
+
+	def Call(self, name: str, function: Callable, args: tuple, kwargs: dict):
+		depth = getattr(self.local, "depth", 0)
+		profile = self.profiler and not depth and current_thread() is self.thread
+
+		self.local.depth = depth + 1
+		if profile:
+			self.profiler.enable()
+		start = perf_counter()
+		try:
+			return function(*args, **kwargs)
+		finally:
+			elapsed = perf_counter() - start
+			if profile:
+				self.profiler.disable()
+			self.local.depth = depth
+			self.stats.AddCall(name, elapsed)
+
+	def __enter__(self) -> "Tracer":
+		global _tracer
+		self.previous = _tracer
+		_tracer = self
+		return self
+
+	def __exit__(self, *args):
+		global _tracer
+		_tracer = self.previous
+		if self.profiler:
+			from pstats import Stats
+
+			profile = Stats(self.profiler)
+			if self.stats.profile:
+				self.stats.profile.add(profile)
+			else:
+				self.stats.profile = profile
+
+_tracer: Optional[Tracer] = None
+
+def GetTracer() -> Optional[Tracer]:
+	return _tracer
+
+def Traced(name: str):
+	"""Decorator timing calls of the function as |name| while a Tracer is active."""
+	def Decorator(function: Callable) -> Callable:
+		@wraps(function)
+		def Wrapper(*args, **kwargs):
+			tracer = _tracer
+			if tracer is None:
+				return function(*args, **kwargs)
+			return tracer.Call(name, function, args, kwargs)
+		return Wrapper
+	return Decorator
+
+class TracedFile:
+	"""File object wrapper recording its calls in |stats|."""
+	def __init__(self, file: BufferedIOBase, stats: TraceStats):
+		self.file = file
+		self.stats = stats
+
+	def read(self, size: int = -1) -> bytes:
+		start = perf_counter()
+		data = self.file.read(size)
+		self.stats.AddIo("read", perf_counter() - start, len(data))
+		return data
+
+	def readinto(self, buffer) -> int:
+		start = perf_counter()
+		count = self.file.readinto(buffer)
+		self.stats.AddIo("readinto", perf_counter() - start, count or 0)
+		return count
+
+	def write(self, data: bytes) -> int:
+		start = perf_counter()
+		count = self.file.write(data)
+		self.stats.AddIo("write", perf_counter() - start, count or 0)
+		return count
+
+	def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+		start = perf_counter()
+		position = self.file.seek(offset, whence)
+		self.stats.AddIo("seek", perf_counter() - start)
+		return position
+
+	def close(self):
+		start = perf_counter()
+		self.file.close()
+		self.stats.AddIo("close", perf_counter() - start)
+
+	def __getattr__(self, name: str):
+		return getattr(self.file, name)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class TracingPartitionOpener(IPartitionOpener):
+	"""IPartitionOpener wrapper tracing |opener| and the files it opens."""
+	def __init__(self, opener: IPartitionOpener, stats: TraceStats):
+		self.opener = opener
+		self.stats = stats
+
+	def Open(self, partition_name: str, flags: int) -> BufferedIOBase:
+		start = perf_counter()
+		file = self.opener.Open(partition_name, flags)
+		self.stats.AddIo("open", perf_counter() - start)
+		return TracedFile(file, self.stats)
+
+	def GetInfo(self, partition_name: str) -> BlockDeviceInfo:
+		start = perf_counter()
+		info = self.opener.GetInfo(partition_name)
+		self.stats.AddIo("get_info", perf_counter() - start)
+		return info
+
+	def GetDeviceString(self, partition_name: str) -> str:
+		return self.opener.GetDeviceString(partition_name)
+
+def TraceOpener(opener: IPartitionOpener) -> IPartitionOpener:
+	"""Return |opener| wrapped in a TracingPartitionOpener if a Tracer is active."""
+	tracer = _tracer
+	if tracer is None:
+		return opener
+	return TracingPartitionOpener(opener, tracer.stats)
@@ -5,19 +5,94 @@
 #
 
 from ctypes import sizeof
+from errno import EINVAL, ENOSYS, EOPNOTSUPP, EXDEV
+from fcntl import F_GETFL, F_SETFL, fcntl
+from hashlib import sha256
 from io import BufferedIOBase
+import os
 from typing import List
 
 from liblp.include.metadata_format import (
 	LP_METADATA_GEOMETRY_SIZE,
+	LP_METADATA_MINOR_VERSION_MIN,
+	LP_PARTITION_ATTRIBUTE_MASK_V0,
 	LP_PARTITION_RESERVED_BYTES,
+	LP_SECTOR_SIZE,
 	LpMetadataBlockDevice,
 	LpMetadataGeometry,
+	LpMetadataHeader,
+	LpMetadataHeaderV1_0,
 	LpMetadataPartition,
 	LpMetadataPartitionGroup,
 )
 from liblp.liblp import LpMetadata
 
+# Size of a SHA256 checksum field.
+CHECKSUM_SIZE = 32
+
+# Size of the bounce buffer used when a kernel-side copy is not possible.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def CopyFileRange(in_fd: int, out_fd: int, count: int, in_offset: int, out_offset: int):
+	"""
+	Copy |count| bytes from |in_fd| at |in_offset| to |out_fd| at |out_offset|.
+	copy_file_range(2) is used when available, which lets the kernel (or the
+	filesystem, with reflinks) do the copy; otherwise data goes through a
+	fixed size buffer with positional reads and writes. File positions are
+	left untouched.
+	"""
+	copy_file_range = getattr(os, "copy_file_range", None)
+	while count and copy_file_range:
+		try:
+			copied = copy_file_range(in_fd, out_fd, count, in_offset, out_offset)
+		except OSError as e:
+			if e.errno not in (EINVAL, ENOSYS, EOPNOTSUPP, EXDEV):
+				raise
+			break
+		if not copied:
+			raise Exception("Unexpected end of file while copying")
+		count -= copied
+		in_offset += copied
+		out_offset += copied
+
+	if not count:
+		return
+
+	buffer = memoryview(bytearray(min(count, COPY_BUFFER_SIZE)))
+	while count:
+		read = os.preadv(in_fd, [buffer[:min(count, len(buffer))]], in_offset)
+		if not read:
+			raise Exception("Unexpected end of file while copying")
+		written = 0
+		while written < read:
+			written += os.pwrite(out_fd, buffer[written:read], out_offset + written)
+		count -= read
+		in_offset += read
+		out_offset += read
+
+def WriteFully(fd: int, offset: int, data: bytes):
+	data = memoryview(data)
+	written = 0
+	while written < len(data):
+		written += os.pwrite(fd, data[written:], offset + written)
+
+def SetDirectIo(fd: int, enable: bool) -> bool:
+	"""
+	Turn O_DIRECT on or off for |fd|. Return whether it is now enabled,
+	which is not the case on filesystems that don't support it.
+	"""
+	if not hasattr(os, "O_DIRECT"):
+		return False
+
+	flags = fcntl(fd, F_GETFL)
+	try:
+		fcntl(fd, F_SETFL, flags | os.O_DIRECT if enable else flags & ~os.O_DIRECT)
+	except OSError as e:
+		if e.errno != EINVAL:
+			raise
+		return False
+	return enable
+
 def GetDescriptorSize(fd: BufferedIOBase, size: int):
 	raise NotImplementedError
 
@@ -43,11 +118,28 @@ def GetTotalMetadataSize(metadata_max_size: int, max_slots: int) -> int:
 	return (LP_PARTITION_RESERVED_BYTES +
 	        (LP_METADATA_GEOMETRY_SIZE + metadata_max_size * max_slots) * 2)
 
+def AlignTo(base: int, alignment: int, alignment_offset: int = 0) -> int:
+	"""
+	Round |base| up to the next multiple of |alignment|, shifted by
+	|alignment_offset|. An |alignment| of 0 leaves |base| untouched.
+	"""
+	if not alignment:
+		return base
+	aligned = (base + alignment - 1) // alignment * alignment + alignment_offset
+	if aligned - alignment >= base:
+		# We overaligned (base < alignment_offset).
+		return aligned - alignment
+	return aligned
+
 def GetMetadataSuperBlockDevice(metadata: LpMetadata) -> LpMetadataBlockDevice:
 	return metadata.block_devices[0]
 
 def SlotNumberForSlotSuffix(suffix: str) -> int:
-	raise NotImplementedError
+	if suffix in ("", "a", "_a"):
+		return 0
+	if suffix in ("b", "_b"):
+		return 1
+	raise Exception(f"slot '{suffix}' does not have a recognized format.")
 
 def GetTotalSuperPartitionSize(metadata: LpMetadata) -> int:
 	raise NotImplementedError
@@ -59,10 +151,17 @@ def FindPartition(metadata: LpMetadata, name: str) -> LpMetadataPartition:
 	raise NotImplementedError
 
 def GetPartitionSize(metadata: LpMetadata, partition: LpMetadataPartition) -> int:
-	raise NotImplementedError
+	total_size = 0
+	for i in range(partition.num_extents):
+		extent = metadata.extents[partition.first_extent_index + i]
+		total_size += extent.num_sectors * LP_SECTOR_SIZE
+	return total_size
 
 def GetPartitionSlotSuffix(partition_name: str) -> str:
-	raise NotImplementedError
+	if len(partition_name) <= 2:
+		return ""
+	suffix = partition_name[-2:]
+	return suffix if suffix in ("_a", "_b") else ""
 
 def SlotSuffixForSlotNumber(slot_number: int) -> str:
 	assert slot_number in [0, 1], \
@@ -95,4 +194,27 @@ def ToHexString(value: int):
 	raise NotImplementedError
 
 def SetMetadataHeaderV0(metadata: LpMetadata):
-	raise NotImplementedError
+	if metadata.header.minor_version <= LP_METADATA_MINOR_VERSION_MIN:
+		return
+
+	metadata.header.minor_version = LP_METADATA_MINOR_VERSION_MIN
+	metadata.header.header_size = sizeof(LpMetadataHeaderV1_0)
+
+	# Zero out all fields beyond LpMetadataHeaderV1_0, flags included.
+	zeroes = bytes(sizeof(LpMetadataHeader) - sizeof(LpMetadataHeaderV1_0))
+	memoryview(metadata.header).cast('B')[sizeof(LpMetadataHeaderV1_0):] = zeroes
+
+	# Clear partition attributes unknown to V0.
+	for partition in metadata.partitions:
+		partition.attributes &= LP_PARTITION_ATTRIBUTE_MASK_V0
+
+def ChecksumWithZeroedField(buffer: bytes, field_offset: int) -> bytes:
+	"""
+	Return the SHA256 of |buffer| as if the 32 bytes checksum field at
+	|field_offset| were zero, without copying |buffer|.
+	"""
+	view = memoryview(buffer)
+	checksum = sha256(view[:field_offset])
+	checksum.update(bytes(CHECKSUM_SIZE))
+	checksum.update(view[field_offset + CHECKSUM_SIZE:])
+	return checksum.digest()
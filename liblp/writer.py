@@ -4,13 +4,397 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
-from liblp.partition_opener import IPartitionOpener
+from ctypes import sizeof
+from errno import EINVAL
+from hashlib import sha256
+from mmap import mmap
+import os
+from typing import List, Tuple
+
+from liblp.include.metadata_format import (
+	LP_BLOCK_DEVICE_SLOT_SUFFIXED,
+	LP_METADATA_GEOMETRY_SIZE,
+	LP_PARTITION_RESERVED_BYTES,
+	LP_METADATA_VERSION_FOR_EXPANDED_HEADER,
+	LP_SECTOR_SIZE,
+	LP_TARGET_TYPE_LINEAR,
+	LpMetadataBlockDevice,
+	LpMetadataExtent,
+	LpMetadataGeometry,
+	LpMetadataHeader,
+	LpMetadataHeaderV1_0,
+	LpMetadataPartition,
+	LpMetadataPartitionGroup,
+)
+from liblp.partition_opener import IPartitionOpener, PartitionOpener
 from liblp.liblp import LpMetadata
+from liblp.reader import (
+	GetBlockDevicePartitionName,
+	MemoryReader,
+	ParseGeometry,
+	ParseMetadata,
+	ReadLogicalPartitionGeometry,
+)
+from liblp.utility import (
+	CHECKSUM_SIZE,
+	ChecksumWithZeroedField,
+	GetBackupGeometryOffset,
+	GetBackupMetadataOffset,
+	GetMetadataSuperBlockDevice,
+	GetPartitionSlotSuffix,
+	GetPrimaryGeometryOffset,
+	GetPrimaryMetadataOffset,
+	GetTotalMetadataSize,
+	SetDirectIo,
+	SlotSuffixForSlotNumber,
+)
+
+def SerializeGeometry(input: LpMetadataGeometry) -> bytes:
+	buffer = bytearray(LP_METADATA_GEOMETRY_SIZE)
+	buffer[:sizeof(input)] = bytes(input)
+	offset = LpMetadataGeometry.checksum.offset
+	buffer[offset:offset + CHECKSUM_SIZE] = \
+		ChecksumWithZeroedField(memoryview(buffer)[:sizeof(input)], offset)
+	return bytes(buffer)
+
+class MetadataSerializer:
+	"""
+	Serialize LpMetadata into a single buffer: the header (V1.0 or V1.2, as
+	specified by |header_size|) is followed by the partition, extent, group
+	and block device tables. Both checksums are computed over the buffer in
+	place.
+
+	The buffer is kept and reused by the following calls, it only gets
+	reallocated when a bigger one is needed.
+	"""
+	def __init__(self, size: int = 0):
+		self.buffer = bytearray(size)
+
+	def Serialize(self, input: LpMetadata) -> memoryview:
+		"""
+		Return a view of the serialized metadata. The view is only valid
+		until the next call, copy it with bytes() to keep it around.
+		"""
+		header_size = input.header.header_size
+		if input.header.minor_version < LP_METADATA_VERSION_FOR_EXPANDED_HEADER:
+			assert header_size == sizeof(LpMetadataHeaderV1_0), \
+				"Invalid partition metadata header struct size."
+		else:
+			assert header_size == sizeof(LpMetadataHeader), \
+				"Invalid partition metadata header struct size."
+
+		tables = [
+			(input.partitions, sizeof(LpMetadataPartition)),
+			(input.extents, sizeof(LpMetadataExtent)),
+			(input.groups, sizeof(LpMetadataPartitionGroup)),
+			(input.block_devices, sizeof(LpMetadataBlockDevice)),
+		]
+		tables_size = sum(len(entries) * entry_size for entries, entry_size in tables)
+		total_size = header_size + tables_size
+
+		if len(self.buffer) < total_size:
+			self.buffer = bytearray(total_size)
+		buffer = self.buffer
+
+		# Lay out the header first, then fill in the table descriptors.
+		buffer[:header_size] = memoryview(input.header).cast('B')[:header_size]
+		header = LpMetadataHeaderV1_0.from_buffer(buffer)
+		descriptors = [header.partitions, header.extents, header.groups, header.block_devices]
+
+		offset = 0
+		for descriptor, (entries, entry_size) in zip(descriptors, tables):
+			descriptor.offset = offset
+			descriptor.num_entries = len(entries)
+			descriptor.entry_size = entry_size
+
+			# Joining the entries is faster than copying them one at a time.
+			size = len(entries) * entry_size
+			start = header_size + offset
+			buffer[start:start + size] = b"".join(map(bytes, entries))
+			offset += size
+
+		header.tables_size = tables_size
+		view = memoryview(buffer)[:total_size]
+
+		# Compute payload checksum.
+		checksum_offset = LpMetadataHeader.tables_checksum.offset
+		view[checksum_offset:checksum_offset + CHECKSUM_SIZE] = \
+			sha256(view[header_size:]).digest()
+
+		# Compute header checksum.
+		checksum_offset = LpMetadataHeader.header_checksum.offset
+		view[checksum_offset:checksum_offset + CHECKSUM_SIZE] = \
+			ChecksumWithZeroedField(view[:header_size], checksum_offset)
+
+		return view
+
+def SerializeMetadata(input: LpMetadata) -> bytes:
+	return bytes(MetadataSerializer().Serialize(input))
+
+def CompareGeometry(g1: LpMetadataGeometry, g2: LpMetadataGeometry) -> bool:
+	return (g1.metadata_max_size == g2.metadata_max_size
+	        and g1.metadata_slot_count == g2.metadata_slot_count
+	        and g1.logical_block_size == g2.logical_block_size)
+
+def ValidateAndSerializeMetadata(opener: IPartitionOpener, metadata: LpMetadata,
+                                 slot_suffix: str, super_partition: str = None) -> bytes:
+	"""
+	Perform checks so we don't accidentally overwrite valid metadata with
+	potentially invalid metadata, or random partition data with metadata.
+	|super_partition|, if given, is opened in place of the super block
+	device, e.g. an image file not named after it.
+	"""
+	geometry = metadata.geometry
+
+	blob = SerializeMetadata(metadata)
+
+	# Make sure we're writing within the space reserved.
+	assert len(blob) <= geometry.metadata_max_size, \
+		f"Logical partition metadata is too large. {len(blob)} > {geometry.metadata_max_size}"
+
+	# Make sure the device has enough space to store two backup copies of the
+	# metadata.
+	reserved_size = LP_METADATA_GEOMETRY_SIZE + geometry.metadata_max_size * geometry.metadata_slot_count
+	total_reserved = LP_PARTITION_RESERVED_BYTES + reserved_size * 2
+
+	assert metadata.block_devices, \
+		"Logical partition metadata does not have a super block device."
+	super_device = GetMetadataSuperBlockDevice(metadata)
+
+	assert total_reserved <= super_device.first_logical_sector * LP_SECTOR_SIZE, \
+		"Not enough space to store all logical partition metadata slots."
+
+	for block_device in metadata.block_devices:
+		partition_name = GetBlockDevicePartitionName(block_device)
+		if block_device.flags & LP_BLOCK_DEVICE_SLOT_SUFFIXED:
+			assert slot_suffix, \
+				(f"Block device {partition_name} requires a slot suffix, which could not "
+				 "be derived from the super partition name.")
+			partition_name += slot_suffix
+
+		assert (block_device.first_logical_sector + 1) * LP_SECTOR_SIZE <= block_device.size, \
+			(f"Block device {partition_name} has invalid first sector "
+			 f"{block_device.first_logical_sector} for size {block_device.size}")
+
+		if super_partition and block_device is super_device:
+			info = opener.GetInfo(super_partition)
+		else:
+			info = opener.GetInfo(partition_name)
+		assert info, f"Could not get block device info for {partition_name}"
+		assert info.size == block_device.size, \
+			(f"Block device {partition_name} size mismatch (expected "
+			 f"{block_device.size}, got {info.size})")
+
+	# Make sure all partition entries reference valid extents.
+	for partition in metadata.partitions:
+		assert partition.first_extent_index + partition.num_extents <= len(metadata.extents), \
+			"Partition references invalid extent."
+
+	# Make sure all linear extents have a valid range.
+	last_sector = super_device.size // LP_SECTOR_SIZE
+	for extent in metadata.extents:
+		if extent.target_type == LP_TARGET_TYPE_LINEAR:
+			physical_sector = extent.target_data
+			assert (physical_sector >= super_device.first_logical_sector
+			        and physical_sector + extent.num_sectors <= last_sector), \
+				"Extent table entry is out of bounds."
+
+	return blob
+
+def GetDirtySectorRanges(new: bytes, old: bytes) -> List[Tuple[int, int]]:
+	"""
+	Return the (offset, length) byte ranges of the sectors that differ
+	between two buffers of the same size, adjacent sectors being coalesced.
+	"""
+	ranges: List[Tuple[int, int]] = []
+	for offset in range(0, len(new), LP_SECTOR_SIZE):
+		end = offset + LP_SECTOR_SIZE
+		if new[offset:end] == old[offset:end]:
+			continue
+		if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+			ranges[-1] = (ranges[-1][0], ranges[-1][1] + LP_SECTOR_SIZE)
+		else:
+			ranges.append((offset, LP_SECTOR_SIZE))
+
+	return ranges
+
+def WriteMetadataCopy(fd: int, offset: int, blob: bytes) -> int:
+	"""
+	Write a metadata copy at |offset|, only touching the sectors whose
+	contents change, then flush it to storage. Bytes past the end of |blob|
+	in its last sector are preserved. Return the number of bytes written.
+	"""
+	length = (len(blob) + LP_SECTOR_SIZE - 1) // LP_SECTOR_SIZE * LP_SECTOR_SIZE
+	old = os.pread(fd, length, offset)
+	if len(old) != length:
+		raise Exception("Unexpected end of file while reading metadata")
+
+	new = blob + old[len(blob):]
+	written = 0
+	for range_offset, range_length in GetDirtySectorRanges(new, old):
+		data = memoryview(new)[range_offset:range_offset + range_length]
+		done = 0
+		while done < range_length:
+			done += os.pwrite(fd, data[done:], offset + range_offset + done)
+		written += range_length
+
+	if written:
+		os.fsync(fd)
+
+	return written
+
+def BuildMetadataRegion(metadata: LpMetadata, blob: bytes) -> mmap:
+	"""
+	Lay out the whole metadata region (reserved bytes, both geometry copies,
+	and the primary and backup copies of every slot) in a single zeroed,
+	page aligned buffer.
+	"""
+	geometry = metadata.geometry
+	region = mmap(-1, GetTotalMetadataSize(geometry.metadata_max_size,
+	                                       geometry.metadata_slot_count))
+
+	geometry_blob = SerializeGeometry(geometry)
+	for offset in (GetPrimaryGeometryOffset(), GetBackupGeometryOffset()):
+		region[offset:offset + len(geometry_blob)] = geometry_blob
+
+	for slot_number in range(geometry.metadata_slot_count):
+		for offset in (GetPrimaryMetadataOffset(geometry, slot_number),
+		               GetBackupMetadataOffset(geometry, slot_number)):
+			region[offset:offset + len(blob)] = blob
+
+	return region
+
+def VerifyMetadataRegion(metadata: LpMetadata, region: bytes):
+	"""Parse every geometry and metadata copy of a metadata region."""
+	geometry = metadata.geometry
+	for offset in (GetPrimaryGeometryOffset(), GetBackupGeometryOffset()):
+		assert CompareGeometry(ParseGeometry(region[offset:offset + LP_METADATA_GEOMETRY_SIZE]),
+		                       geometry), \
+			f"Geometry at offset {offset} does not match after flashing."
+
+	reader = MemoryReader(region)
+	for slot_number in range(geometry.metadata_slot_count):
+		for offset in (GetPrimaryMetadataOffset(geometry, slot_number),
+		               GetBackupMetadataOffset(geometry, slot_number)):
+			reader.seek(offset)
+			ParseMetadata(geometry, reader)
 
 def FlashPartitionTable(super_partition: str, metadata: LpMetadata,
-                        opener: IPartitionOpener = None) -> bool:
-	raise NotImplementedError
+                        opener: IPartitionOpener = None, direct_io: bool = False) -> bool:
+	"""
+	The whole metadata region is built in memory and written with a single
+	positional write, then read back and every copy is parsed. With
+	|direct_io|, O_DIRECT is used for both when the underlying file
+	supports it, bypassing the page cache.
+	"""
+	if not opener:
+		opener = PartitionOpener()
+
+	# This is only used in update_engine and fastbootd, where the super
+	# partition should be named "super" (or super_a/super_b). If we're
+	# using a different name, the suffix will be ignored.
+	slot_suffix = GetPartitionSlotSuffix(super_partition)
+
+	# Before writing geometry and/or logical partition tables, perform some
+	# basic checks that the geometry and tables are coherent, and will fit
+	# on the given block device.
+	blob = ValidateAndSerializeMetadata(opener, metadata, slot_suffix, super_partition)
+
+	region = BuildMetadataRegion(metadata, blob)
+	readback = mmap(-1, len(region))
+
+	with opener.Open(super_partition, 'r+b') as fd, region, readback:
+		fd = fd.fileno()
+
+		direct = direct_io and SetDirectIo(fd, True)
+		written = 0
+		if direct:
+			try:
+				written = os.pwrite(fd, region, 0)
+			except OSError as e:
+				if e.errno != EINVAL:
+					raise
+			if written < len(region):
+				# Unaligned region, or a short write that would leave the rest at
+				# an unaligned offset: write the whole region through the page cache.
+				direct = SetDirectIo(fd, False)
+				written = 0
+
+		view = memoryview(region)
+		while written < len(region):
+			written += os.pwrite(fd, view[written:], written)
+		view.release()
+		os.fsync(fd)
+
+		read = 0
+		view = memoryview(readback)
+		while read < len(readback):
+			count = os.preadv(fd, [view[read:]], read)
+			if not count:
+				raise Exception("Unexpected end of file while verifying metadata")
+			read += count
+			if direct and read < len(readback):
+				# The rest is at an unaligned offset, read it through the page cache.
+				direct = SetDirectIo(fd, False)
+		view.release()
+
+		VerifyMetadataRegion(metadata, readback)
+
+	return True
 
 def UpdatePartitionTable(super_partition: str, metadata: LpMetadata, slot_number: int,
                          opener: IPartitionOpener = None) -> bool:
-	raise NotImplementedError
+	if not opener:
+		opener = PartitionOpener()
+
+	slot_suffix = SlotSuffixForSlotNumber(slot_number)
+
+	# Before writing geometry and/or logical partition tables, perform some
+	# basic checks that the geometry and tables are coherent, and will fit
+	# on the given block device.
+	blob = ValidateAndSerializeMetadata(opener, metadata, slot_suffix, super_partition)
+
+	with opener.Open(super_partition, 'r+b') as fd:
+		WriteMetadataSlots(fd, metadata, blob, [slot_number])
+
+	return True
+
+def WriteMetadataSlots(fd, metadata: LpMetadata, blob: bytes, slot_numbers: List[int]):
+	# Verify that the old geometry is identical. If it's not identical,
+	# then we might be writing a table that was built for a different
+	# device, so we must reject it.
+	geometry = metadata.geometry
+	old_geometry = ReadLogicalPartitionGeometry(fd)
+	assert CompareGeometry(geometry, old_geometry), \
+		"Incompatible geometry in new logical partition metadata"
+
+	# Validate the slot numbers now, before we compute any offset.
+	for slot_number in slot_numbers:
+		assert 0 <= slot_number < geometry.metadata_slot_count, \
+			f"Invalid logical partition metadata slot number {slot_number}"
+
+	for slot_number in slot_numbers:
+		# The backup copy is written and flushed first, so that an interrupted
+		# update always leaves one intact copy, either the old primary or the
+		# new backup. Unchanged sectors are not rewritten.
+		WriteMetadataCopy(fd.fileno(), GetBackupMetadataOffset(geometry, slot_number), blob)
+		WriteMetadataCopy(fd.fileno(), GetPrimaryMetadataOffset(geometry, slot_number), blob)
+
+def UpdateMetadataSlots(super_partition: str, metadata: LpMetadata, slot_numbers: List[int],
+                        opener: IPartitionOpener = None) -> bool:
+	"""
+	Write |metadata| to the primary and backup copies of each of
+	|slot_numbers|. Unlike UpdatePartitionTable(), slot numbers are not
+	mapped to A/B slot suffixes, so any metadata slot of the geometry can be
+	written, e.g. the third one of a virtual A/B super image.
+	"""
+	if not opener:
+		opener = PartitionOpener()
+
+	# No slot suffix can be derived, slot suffixed block devices are rejected.
+	blob = ValidateAndSerializeMetadata(opener, metadata, "", super_partition)
+
+	with opener.Open(super_partition, 'r+b') as fd:
+		WriteMetadataSlots(fd, metadata, blob, slot_numbers)
+
+	return True
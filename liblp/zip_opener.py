@@ -0,0 +1,146 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+"""
+Access to images inside zip archives (OTA and factory packages) without
+extracting them first.
+"""
+
+from io import SEEK_CUR, SEEK_END, SEEK_SET, BufferedIOBase, UnsupportedOperation
+import os
+from struct import Struct
+from typing import Optional
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
+
+from liblp.partition_opener import BlockDeviceInfo, IPartitionOpener, Pread
+
+# signature, version, flags, compression, mtime, mdate, crc32,
+# compressed size, size, file name length, extra field length
+ZIP_LOCAL_HEADER_STRUCT = Struct("<4sHHHHHIIIHH")
+ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+ZIP_FLAG_ENCRYPTED = 0x1
+
+class ZipMemberFile:
+	"""
+	Read-only file object over a stored zip member: a window of the archive
+	starting at |offset|, read with pread() so that any number of them can
+	share the archive descriptor.
+	"""
+	def __init__(self, fd: int, offset: int, size: int, name: str = ""):
+		self.fd = fd
+		self.offset = offset
+		self.size = size
+		self.name = name
+		self.position = 0
+		self.closed = False
+
+	def fileno(self) -> int:
+		# Offsets of the archive descriptor aren't member offsets.
+		raise UnsupportedOperation("fileno")
+
+	def seekable(self) -> bool:
+		return True
+
+	def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+		if whence == SEEK_CUR:
+			offset += self.position
+		elif whence == SEEK_END:
+			offset += self.size
+		self.position = offset
+		return self.position
+
+	def tell(self) -> int:
+		return self.position
+
+	def read(self, size: int = -1) -> bytes:
+		available = max(self.size - self.position, 0)
+		if size < 0 or size > available:
+			size = available
+		data = Pread(self.fd, size, self.offset + self.position)
+		self.position += len(data)
+		return data
+
+	def close(self):
+		self.closed = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class ZipPartitionOpener(IPartitionOpener):
+	"""
+	IPartitionOpener over the members of a zip archive. Partition names are
+	member names, or their base name if it is unique.
+
+	Stored members are windows of the archive, with random access.
+	Compressed members are decompressed as they are read: seeking forward
+	skips data, seeking backward starts over, so they should be read in
+	order.
+	"""
+	def __init__(self, zip_path: str):
+		self.zip_path = os.fspath(zip_path)
+		self.zip_file = ZipFile(self.zip_path)
+		self.fd = os.open(self.zip_path, os.O_RDONLY | os.O_CLOEXEC)
+
+	def GetMember(self, partition_name: str) -> ZipInfo:
+		try:
+			return self.zip_file.getinfo(partition_name)
+		except KeyError:
+			pass
+
+		members = [info for info in self.zip_file.infolist()
+		           if os.path.basename(info.filename) == partition_name]
+		if len(members) != 1:
+			raise Exception(f"{partition_name} not found in {self.zip_path}")
+		return members[0]
+
+	def GetMemberOffset(self, partition_name: str) -> Optional[int]:
+		"""
+		Return the offset of the data of member |partition_name| in the
+		archive, or None if it isn't stored as is.
+		"""
+		info = self.GetMember(partition_name)
+		if info.compress_type != ZIP_STORED or info.flag_bits & ZIP_FLAG_ENCRYPTED:
+			return None
+
+		# The extra field of the local header can differ from the central one.
+		header = Pread(self.fd, ZIP_LOCAL_HEADER_STRUCT.size, info.header_offset)
+		(signature, _, _, _, _, _, _, _, _, name_length,
+		 extra_length) = ZIP_LOCAL_HEADER_STRUCT.unpack(header)
+		assert signature == ZIP_LOCAL_HEADER_SIGNATURE, \
+			f"Invalid local header for {info.filename}"
+
+		return info.header_offset + ZIP_LOCAL_HEADER_STRUCT.size + name_length + extra_length
+
+	def Open(self, partition_name: str, flags: int) -> BufferedIOBase:
+		assert flags == 'rb', "Zip members can only be opened for reading."
+
+		info = self.GetMember(partition_name)
+		offset = self.GetMemberOffset(partition_name)
+		if offset is not None:
+			return ZipMemberFile(self.fd, offset, info.file_size, info.filename)
+		return self.zip_file.open(info)
+
+	def GetInfo(self, partition_name: str) -> BlockDeviceInfo:
+		try:
+			info = self.GetMember(partition_name)
+		except Exception:
+			return None
+		return BlockDeviceInfo(os.path.basename(info.filename), info.file_size, 0, 0, 4096)
+
+	def GetDeviceString(self, partition_name: str) -> str:
+		raise Exception("Zip members can't be used as block devices.")
+
+	def close(self):
+		self.zip_file.close()
+		os.close(self.fd)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
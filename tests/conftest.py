@@ -0,0 +1,41 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from benchmarks.generator import MiB, GenerateSuperImage
+from liblp.partition_tools.lpunpack import lpunpack
+
+# GenerateSuperImage() arguments of the super_image fixture, tests can
+# override them with @pytest.mark.super_image(**kwargs).
+SUPER_IMAGE_ARGS = {"size": 32 * MiB, "partitions": 2, "fragmentation": 2, "fill": 0.4}
+
+@pytest.fixture
+def super_image(request, tmp_path) -> Path:
+	"""Generate tmp_path/super.img with SUPER_IMAGE_ARGS and the marker arguments."""
+	args = dict(SUPER_IMAGE_ARGS)
+	marker = request.node.get_closest_marker("super_image")
+	if marker:
+		args.update(marker.kwargs)
+
+	image = tmp_path / "super.img"
+	GenerateSuperImage(image, **args)
+	return image
+
+def HashImages(output: Path) -> Dict[str, str]:
+	"""Hash the images in |output| by name."""
+	return {path.stem: sha256(path.read_bytes()).hexdigest()
+	        for path in sorted(output.glob("*.img"))}
+
+def HashPartitions(image: Path, output: Path, slot: int = 0) -> Dict[str, str]:
+	"""Extract the partitions of |image| to |output| and hash them by name."""
+	output.mkdir(exist_ok=True)
+	lpunpack(image, output, slot=slot)
+	return HashImages(output)
@@ -0,0 +1,82 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from random import Random
+
+import pytest
+
+from benchmarks.generator import MiB
+from liblp.builder import MetadataBuilder
+from liblp.include.metadata_format import LP_SECTOR_SIZE
+from liblp.partition_opener import BlockDeviceInfo
+from liblp.reader import MemoryReader, ParseMetadata
+from liblp.writer import SerializeMetadata
+
+def CheckFreeSpace(builder: MetadataBuilder):
+	"""Recount the free space of |builder| from its extents."""
+	for device_index, free_space in enumerate(builder.free_space):
+		block_device = builder.block_devices[device_index]
+		extents = sorted((extent.physical_sector, extent.EndSector())
+		                 for partition in builder.partitions.values()
+		                 for extent in partition.extents
+		                 if extent.device_index == device_index)
+
+		gaps = []
+		position = block_device.first_logical_sector
+		for start, end in extents:
+			assert start >= position, "Overlapping extents"
+			assert free_space.AlignSector(start) == start, "Unaligned extent"
+			if start > position:
+				gaps.append((position, start))
+			position = end
+		last_sector = block_device.size // LP_SECTOR_SIZE
+		assert position <= last_sector, "Extent past the end of the device"
+		if position < last_sector:
+			gaps.append((position, last_sector))
+
+		assert list(zip(free_space.starts, free_space.ends)) == gaps
+		assert free_space.free_sectors == sum(end - start for start, end in gaps)
+		assert free_space.allocatable == [start for start, end in gaps
+		                                  if free_space.AllocatableRange(start, end)[1]]
+
+	sectors_per_block = builder.geometry.logical_block_size // LP_SECTOR_SIZE
+	for partition in builder.partitions.values():
+		for extent in partition.extents:
+			assert extent.num_sectors % sectors_per_block == 0
+		assert partition.size == sum(extent.num_sectors for extent in partition.extents) * LP_SECTOR_SIZE
+
+@pytest.mark.parametrize("alignment", [0, 4096, 64 * 1024])
+def test_random_resizes(alignment):
+	builder = MetadataBuilder.New([BlockDeviceInfo("super", 64 * MiB, alignment, 0, 4096)],
+	                              "super", 64 * 1024, 2)
+	partitions = [builder.AddPartition(f"partition_{i}", 0) for i in range(16)]
+
+	random = Random(0)
+	failures = 0
+	for i in range(2000):
+		partition = random.choice(partitions)
+		size = partition.size
+		requested_size = random.randrange(0, 8 * MiB)
+		if builder.ResizePartition(partition, requested_size):
+			assert partition.size == requested_size + -requested_size % 4096
+		else:
+			assert partition.size == size
+			failures += 1
+		if i % 100 == 0:
+			CheckFreeSpace(builder)
+
+	# Some resizes must have run out of space.
+	assert failures
+	builder.RemovePartition(partitions[0].name)
+	CheckFreeSpace(builder)
+
+	# The free space of an edited copy is the same as the one kept up to date.
+	metadata = builder.Export()
+	copy = MetadataBuilder.NewFromMetadata(
+		ParseMetadata(metadata.geometry, MemoryReader(SerializeMetadata(metadata))))
+	CheckFreeSpace(copy)
+	assert copy.free_space[0].starts == builder.free_space[0].starts
+	assert copy.free_space[0].ends == builder.free_space[0].ends
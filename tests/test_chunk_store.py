@@ -0,0 +1,35 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import pytest
+
+from liblp.chunk_store import ChunkStore, IngestSuperImage, StreamSuperImage
+
+# Most of the image is free space, made of identical zero chunks.
+pytestmark = pytest.mark.super_image(fragmentation=1, fill=0.25)
+
+def test_ingest_counts_stored_chunks(super_image, tmp_path):
+	image = super_image
+	store = ChunkStore(tmp_path / "store")
+
+	stats = IngestSuperImage(store, image, chunk_size=64 * 1024, jobs=8)
+
+	chunk_files = [path for path in (tmp_path / "store" / "chunks").rglob("*") if path.is_file()]
+	assert stats.new_chunks == len(chunk_files) < stats.chunks
+	assert stats.bytes_stored == sum(path.stat().st_size for path in chunk_files)
+	assert b"".join(StreamSuperImage(store, "super")) == image.read_bytes()
+
+	stats = IngestSuperImage(store, image, "again", chunk_size=64 * 1024, jobs=8)
+	assert stats.new_chunks == stats.bytes_stored == 0
+
+@pytest.mark.parametrize("name", ["../outside", "a/b", "a\0b"])
+def test_invalid_name(super_image, tmp_path, name):
+	store = ChunkStore(tmp_path / "store")
+
+	with pytest.raises(Exception, match="Invalid image name"):
+		IngestSuperImage(store, super_image, name)
+	assert not (tmp_path / "store").exists()
+	assert not (tmp_path / "outside.json").exists()
@@ -0,0 +1,32 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import pytest
+
+from conftest import HashPartitions
+from liblp.defrag import DefragmentSuperImage
+from liblp.reader import ReadLogicalPartitionGeometry, ReadUnadjustedMetadata
+from liblp.writer import SerializeMetadata
+
+def ReadSlots(image):
+	with image.open('rb') as fd:
+		geometry = ReadLogicalPartitionGeometry(fd)
+		return [SerializeMetadata(ReadUnadjustedMetadata(fd, geometry, slot))
+		        for slot in range(geometry.metadata_slot_count)]
+
+@pytest.mark.super_image(partitions=3, fragmentation=4, slots=3, alignment=4096)
+def test_defragment_three_slots(super_image, tmp_path):
+	image = super_image
+	before = HashPartitions(image, tmp_path / "before")
+
+	stats = DefragmentSuperImage(image)
+
+	assert stats.passes
+	assert stats.extents_after == 3 < stats.extents_before
+	slots = ReadSlots(image)
+	assert len(slots) == 3
+	assert slots[1] == slots[0] and slots[2] == slots[0]
+	assert HashPartitions(image, tmp_path / "after") == before
@@ -0,0 +1,117 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+
+import pytest
+
+from benchmarks.generator import MiB
+from conftest import HashPartitions
+from liblp import GetPartitionExtentMap, GetPartitionName, GetPartitionSize, ReadMetadata
+from liblp.filesystems import (
+	AVB_FOOTER_MAGIC,
+	AVB_FOOTER_SIZE,
+	AVB_FOOTER_STRUCT,
+	EROFS_SUPER_BLOCK_STRUCT,
+	EROFS_SUPER_MAGIC_V1,
+	EXT4_BLOCKS_COUNT_LO_OFFSET,
+	EXT4_LOG_BLOCK_SIZE_OFFSET,
+	EXT4_MAGIC_OFFSET,
+	EXT4_SUPER_MAGIC,
+	F2FS_SUPER_BLOCK_STRUCT,
+	F2FS_SUPER_MAGIC,
+	SUPERBLOCK_OFFSET,
+	SUPERBLOCK_SIZE,
+	GetUsedRanges,
+)
+from liblp.partition_tools.lpunpack import lpunpack
+
+def Ext4Superblock(size: int) -> bytes:
+	# 4096 bytes blocks.
+	superblock = bytearray(SUPERBLOCK_SIZE)
+	superblock[EXT4_BLOCKS_COUNT_LO_OFFSET:EXT4_BLOCKS_COUNT_LO_OFFSET + 4] = \
+		(size // 4096).to_bytes(4, "little")
+	superblock[EXT4_LOG_BLOCK_SIZE_OFFSET:EXT4_LOG_BLOCK_SIZE_OFFSET + 4] = \
+		(2).to_bytes(4, "little")
+	superblock[EXT4_MAGIC_OFFSET:EXT4_MAGIC_OFFSET + 2] = EXT4_SUPER_MAGIC.to_bytes(2, "little")
+	return bytes(superblock)
+
+def ErofsSuperblock(size: int) -> bytes:
+	return EROFS_SUPER_BLOCK_STRUCT.pack(EROFS_SUPER_MAGIC_V1, 0, 0, 12, 0, 0, 0, 0, 0,
+	                                     size >> 12).ljust(SUPERBLOCK_SIZE, b"\0")
+
+def F2fsSuperblock(size: int) -> bytes:
+	return F2FS_SUPER_BLOCK_STRUCT.pack(F2FS_SUPER_MAGIC, 1, 15, 9, 3, 12, 9, 1, 1, 0,
+	                                    size >> 12).ljust(SUPERBLOCK_SIZE, b"\0")
+
+def AvbFooter(original_image_size: int, vbmeta_offset: int, vbmeta_size: int) -> bytes:
+	return AVB_FOOTER_STRUCT.pack(AVB_FOOTER_MAGIC, 1, 0, original_image_size,
+	                              vbmeta_offset, vbmeta_size)
+
+def MemoryPartition(size: int, superblock: bytes = b"", footer: bytes = b""):
+	data = bytearray(size)
+	data[SUPERBLOCK_OFFSET:SUPERBLOCK_OFFSET + len(superblock)] = superblock
+	if footer:
+		data[-AVB_FOOTER_SIZE:] = footer
+	return lambda offset, length: bytes(data[offset:offset + length])
+
+@pytest.mark.parametrize("superblock", [Ext4Superblock, ErofsSuperblock, F2fsSuperblock])
+def test_filesystem_size(superblock):
+	read = MemoryPartition(8 * MiB, superblock(2 * MiB))
+	assert GetUsedRanges(read, 8 * MiB) == [(0, 2 * MiB)]
+
+def test_avb_footer():
+	# Hash tree after the filesystem, then vbmeta.
+	read = MemoryPartition(8 * MiB, Ext4Superblock(2 * MiB),
+	                       AvbFooter(2 * MiB, 2 * MiB + 64 * 1024, 1000))
+	assert GetUsedRanges(read, 8 * MiB) == [(0, 2 * MiB + 68 * 1024), (8 * MiB - 4096, 4096)]
+
+@pytest.mark.parametrize("superblock, footer", [
+	# Nothing recognized.
+	(b"", b""),
+	# Filesystem larger than the partition.
+	(Ext4Superblock(16 * MiB), b""),
+	# vbmeta past the footer block.
+	(b"", AvbFooter(2 * MiB, 8 * MiB - 2048, 1024)),
+])
+def test_whole_partition(superblock, footer):
+	read = MemoryPartition(8 * MiB, superblock, footer)
+	assert GetUsedRanges(read, 8 * MiB) == [(0, 8 * MiB)]
+
+def WritePartition(image, metadata, name: str, offset: int, data: bytes):
+	partition = next(partition for partition in metadata.partitions
+	                 if GetPartitionName(partition) == name)
+	fd = os.open(image, os.O_RDWR)
+	try:
+		for segment in GetPartitionExtentMap(metadata, partition).Translate(offset, len(data)):
+			start = segment.logical_offset - offset
+			os.pwrite(fd, data[start:start + segment.length], segment.offset)
+	finally:
+		os.close(fd)
+
+def test_lpunpack_used_only(super_image, tmp_path):
+	metadata = ReadMetadata(super_image, 0)
+	sizes = {GetPartitionName(partition): GetPartitionSize(metadata, partition)
+	         for partition in metadata.partitions}
+
+	# bench_0 holds a 2 MiB ext4 filesystem with an AVB footer, bench_1
+	# isn't recognized and is extracted whole.
+	size = sizes["bench_0"]
+	assert size > 4 * MiB
+	WritePartition(super_image, metadata, "bench_0", SUPERBLOCK_OFFSET, Ext4Superblock(2 * MiB))
+	WritePartition(super_image, metadata, "bench_0", size - AVB_FOOTER_SIZE,
+	               AvbFooter(2 * MiB, 2 * MiB, 4096))
+	HashPartitions(super_image, tmp_path / "full")
+
+	output = tmp_path / "used"
+	output.mkdir()
+	lpunpack(super_image, output, used_only=True)
+
+	full = (tmp_path / "full" / "bench_0.img").read_bytes()
+	used = (output / "bench_0.img").read_bytes()
+	assert used == full[:2 * MiB + 4096] + bytes(size - 2 * MiB - 8192) + full[-4096:]
+	assert (output / "bench_0.img").stat().st_blocks * 512 <= 2 * MiB + 8192 + 64 * 1024
+	assert (output / "bench_1.img").read_bytes() == (tmp_path / "full" / "bench_1.img").read_bytes()
@@ -0,0 +1,100 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from mmap import ACCESS_READ, mmap
+from random import Random
+
+import pytest
+
+from benchmarks.generator import MiB, BuildSuperMetadata
+from liblp import (
+	GetPartitionName,
+	GetPartitionSize,
+	IsEmptySuperImage,
+	ReadFromImageBlob,
+	ReadFromImageFile,
+	ReadMetadata,
+	WriteToImageFile,
+)
+from liblp.partition_tools.lpunpack import lpunpack
+from liblp.utility import GetTotalMetadataSize
+from liblp.writer import SerializeGeometry, SerializeMetadata
+
+@pytest.fixture
+def super_empty_image(super_image, tmp_path):
+	# Like lpmake without images: the geometry followed by the metadata.
+	metadata = ReadMetadata(super_image, 0)
+	image = tmp_path / "super_empty.img"
+	image.write_bytes(SerializeGeometry(metadata.geometry) + SerializeMetadata(metadata))
+	return image
+
+def test_is_empty_super_image(super_image, super_empty_image):
+	assert IsEmptySuperImage(super_empty_image)
+	assert not IsEmptySuperImage(super_image)
+
+def test_read_from_image_file(super_image, super_empty_image):
+	expected = SerializeMetadata(ReadMetadata(super_image, 0))
+	assert SerializeMetadata(ReadFromImageFile(super_empty_image)) == expected
+	assert SerializeMetadata(ReadFromImageFile(super_image)) == expected
+
+@pytest.mark.parametrize("blob_type", ["bytes", "memoryview", "mmap"])
+def test_read_from_image_blob(super_image, super_empty_image, blob_type):
+	expected = SerializeMetadata(ReadMetadata(super_image, 0))
+	with super_empty_image.open('rb') as fd:
+		if blob_type == "bytes":
+			blob = fd.read()
+		elif blob_type == "memoryview":
+			blob = memoryview(bytearray(fd.read()))
+		else:
+			blob = mmap(fd.fileno(), 0, access=ACCESS_READ)
+
+		assert SerializeMetadata(ReadFromImageBlob(blob)) == expected
+
+def test_read_from_image_blob_too_small():
+	with pytest.raises(AssertionError, match="too small"):
+		ReadFromImageBlob(bytes(1024))
+
+@pytest.fixture
+def partition_images(tmp_path):
+	"""
+	Metadata of a 32 MiB super image with two partitions, and images for
+	them: a full one and one covering half of its partition.
+	"""
+	metadata = BuildSuperMetadata(size=32 * MiB, partitions=2, fragmentation=2, fill=0.4)
+	random = Random(0)
+	images = {}
+	for i, partition in enumerate(metadata.partitions):
+		name = GetPartitionName(partition)
+		size = GetPartitionSize(metadata, partition) // (i + 1)
+		images[name] = tmp_path / f"{name}.in"
+		images[name].write_bytes(random.getrandbits(size * 8).to_bytes(size, "little"))
+	return metadata, images
+
+def test_raw_round_trip(partition_images, tmp_path):
+	metadata, images = partition_images
+	image = tmp_path / "super.img"
+	assert WriteToImageFile(str(image), metadata, 4096,
+	                        {name: str(path) for name, path in images.items()}, False)
+
+	assert SerializeMetadata(ReadFromImageFile(image)) == SerializeMetadata(metadata)
+
+	output = tmp_path / "out"
+	output.mkdir()
+	lpunpack(image, output)
+	for partition in metadata.partitions:
+		name = GetPartitionName(partition)
+		data = images[name].read_bytes()
+		assert (output / f"{name}.img").read_bytes() == \
+			data.ljust(GetPartitionSize(metadata, partition), b"\0")
+
+	# Only the metadata and the partition images are allocated, the rest is
+	# a hole.
+	stat = image.stat()
+	assert stat.st_size == metadata.block_devices[0].size
+	geometry = metadata.geometry
+	used = (GetTotalMetadataSize(geometry.metadata_max_size, geometry.metadata_slot_count)
+	        + sum(path.stat().st_size for path in images.values()))
+	assert stat.st_blocks * 512 <= used + 64 * 1024
@@ -0,0 +1,70 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from compileall import compile_dir
+from pathlib import Path
+import subprocess
+import sys
+from typing import Dict, Tuple
+
+import pytest
+
+import liblp
+
+# Cumulative import time budgets, in microseconds. The lazy namespace only
+# costs the stdlib modules it needs, lpunpack adds the reader and argparse.
+IMPORT_TIME_BUDGETS = {
+	"liblp": 10000,
+	"liblp.partition_tools.lpunpack": 60000,
+}
+
+# Modules that are only needed by some code paths and slow to import.
+LAZY_MODULES = [
+	"cProfile",
+	"pstats",
+	"concurrent.futures",
+	"multiprocessing",
+	"zipfile",
+	"liblp.images",
+	"liblp.sparse",
+]
+
+RUNS = 5
+
+SOURCE_DIR = Path(liblp.__file__).parent.parent
+
+@pytest.fixture(scope="module", autouse=True)
+def bytecode():
+	# Stale bytecode would be compiled on every import.
+	compile_dir(SOURCE_DIR / "liblp", quiet=1)
+
+def ImportTime(module: str) -> Tuple[int, Dict[str, int]]:
+	"""
+	Import |module| in a new interpreter, return its cumulative import time
+	and the cumulative time of every module imported, in microseconds.
+	site is disabled so that .pth files can't import anything at startup,
+	the package is imported from the source tree.
+	"""
+	result = subprocess.run([sys.executable, "-S", "-X", "importtime", "-c", f"import {module}"],
+	                        check=True, capture_output=True, text=True, cwd=SOURCE_DIR)
+	modules = {}
+	for line in result.stderr.splitlines():
+		if not line.startswith("import time:") or "cumulative" in line:
+			continue
+		_, cumulative, name = line.split("|")
+		modules[name.strip()] = int(cumulative)
+	return modules[module], modules
+
+@pytest.mark.parametrize("module", IMPORT_TIME_BUDGETS)
+def test_import_time(module):
+	best = min(ImportTime(module)[0] for _ in range(RUNS))
+	assert best <= IMPORT_TIME_BUDGETS[module], \
+		f"import {module} took {best} us, budget is {IMPORT_TIME_BUDGETS[module]} us"
+
+@pytest.mark.parametrize("module", IMPORT_TIME_BUDGETS)
+def test_lazy_imports(module):
+	_, modules = ImportTime(module)
+	assert not [name for name in LAZY_MODULES if name in modules]
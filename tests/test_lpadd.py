@@ -0,0 +1,26 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import pytest
+
+from conftest import HashPartitions
+from liblp.partition_tools.lpadd import lpadd
+from test_defrag import ReadSlots
+
+@pytest.mark.super_image(fragmentation=1, slots=3)
+def test_lpadd_three_slots(super_image, tmp_path):
+	image = super_image
+	partition_image = tmp_path / "new.img"
+	partition_image.write_bytes(bytes(range(256)) * 4096)
+
+	lpadd(image, "new", "default", partition_image)
+
+	slots = ReadSlots(image)
+	assert len(slots) == 3
+	assert slots[1] == slots[0] and slots[2] == slots[0]
+	hashes = HashPartitions(image, tmp_path / "out")
+	assert set(hashes) == {"bench_0", "bench_1", "new"}
+	assert (tmp_path / "out" / "new.img").read_bytes() == partition_image.read_bytes()
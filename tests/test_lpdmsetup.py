@@ -0,0 +1,45 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+import subprocess
+
+import pytest
+
+from liblp import CreateDmTables, DeviceMapOpener, ReadMetadata
+from liblp.partition_tools.lpdmsetup import lpdmsetup
+
+def test_script(super_image):
+	script = lpdmsetup(super_image, prefix="test_")
+	lines = script.splitlines()
+
+	assert lines[:2] == ["#!/bin/sh", "set -e"]
+	assert lines[2] == f"LOOP=$(losetup --find --show --read-only {super_image})"
+	assert lines[3] == ("printf '%s\\n' '0 6144 linear '\"$LOOP\"' 2048' "
+	                    "'6144 6144 linear '\"$LOOP\"' 14336' | dmsetup create test_bench_0 --readonly")
+	assert len(lines) == 5
+
+def test_script_runs(super_image, tmp_path):
+	# Fake losetup and dmsetup, dmsetup saves the table it is given.
+	bin_dir = tmp_path / "bin"
+	bin_dir.mkdir()
+	(bin_dir / "losetup").write_text("#!/bin/sh\necho /dev/loop7\n")
+	(bin_dir / "dmsetup").write_text(f"#!/bin/sh\ncat > {tmp_path}/$2.table\n")
+	for tool in bin_dir.iterdir():
+		tool.chmod(0o755)
+
+	env = dict(os.environ, PATH=f"{bin_dir}:{os.environ['PATH']}")
+	subprocess.run(["sh", "-c", lpdmsetup(super_image)], check=True, env=env)
+
+	metadata = ReadMetadata(super_image, 0)
+	tables = CreateDmTables(metadata, DeviceMapOpener({"super": "/dev/loop7"}))
+	for name, table in tables.items():
+		assert (tmp_path / f"{name}.table").read_text() == table.Serialize()
+
+@pytest.mark.parametrize("device", ["/dev/x$(id)", "/dev/a b", "/dev/a;reboot", "`id`", ""])
+def test_invalid_device(super_image, device):
+	with pytest.raises(Exception, match="Invalid device string"):
+		lpdmsetup(super_image, {"super": device})
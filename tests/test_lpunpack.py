@@ -0,0 +1,58 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import pytest
+import sys
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from benchmarks.generator import MiB
+from conftest import HashImages, HashPartitions
+from liblp.partition_tools.lpunpack import lpunpack, main
+
+@pytest.mark.parametrize("chunk_size", [-4096, 0, 1000, 512])
+def test_invalid_chunk_size(super_image, tmp_path, chunk_size):
+	output = tmp_path / "out"
+	output.mkdir()
+	with pytest.raises(AssertionError):
+		lpunpack(super_image, output, jobs=2, chunk_size=chunk_size)
+	assert not list(output.iterdir())
+
+@pytest.mark.parametrize("chunk_size", [-4096, 0, 1000, 512])
+def test_cli_invalid_chunk_size(super_image, tmp_path, monkeypatch, capsys, chunk_size):
+	output = tmp_path / "out"
+	output.mkdir()
+	monkeypatch.setattr(sys, "argv", ["lpunpack", str(super_image), "-o", str(output),
+	                                  "-j", "2", "--chunk-size", str(chunk_size)])
+	with pytest.raises(SystemExit) as exit_info:
+		main()
+	assert exit_info.value.code == 2
+	assert "--chunk-size must be" in capsys.readouterr().err
+	assert not list(output.iterdir())
+
+def test_jobs(super_image, tmp_path):
+	expected = HashPartitions(super_image, tmp_path / "default")
+	output = tmp_path / "jobs"
+	output.mkdir()
+	lpunpack(super_image, output, jobs=2, chunk_size=1 * MiB)
+	assert HashImages(output) == expected
+
+def test_used_only_compressed_zip(super_image, tmp_path, monkeypatch, capsys):
+	archive = tmp_path / "super.zip"
+	with ZipFile(archive, 'w', ZIP_DEFLATED) as zip_file:
+		zip_file.write(super_image, "super.img")
+
+	output = tmp_path / "out"
+	output.mkdir()
+	with pytest.raises(Exception, match="super.img is compressed"):
+		lpunpack(archive, output, zip_member="super.img", used_only=True)
+	assert not list(output.iterdir())
+
+	monkeypatch.setattr(sys, "argv", ["lpunpack", str(archive), "-o", str(output), "--used-only"])
+	with pytest.raises(SystemExit) as exit_info:
+		main()
+	assert exit_info.value.code == 2
+	assert "--used-only needs random access" in capsys.readouterr().err
+	assert not list(output.iterdir())
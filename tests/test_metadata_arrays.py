@@ -0,0 +1,50 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from liblp import GetPartitionSize, ReadMetadata
+from liblp.metadata_arrays import GetPartitionSizes, ReadMetadataArrays
+from liblp.utility import GetBackupMetadataOffset, GetPrimaryMetadataOffset
+from liblp.writer import SerializeMetadata
+
+pytestmark = pytest.mark.super_image(partitions=3)
+
+def WriteMetadata(image, metadata):
+	# Both copies, bypassing the validation of the writer.
+	blob = SerializeMetadata(metadata)
+	fd = os.open(image, os.O_WRONLY)
+	try:
+		for offset in (GetPrimaryMetadataOffset(metadata.geometry, 0),
+		               GetBackupMetadataOffset(metadata.geometry, 0)):
+			os.pwrite(fd, blob, offset)
+	finally:
+		os.close(fd)
+
+def test_read(super_image):
+	metadata = ReadMetadata(super_image, 0)
+	arrays = ReadMetadataArrays(super_image, 0)
+	assert list(GetPartitionSizes(arrays)) == \
+		[GetPartitionSize(metadata, partition) for partition in metadata.partitions]
+
+@pytest.mark.parametrize("field, value", [
+	("num_extents", 100),
+	("first_extent_index", 0xFFFFFFFF),
+	("group_index", 5),
+])
+def test_invalid_partition(super_image, field, value):
+	metadata = ReadMetadata(super_image, 0)
+	setattr(metadata.partitions[1], field, value)
+	WriteMetadata(super_image, metadata)
+
+	with pytest.raises(Exception):
+		ReadMetadata(super_image, 0)
+	with pytest.raises(AssertionError):
+		ReadMetadataArrays(super_image, 0)
@@ -0,0 +1,31 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from io import SEEK_END
+from struct import pack
+
+from liblp.partition_opener import BLKGETSIZE64, PooledPartitionOpener
+import liblp.partition_opener
+
+def test_pread_file_block_device(tmp_path, monkeypatch):
+	# A file standing in for a block device, whose st_size isn't its size.
+	device = tmp_path / "super"
+	device.write_bytes(bytes(range(256)) * 32)
+
+	def ioctl(fd, request, arg):
+		assert request == BLKGETSIZE64
+		return pack("<Q", 4096)
+
+	monkeypatch.setattr(liblp.partition_opener, "S_ISBLK", lambda mode: True)
+	monkeypatch.setattr(liblp.partition_opener, "ioctl", ioctl)
+
+	opener = PooledPartitionOpener()
+	with opener.Open(str(device), 'rb') as fd:
+		assert fd.seek(-16, SEEK_END) == 4080
+		assert fd.read() == bytes(range(240, 256))
+
+		fd.seek(0)
+		assert fd.read() == device.read_bytes()[:4096]
@@ -0,0 +1,39 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+
+import pytest
+
+from liblp import ReadMetadata
+from liblp.include.metadata_format import LpMetadataHeader
+from liblp.utility import GetBackupMetadataOffset, GetPrimaryMetadataOffset
+from liblp.writer import SerializeMetadata
+
+def Corrupt(image, offset: int, field=LpMetadataHeader.header_checksum):
+	# Flip the first byte of |field| of the header at |offset|.
+	fd = os.open(image, os.O_RDWR)
+	try:
+		offset += field.offset
+		os.pwrite(fd, bytes([os.pread(fd, 1, offset)[0] ^ 0xFF]), offset)
+	finally:
+		os.close(fd)
+
+def test_invalid_slot(super_image):
+	with pytest.raises(Exception, match="invalid metadata slot number"):
+		ReadMetadata(super_image, 2)
+
+def test_backup_copy(super_image):
+	metadata = ReadMetadata(super_image, 0)
+	Corrupt(super_image, GetPrimaryMetadataOffset(metadata.geometry, 0))
+	assert SerializeMetadata(ReadMetadata(super_image, 0)) == SerializeMetadata(metadata)
+
+def test_primary_error(super_image):
+	geometry = ReadMetadata(super_image, 0).geometry
+	Corrupt(super_image, GetPrimaryMetadataOffset(geometry, 0), LpMetadataHeader.magic)
+	Corrupt(super_image, GetBackupMetadataOffset(geometry, 0))
+	with pytest.raises(AssertionError, match="invalid magic value"):
+		ReadMetadata(super_image, 0)
@@ -0,0 +1,89 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from random import Random
+
+from benchmarks.generator import MiB, BuildSuperMetadata
+from liblp import BlockDeviceInfo, GetPartitionName, MetadataBuilder, WriteToImageFile
+import liblp.images
+from liblp.images import ImageBuilder
+from liblp.sparse import (
+	CHUNK_TYPE_DONT_CARE,
+	CHUNK_TYPE_FILL,
+	CHUNK_TYPE_RAW,
+	SparseImageReader,
+)
+
+def test_sparse_round_trip(tmp_path):
+	metadata = BuildSuperMetadata(size=32 * MiB, partitions=2, fragmentation=2, fill=0.4)
+	random = Random(0)
+	images = {}
+	for partition in metadata.partitions:
+		name = GetPartitionName(partition)
+		# RAW, FILL and zero runs, the rest of the partition isn't covered.
+		images[name] = str(tmp_path / f"{name}.in")
+		with open(images[name], 'wb') as fd:
+			fd.write(random.getrandbits(MiB * 8).to_bytes(MiB, "little"))
+			fd.write(b"\xde\xad\xbe\xef" * (MiB // 4))
+			fd.write(bytes(MiB))
+			fd.write(random.getrandbits(MiB * 8).to_bytes(MiB, "little"))
+
+	raw = tmp_path / "super.img"
+	sparse = tmp_path / "super.simg"
+	assert WriteToImageFile(str(raw), metadata, 4096, images, False)
+	assert WriteToImageFile(str(sparse), metadata, 4096, images, True)
+	assert sparse.stat().st_size < raw.stat().st_size
+
+	with open(sparse, 'rb') as fd:
+		reader = SparseImageReader(fd)
+		assert reader.size == raw.stat().st_size
+		assert reader.read() == raw.read_bytes()
+
+	assert {CHUNK_TYPE_RAW, CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE} <= set(reader.types)
+	# Adjacent chunks of the same type, and pattern for FILL chunks, are merged.
+	for i in range(1, len(reader.types)):
+		assert reader.types[i] != reader.types[i - 1] or (
+			reader.types[i] == CHUNK_TYPE_FILL and reader.payloads[i] != reader.payloads[i - 1])
+
+def test_export_files_shared_pool(tmp_path, monkeypatch):
+	# Two block devices with one partition each, both classified by the pool.
+	monkeypatch.setattr(liblp.images, "PARALLEL_CLASSIFY_THRESHOLD", 0)
+	pools = []
+	def CreateClassifierPool(jobs):
+		pools.append(jobs)
+		return create_classifier_pool(jobs)
+	create_classifier_pool = liblp.images.CreateClassifierPool
+	monkeypatch.setattr(liblp.images, "CreateClassifierPool", CreateClassifierPool)
+
+	builder = MetadataBuilder.New([BlockDeviceInfo("super", 8 * MiB, 0, 0, 4096),
+	                               BlockDeviceInfo("super_b", 8 * MiB, 0, 0, 4096)],
+	                              "super", 64 * 1024, 2)
+	random = Random(0)
+	images = {}
+	for name in ("first", "second"):
+		partition = builder.AddPartition(name, 0)
+		assert builder.ResizePartition(partition, 4 * MiB)
+		image = tmp_path / f"{name}.img"
+		# Random blocks, then zero blocks.
+		image.write_bytes(random.getrandbits(2 * MiB * 8).to_bytes(2 * MiB, "little")
+		                  + bytes(2 * MiB))
+		images[name] = str(image)
+	metadata = builder.Export()
+
+	outputs = {}
+	for jobs in (1, 2):
+		output = tmp_path / f"jobs{jobs}"
+		output.mkdir()
+		image_builder = ImageBuilder(metadata, 4096, images, True, jobs)
+		image_builder.Build()
+		image_builder.ExportFiles(str(output))
+		outputs[jobs] = {path.name: path.read_bytes() for path in output.iterdir()}
+
+	assert pools == [2]
+	assert outputs[2] == outputs[1]
+	assert set(outputs[1]) == {"super_super.img", "super_super_b.img"}
+	with open(tmp_path / "jobs2" / "super_super.img", 'rb') as fd:
+		assert SparseImageReader(fd).size == 8 * MiB
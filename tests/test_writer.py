@@ -0,0 +1,126 @@
+#
+# Copyright (C) 2022 Sebastiano Barezzi
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from errno import EINVAL
+import os
+
+import pytest
+
+from benchmarks.generator import MiB
+from liblp.builder import MetadataBuilder
+from liblp.include.metadata_format import LP_SECTOR_SIZE
+from liblp.reader import GetPartitionName, ReadMetadata
+from liblp.utility import GetBackupMetadataOffset, GetPrimaryMetadataOffset
+from liblp.writer import (
+	FlashPartitionTable,
+	GetDirtySectorRanges,
+	SerializeMetadata,
+	UpdateMetadataSlots,
+	UpdatePartitionTable,
+)
+import liblp.writer
+
+def test_direct_io_short_write(super_image, monkeypatch):
+	image = super_image
+	metadata = ReadMetadata(image, 0)
+
+	# Emulate O_DIRECT: unaligned writes fail and the first one is short.
+	direct = []
+	writes = []
+	pwrite = os.pwrite
+
+	def SetDirectIo(fd, enable):
+		direct[:] = [enable]
+		return enable
+
+	def DirectPwrite(fd, data, offset):
+		if direct[0]:
+			if offset % 4096 or len(data) % 4096:
+				raise OSError(EINVAL, os.strerror(EINVAL))
+			if not writes:
+				writes.append(offset)
+				return pwrite(fd, memoryview(data)[:len(data) - LP_SECTOR_SIZE], offset)
+		writes.append(offset)
+		return pwrite(fd, data, offset)
+
+	monkeypatch.setattr(liblp.writer, "SetDirectIo", SetDirectIo)
+	monkeypatch.setattr(os, "pwrite", DirectPwrite)
+
+	assert FlashPartitionTable(str(image), metadata, direct_io=True)
+	assert writes == [0, 0]
+	assert direct == [False]
+	assert SerializeMetadata(ReadMetadata(image, 0)) == SerializeMetadata(metadata)
+
+@pytest.mark.parametrize("write", [
+	lambda image, metadata: FlashPartitionTable(image, metadata),
+	lambda image, metadata: UpdatePartitionTable(image, metadata, 0),
+	lambda image, metadata: UpdateMetadataSlots(image, metadata, [0, 1]),
+])
+def test_device_size_mismatch(super_image, write):
+	image = super_image
+	metadata = ReadMetadata(image, 0)
+
+	os.truncate(image, 16 * MiB)
+	before = image.read_bytes()
+	with pytest.raises(AssertionError, match="size mismatch"):
+		write(str(image), metadata)
+	assert image.read_bytes() == before
+
+# Enough extents for the metadata to span several sectors.
+@pytest.mark.super_image(partitions=8, fragmentation=4, alignment=4096)
+def test_update_writes_changed_sectors(super_image, monkeypatch):
+	image = super_image
+	metadata = ReadMetadata(image, 0)
+	geometry = metadata.geometry
+
+	builder = MetadataBuilder.NewFromMetadata(metadata)
+	partition = builder.FindPartition(GetPartitionName(metadata.partitions[0]))
+	assert builder.ResizePartition(partition, partition.size - geometry.logical_block_size)
+	new_metadata = builder.Export()
+	blob = SerializeMetadata(new_metadata)
+
+	before = image.read_bytes()
+	calls = []
+	pwrite = os.pwrite
+	fsync = os.fsync
+
+	def RecordPwrite(fd, data, offset):
+		calls.append(("pwrite", offset, len(data)))
+		return pwrite(fd, data, offset)
+
+	def RecordFsync(fd):
+		calls.append(("fsync",))
+		return fsync(fd)
+
+	monkeypatch.setattr(os, "pwrite", RecordPwrite)
+	monkeypatch.setattr(os, "fsync", RecordFsync)
+
+	assert UpdatePartitionTable(str(image), new_metadata, 0)
+
+	# Only the changed sectors of the backup copy then of the primary copy are
+	# written, each copy being flushed once.
+	expected = []
+	for offset in (GetBackupMetadataOffset(geometry, 0), GetPrimaryMetadataOffset(geometry, 0)):
+		length = (len(blob) + LP_SECTOR_SIZE - 1) // LP_SECTOR_SIZE * LP_SECTOR_SIZE
+		old = before[offset:offset + length]
+		ranges = GetDirtySectorRanges(blob + old[len(blob):], old)
+		assert ranges and sum(range_length for _, range_length in ranges) < length
+		expected += [("pwrite", offset + range_offset, range_length)
+		             for range_offset, range_length in ranges]
+		expected.append(("fsync",))
+	assert calls == expected
+
+	after = image.read_bytes()
+	for offset in (GetBackupMetadataOffset(geometry, 1), GetPrimaryMetadataOffset(geometry, 1)):
+		assert after[offset:offset + geometry.metadata_max_size] == \
+			before[offset:offset + geometry.metadata_max_size]
+	assert SerializeMetadata(ReadMetadata(image, 0)) == blob
+	assert SerializeMetadata(ReadMetadata(image, 1)) == SerializeMetadata(metadata)
+
+	# Nothing changes the second time: no write, no flush.
+	calls.clear()
+	assert UpdatePartitionTable(str(image), new_metadata, 0)
+	assert calls == []